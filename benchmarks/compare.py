@@ -0,0 +1,83 @@
+"""
+Compares two runs of the benchmarks.
+
+Usage: benchmarks.compare [--threshold=<pct>] <baseline> <current>
+
+Run as `python -m benchmarks.compare` from the top of the tree. Results are
+matched by benchmark and node shape, and the fastest repetition of each is
+compared, being the least disturbed by the rest of the machine. Exits with
+a failure if any benchmark got slower by more than the threshold, or failed.
+
+Options:
+ --threshold=<pct>  Slowdown in percent counted as a regression
+                    (defaults to 10)
+ -h, --help         Print help
+"""
+import json
+import sys
+
+import docopt
+
+
+def load(fname):
+    """ Dict of (benchmark, shape) to the last result for it in `fname`. """
+    results = {}
+    with open(fname) as stream:
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            key = (record["benchmark"],
+                   json.dumps(record["shape"], sort_keys=True))
+            results[key] = record
+    return results
+
+
+def _shape(shape):
+    shape = json.loads(shape)
+    return "{devices}x{labels}x{parts}x{images}x{size}".format(**shape)
+
+
+def compare(baseline, current, threshold=10.0):
+    """ Prints the change of every benchmark in both runs and returns the
+        names of those which regressed. """
+    regressed = []
+    print("{:28} {:>18} {:>10} {:>10} {:>8}".format(
+        "benchmark", "shape", "baseline", "current", "change"))
+    for key in sorted(set(baseline) & set(current)):
+        before = baseline[key]["min"]
+        after = current[key]["min"]
+        change = (after - before) * 100.0 / before if before else 0.0
+        flag = ""
+        if not current[key]["ok"]:
+            flag = "FAILED"
+        elif change > threshold:
+            flag = "SLOWER"
+        elif change < -threshold:
+            flag = "faster"
+        if flag in ("FAILED", "SLOWER"):
+            regressed.append(key[0])
+        print("{:28} {:>18} {:>10.4f} {:>10.4f} {:>+7.1f}% {}".format(
+            key[0], _shape(key[1]), before, after, change, flag).rstrip())
+
+    for key in sorted(set(baseline) ^ set(current)):
+        print("{:28} {:>18} only in {}".format(
+            key[0], _shape(key[1]),
+            "baseline" if key in baseline else "current"))
+    return regressed
+
+
+def main(argv=None):
+    """ Compares the runs named on the command line. """
+    args = docopt.docopt(__doc__, argv=argv)
+    threshold = float(args['--threshold'] or 10)
+    regressed = compare(load(args['<baseline>']), load(args['<current>']),
+                        threshold)
+    if regressed:
+        sys.stderr.write("Regressed: {}\n".format(", ".join(regressed)))
+    return not regressed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,139 @@
+"""
+Synthetic storage nodes for the benchmarks.
+
+A node is laid out exactly as the camera and the bundler leave one:
+`<node>/<device>/<label>.<device>.p<N>.tar.gz` archives with their index
+sidecars and `.done` markers, and loose `image%06d.jpg` frames in
+`<node>/<device>/<label>/` still waiting to be zipped. Frames are filled
+with random bytes, so they compress no better than real JPEGs, and are
+stamped one interval apart so time based selections see a realistic span.
+"""
+from datetime import date, timedelta
+import os
+
+import yaml
+
+from photopi.bundle.archive import DEFAULT_FORMAT
+from photopi.bundle.module import BundleModule
+from photopi.bundle.spec import BundleSpec
+
+FIRST_LABEL = date(2026, 1, 1)
+FRAME_INTERVAL = 5
+_POOL_SIZE = 4 * 1024 * 1024
+
+
+class Shape:
+    """ The size of a synthetic node: `devices` x `labels` bundles, each of
+        `parts` parts of `images` frames of `size` bytes. """
+
+    def __init__(self, devices=2, labels=3, parts=4, images=100, size=65536):
+        self.devices = int(devices)
+        self.labels = int(labels)
+        self.parts = int(parts)
+        self.images = int(images)
+        self.size = int(size)
+
+    def __str__(self):
+        return "{}x{}x{}x{}x{}".format(self.devices, self.labels, self.parts,
+                                       self.images, self.size)
+
+    def params(self):
+        """ The shape as a dict, for reporting. """
+        return {"devices": self.devices, "labels": self.labels,
+                "parts": self.parts, "images": self.images, "size": self.size}
+
+    def device_names(self):
+        """ Names of the devices. """
+        return ["pp{}".format(num + 1) for num in range(self.devices)]
+
+    def label_names(self):
+        """ Names of the labels, one day apart. """
+        return [(FIRST_LABEL + timedelta(days=num)).isoformat()
+                for num in range(self.labels)]
+
+    def bundles(self):
+        """ (device, label) of every bundle. """
+        return [(device, label) for device in self.device_names()
+                for label in self.label_names()]
+
+
+class FrameWriter:
+    """ Writes frames of `size` bytes cut from one pool of random data. """
+
+    def __init__(self, size):
+        self._size = size
+        self._pool = os.urandom(max(_POOL_SIZE, size * 2))
+        self._offset = 0
+
+    def frame(self):
+        """ Bytes of the next frame: a JPEG envelope around random data. """
+        body = max(0, self._size - 4)
+        if self._offset + body > len(self._pool):
+            self._offset = 0
+        data = self._pool[self._offset:self._offset + body]
+        # Step by an odd amount so consecutive frames never repeat.
+        self._offset += 4099
+        return b"\xff\xd8" + data + b"\xff\xd9"
+
+    def write(self, dirname, number, mtime):
+        """ Writes frame `number` into `dirname` stamped with `mtime`. """
+        fname = os.path.join(dirname, "image{:06d}.jpg".format(number))
+        with open(fname, "wb") as stream:
+            stream.write(self.frame())
+        os.utime(fname, (mtime, mtime))
+        return fname
+
+
+def _label_start(label):
+    return int((date.fromisoformat(label) - date(1970, 1, 1)).total_seconds())
+
+
+def write_loose(writer, path, device, label, first, count):
+    """ Writes `count` loose frames numbered from `first` into bundle
+        `device`/`label` of the node at `path`. """
+    dirname = os.path.join(path, device, label)
+    os.makedirs(dirname, exist_ok=True)
+    start = _label_start(label)
+    for number in range(first, first + count):
+        writer.write(dirname, number, start + number * FRAME_INTERVAL)
+
+
+def make_node(path, shape, zipped=True, fmt=DEFAULT_FORMAT):
+    """ Fills the node at `path` with every bundle of `shape`. With `zipped`
+        each bundle is archived into its parts with the real bundler;
+        otherwise the frames are left loose. """
+    writer = FrameWriter(shape.size)
+    bundler = BundleModule()
+    for device, label in shape.bundles():
+        if not zipped:
+            write_loose(writer, path, device, label, 0,
+                        shape.parts * shape.images)
+            continue
+        spec = BundleSpec(device, label, path)
+        for partnum in range(1, shape.parts + 1):
+            part = spec.part_spec(partnum)
+            dirname = part.dirname()
+            os.makedirs(dirname)
+            start = _label_start(label)
+            for number in range((partnum - 1) * shape.images,
+                                partnum * shape.images):
+                writer.write(dirname, number, start + number * FRAME_INTERVAL)
+            bundler._zip_files(part.archive_filename(fmt), part, fmt)
+            os.rmdir(dirname)
+    return path
+
+
+def write_config(root, device="pp1", **settings):
+    """ Writes a config for a workspace in `root`, with the `local`, `store`
+        and `swap` nodes below it, and returns its path. """
+    nodes = {name: os.path.join(root, name)
+             for name in ("local", "store", "swap")}
+    for path in nodes.values():
+        os.makedirs(path, exist_ok=True)
+    config = {"device_id": device, "storage_nodes": nodes,
+              "catalog_dir": os.path.join(root, "cache")}
+    config.update(settings)
+    fname = os.path.join(root, "photopi.yaml")
+    with open(fname, "w") as stream:
+        yaml.safe_dump(config, stream, default_flow_style=False)
+    return fname
@@ -0,0 +1,345 @@
+"""
+Hardware-free benchmarks of the bundle and timelapse hot paths.
+
+Usage: benchmarks.run [options] [<benchmark>...]
+       benchmarks.run --list
+
+Run as `python -m benchmarks.run` from the top of the tree. Every benchmark runs against synthetic storage nodes of devices x labels x
+parts x images frames of a given size, with stand-ins for rsync, mencoder
+and raspistill from benchmarks/fakebin on the PATH. One JSON line per
+benchmark is written with the time of every repetition; compare two runs
+with `python -m benchmarks.compare`.
+
+Options:
+ --devices=<n>      Devices per node (defaults to 2)
+ --labels=<n>       Labels per device (defaults to 3)
+ --parts=<n>        Parts per bundle (defaults to 4)
+ --images=<n>       Images per part (defaults to 100)
+ --size=<bytes>     Size of every image (defaults to 65536)
+ --repeat=<n>       Repetitions of each benchmark (defaults to 3)
+ --output=<file>    Append the results to a file instead of printing them
+ --tmpdir=<dir>     Directory for the synthetic nodes (defaults to $TMPDIR)
+ --keep             Keep the synthetic nodes after the run
+ --real-tools       Use the installed rsync, mencoder and raspistill
+ --list             List the benchmarks
+ -h, --help         Print help
+ -v                 Include verbose logging
+"""
+from datetime import datetime
+import ast
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import docopt
+
+from photopi.bundle.module import BundleModule
+from photopi.bundle.spec import BundleSpec
+from photopi.camera.capture import CaptureService, RaspistillBackend
+from photopi.camera.module import CameraModule
+from photopi.core.config import Configuration
+from photopi.timelapse.module import TimelapseModule
+
+from benchmarks.nodes import Shape, make_node, write_config
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+FAKEBIN = os.path.join(_HERE, "fakebin")
+PHOTOPI = os.path.join(os.path.dirname(_HERE), "bin", "photopi")
+
+
+def cli_usage():
+    """ The docopt usage of the photopi command. """
+    with open(PHOTOPI) as stream:
+        return ast.get_docstring(ast.parse(stream.read()))
+
+
+class Workspace:
+    """ A config and its `local`, `store` and `swap` nodes below `root`,
+        with the synthetic nodes named in `nodes` copied in from their
+        templates. """
+
+    def __init__(self, root, templates, nodes, **settings):
+        self.root = root
+        for name, kind in nodes.items():
+            shutil.copytree(templates.path(kind), os.path.join(root, name))
+        self.config = Configuration(
+            config_path=write_config(root, **settings))
+
+    def node(self, name):
+        """ Path of node `name`. """
+        return self.config.storage_node(name)
+
+    @staticmethod
+    def args(argv):
+        """ Parsed photopi command line `argv`. """
+        return docopt.docopt(cli_usage(), argv=argv)
+
+
+class Templates:
+    """ Synthetic nodes of `shape`, generated once below `root` and copied
+        into every workspace which needs one. """
+
+    def __init__(self, root, shape):
+        self._root = root
+        self._shape = shape
+
+    def path(self, kind):
+        """ Path of the `zipped` or `loose` template node. """
+        path = os.path.join(self._root, kind)
+        if not os.path.isdir(path):
+            log = logging.getLogger(__name__)
+            started = time.perf_counter()
+            make_node(path + ".tmp", self._shape, zipped=kind == "zipped")
+            os.rename(path + ".tmp", path)
+            log.info("Generated %s node %s in %.1fs", kind, self._shape,
+                     time.perf_counter() - started)
+        return path
+
+
+def _labels(shape):
+    labels = shape.label_names()
+    return "{}:{}".format(labels[0], labels[-1])
+
+
+# Each benchmark sets up a workspace, untimed, and returns the operation to
+# time, which returns True on success.
+
+def bench_ls(work, shape):
+    """ filter_bundles over every node, listing the directories. """
+    workspace = work({"store": "zipped"}, catalog=False)
+    args = workspace.args(["bundle", "ls"])
+    return lambda: bool(BundleModule().filter_bundles(args, workspace.config))
+
+
+def bench_ls_catalog(work, shape):
+    """ filter_bundles over every node, answered by a warm catalog. """
+    workspace = work({"store": "zipped"})
+    args = workspace.args(["bundle", "ls"])
+    BundleModule().filter_bundles(args, workspace.config)
+    return lambda: bool(BundleModule().filter_bundles(args, workspace.config))
+
+
+def bench_last_image_number(work, shape):
+    """ BundleSpec.last_image_number of every bundle. """
+    workspace = work({"store": "zipped"}, catalog=False)
+    path = workspace.node("store")
+
+    def _run():
+        return all(BundleSpec(device, label, path).last_image_number() >= 0
+                   for device, label in shape.bundles())
+    return _run
+
+
+def bench_last_image_number_snapshot(work, shape):
+    """ last_image_number of every bundle from a snapshot of it. """
+    workspace = work({"store": "zipped"}, catalog=False)
+    path = workspace.node("store")
+
+    def _run():
+        return all(BundleSpec(device, label, path).snapshot()
+                   .last_image_number() >= 0
+                   for device, label in shape.bundles())
+    return _run
+
+
+def bench_zip(work, shape):
+    """ bundle zip of one part from loose images. """
+    workspace = work({"local": "loose"})
+    device, label = shape.bundles()[0]
+    args = workspace.args(["bundle", "zip", "--device", device,
+                           "--label", label,
+                           "--maxfilecount", str(shape.images)])
+    return lambda: BundleModule().main(args, workspace.config)
+
+
+def bench_zip_orphans(work, shape):
+    """ bundle zip orphans of every loose image on a node. """
+    workspace = work({"local": "loose"})
+    args = workspace.args(["bundle", "zip", "orphans", "--node", "local",
+                           "--maxfilecount", str(shape.images)])
+    return lambda: BundleModule().main(args, workspace.config)
+
+
+def bench_expand(work, shape):
+    """ bundle expand of one bundle into swap. """
+    workspace = work({"store": "zipped"})
+    device, label = shape.bundles()[0]
+    args = workspace.args(["bundle", "expand", "--node", "store",
+                           "--device", device, "--label", label])
+    return lambda: BundleModule().main(args, workspace.config)
+
+
+def bench_fetch(work, shape):
+    """ bundle fetch of a whole node with the native transfer backend. """
+    workspace = work({"store": "zipped"}, transfer_backend="native")
+    args = workspace.args(["bundle", "fetch", "--src", "store", "--done"])
+    return lambda: BundleModule().main(args, workspace.config)
+
+
+def bench_fetch_rsync(work, shape):
+    """ bundle fetch of a whole node through rsync. """
+    workspace = work({"store": "zipped"}, transfer_backend="rsync")
+    args = workspace.args(["bundle", "fetch", "--src", "store", "--done",
+                           "--streams", "2"])
+    return lambda: BundleModule().main(args, workspace.config)
+
+
+def bench_timelapse_stream(work, shape):
+    """ timelapse select --stream of every label of one device. """
+    workspace = work({"store": "zipped"})
+    device, _ = shape.bundles()[0]
+    args = workspace.args(["timelapse", "select", "--stream",
+                           "--node", "store", "--device", device,
+                           "--labels", _labels(shape), "--dest", "swap",
+                           "--name", "bench"])
+    return lambda: TimelapseModule().main(args, workspace.config)
+
+
+def bench_camera_continuous(work, shape):
+    """ camera continuous onto a bundle with parts, capturing one part. """
+    workspace = work({"local": "zipped"})
+    device, label = shape.bundles()[0]
+    args = workspace.args(["camera", "continuous", "--device", device,
+                           "--label", label, "--interval", "1",
+                           "--timeout", str(shape.images)])
+    return lambda: CameraModule().main(args, workspace.config) is not False
+
+
+def bench_camera_capture(work, shape):
+    """ photos taken one by one with the warm capture service. """
+    workspace = work({})
+    service = CaptureService(RaspistillBackend(workspace.node("swap")))
+    service.start()
+
+    def _run():
+        try:
+            return all(service.capture() for _ in range(shape.images))
+        finally:
+            service.close()
+    return _run
+
+
+BENCHMARKS = {
+    "ls": bench_ls,
+    "ls_catalog": bench_ls_catalog,
+    "last_image_number": bench_last_image_number,
+    "last_image_number_snapshot": bench_last_image_number_snapshot,
+    "zip": bench_zip,
+    "zip_orphans": bench_zip_orphans,
+    "expand": bench_expand,
+    "fetch": bench_fetch,
+    "fetch_rsync": bench_fetch_rsync,
+    "timelapse_stream": bench_timelapse_stream,
+    "camera_continuous": bench_camera_continuous,
+    "camera_capture": bench_camera_capture,
+}
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=_HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(name, shape, templates, scratch, repeat):
+    """ Runs benchmark `name` `repeat` times, each in a fresh workspace, and
+        returns its result record. """
+    log = logging.getLogger(__name__)
+    times = []
+    ok = True
+    for rep in range(repeat):
+        root = os.path.join(scratch, "{}-{}".format(name, rep))
+
+        def _work(nodes, **settings):
+            return Workspace(root, templates, nodes, **settings)
+
+        try:
+            operation = BENCHMARKS[name](_work, shape)
+            started = time.perf_counter()
+            result = operation()
+            times.append(time.perf_counter() - started)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        if not result:
+            log.error("%s failed on repetition %d", name, rep + 1)
+            ok = False
+        log.info("%s: %.4fs", name, times[-1])
+
+    return {
+        "benchmark": name,
+        "shape": shape.params(),
+        "repeat": repeat,
+        "ok": ok,
+        "seconds": [round(secs, 6) for secs in times],
+        "min": round(min(times), 6),
+        "median": round(statistics.median(times), 6),
+        "mean": round(statistics.mean(times), 6),
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def main(argv=None):
+    """ Runs the selected benchmarks and writes their results. """
+    args = docopt.docopt(__doc__, argv=argv)
+    logging.basicConfig(format="%(levelname)s:%(name)s:%(message)s")
+    logging.getLogger().setLevel(logging.WARN)
+    logging.getLogger(__name__).setLevel(
+        logging.INFO if args['-v'] else logging.WARN)
+
+    if args['--list']:
+        for name, bench in BENCHMARKS.items():
+            print("{:28} {}".format(name, bench.__doc__.strip()))
+        return True
+
+    names = args['<benchmark>'] or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.stderr.write("Unknown benchmarks: {}\n".format(", ".join(unknown)))
+        return False
+
+    shape = Shape(devices=args['--devices'] or 2, labels=args['--labels'] or 3,
+                  parts=args['--parts'] or 4, images=args['--images'] or 100,
+                  size=args['--size'] or 65536)
+    repeat = max(1, int(args['--repeat'] or 3))
+    if not args['--real-tools']:
+        os.environ["PATH"] = FAKEBIN + os.pathsep + os.environ.get("PATH", "")
+
+    scratch = tempfile.mkdtemp(prefix="photopi-bench-", dir=args['--tmpdir'])
+    templates = Templates(os.path.join(scratch, "templates"), shape)
+    if args['--output']:
+        output = open(args['--output'], "a")
+    else:
+        # Keep stdout for the results; the tools print to stderr instead.
+        sys.stdout.flush()
+        output = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    ok = True
+    try:
+        for name in names:
+            record = run_benchmark(name, shape, templates, scratch, repeat)
+            ok = ok and record["ok"]
+            output.write(json.dumps(record, sort_keys=True) + "\n")
+            output.flush()
+    finally:
+        output.close()
+        if args['--keep']:
+            logging.getLogger(__name__).warning("Kept %s", scratch)
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,249 @@
+"""
+Persistent catalog of the bundles on a storage node.
+
+The catalog keeps the directory entries of a node (devices, labels, part
+directories, archives, done markers and loose images) in a SQLite database on
+local disk. Every query first stats the directories it reads from and only
+rescans those whose mtime changed, so answering `bundle ls` costs one stat per
+device instead of a walk of the whole node.
+
+Like git's index, a directory modified too close to its last scan is
+considered racy and rescanned, since a coarse mtime could otherwise hide an
+entry created in the same tick.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from photopi.bundle.archive import is_archive
+from photopi.bundle.spec import (BundleSort, IMAGE_FILE_PATTERN,
+                                 IMAGE_PATTERN, PARTDIR_PATTERN)
+
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL,
+    scanned INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    isdir INTEGER NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    payload TEXT,
+    PRIMARY KEY (dir, name)
+);
+"""
+
+_CATALOGS = {}
+_CATALOGS_LOCK = threading.Lock()
+
+
+def open_catalog(config, path):
+    """ The catalog for the storage node at `path`, or None when catalogs are
+        disabled with `catalog: false` in the config. Catalogs are stored in
+        `catalog_dir` (default ~/.cache/photopi) and shared per process. """
+    if config['catalog'] is False or not path:
+        return None
+
+    catalog_dir = config['catalog_dir'] or os.path.join(
+        os.path.expanduser("~"), ".cache", "photopi")
+    key = (os.getpid(), os.path.abspath(path))
+    with _CATALOGS_LOCK:
+        if key not in _CATALOGS:
+            os.makedirs(catalog_dir, exist_ok=True)
+            digest = hashlib.sha1(key[1].encode()).hexdigest()[:16]
+            _CATALOGS[key] = BundleCatalog(
+                key[1], os.path.join(catalog_dir,
+                                     "catalog-{}.sqlite".format(digest)))
+        return _CATALOGS[key]
+
+
+class BundleCatalog:
+    """ Catalog of the bundles below `root`, stored in database `dbpath`. """
+
+    def __init__(self, root, dbpath):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._root = root
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(dbpath, timeout=30,
+                                   check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def __str__(self):
+        return "BundleCatalog({})".format(self._root)
+
+    @property
+    def root(self):
+        """ Path of the storage node this catalog describes. """
+        return self._root
+
+    def _scan_entry(self, entry):
+        isdir = entry.is_dir()
+        if isdir or IMAGE_PATTERN.match(entry.name):
+            # Loose images are only ever listed, so skip their stat.
+            return (int(isdir), None, None)
+        stat = entry.stat()
+        return (0, stat.st_size, stat.st_mtime_ns)
+
+    def _drop(self, relpath):
+        self._db.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ?",
+                         (relpath, relpath + "/%"))
+        self._db.execute("DELETE FROM files WHERE dir = ? OR dir LIKE ?",
+                         (relpath, relpath + "/%"))
+
+    def refresh(self, relpath=""):
+        """ Rescans `relpath` (relative to the root) if it changed since it
+            was last scanned. Returns False when it is not a directory. """
+        with self._lock:
+            try:
+                return self._refresh(relpath)
+            finally:
+                self._db.commit()
+
+    def _refresh(self, relpath):
+        fullpath = os.path.join(self._root, relpath)
+        try:
+            mtime = os.stat(fullpath).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            self._drop(relpath)
+            return False
+
+        row = self._db.execute("SELECT mtime, scanned FROM dirs WHERE path = ?",
+                               (relpath,)).fetchone()
+        if row and row[0] == mtime and mtime < row[1] - RACY_NS:
+            return True
+
+        self._log.debug("Scanning %s", fullpath)
+        scanned = time.time_ns()
+        current = {}
+        with os.scandir(fullpath) as entries:
+            for entry in entries:
+                current[entry.name] = self._scan_entry(entry)
+
+        known = {name: (isdir, size, mtime)
+                 for name, isdir, size, mtime in self._db.execute(
+                     "SELECT name, isdir, size, mtime FROM files "
+                     "WHERE dir = ?", (relpath,))}
+
+        for name, (isdir, _, _) in known.items():
+            if name not in current:
+                self._db.execute(
+                    "DELETE FROM files WHERE dir = ? AND name = ?",
+                    (relpath, name))
+                if isdir:
+                    self._drop(os.path.join(relpath, name))
+
+        self._db.executemany(
+            "INSERT OR REPLACE INTO files (dir, name, isdir, size, mtime) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(relpath, name) + values for name, values in current.items()
+             if known.get(name) != values])
+        self._db.execute(
+            "INSERT OR REPLACE INTO dirs (path, mtime, scanned) "
+            "VALUES (?, ?, ?)", (relpath, mtime, scanned))
+        return True
+
+    def _entries(self, relpath, isdir=None):
+        with self._lock:
+            if not self.refresh(relpath):
+                return []
+            query = "SELECT name FROM files WHERE dir = ?"
+            params = (relpath,)
+            if isdir is not None:
+                query += " AND isdir = ?"
+                params += (int(isdir),)
+            return [row[0] for row in self._db.execute(query, params)]
+
+    def files(self, relpath):
+        """ Dict of name to size of the files in `relpath` (relative to the
+            root). Loose images are not sized and map to None. """
+        with self._lock:
+            if not self.refresh(relpath):
+                return {}
+            return dict(self._db.execute(
+                "SELECT name, size FROM files WHERE dir = ? AND isdir = 0",
+                (relpath,)))
+
+    def devices(self):
+        """ Sorted list of device directories on this node. """
+        return sorted(self._entries("", isdir=True))
+
+    def labels(self, device):
+        """ Sorted list of label directories for `device`. """
+        return sorted(self._entries(device, isdir=True))
+
+    def bundles(self, device_lim=None, label_lim=None):
+        """ Dict of device to the labels which have archives. """
+        bundles = {}
+        for device in self.devices():
+            if device_lim and device != device_lim:
+                continue
+            labels = set()
+            for name in filter(is_archive, self._entries(device, isdir=False)):
+                label = BundleSort.get_label(name)
+                if not label_lim or label == label_lim:
+                    labels.add(label)
+            bundles[device] = sorted(labels)
+        return bundles
+
+    def archives(self, device, label):
+        """ Paths of the archives for the bundle `device`/`label`. """
+        prefix = "{}.".format(label)
+        return [os.path.join(self._root, device, name)
+                for name in self._entries(device, isdir=False)
+                if name.startswith(prefix) and is_archive(name)]
+
+    def partdirs(self, device, label):
+        """ Paths of the part directories for the bundle `device`/`label`. """
+        return [os.path.join(self._root, device, label, name, "")
+                for name in self._entries(os.path.join(device, label),
+                                          isdir=True)
+                if PARTDIR_PATTERN.match(name)]
+
+    def images(self, device, label, part=None):
+        """ Paths of the loose images of a bundle or one of its parts. """
+        relpath = os.path.join(device, label)
+        if part is not None:
+            relpath = os.path.join(relpath, "p{}".format(part))
+        return [os.path.join(self._root, relpath, name)
+                for name in self._entries(relpath, isdir=False)
+                if IMAGE_FILE_PATTERN.match(name)]
+
+    def is_done(self, device, label, partnum):
+        """ Indicates whether a part has a done marker. """
+        name = ".{}.{}.p{}.done".format(label, device, partnum)
+        with self._lock:
+            self.refresh(device)
+            return self._db.execute(
+                "SELECT 1 FROM files WHERE dir = ? AND name = ? AND isdir = 0",
+                (device, name)).fetchone() is not None
+
+    def done_number(self, device, label, partnum):
+        """ Last image number recorded by the done marker of a part, or None
+            if the part is not done. """
+        name = ".{}.{}.p{}.done".format(label, device, partnum)
+        with self._lock:
+            self.refresh(device)
+            row = self._db.execute(
+                "SELECT payload FROM files WHERE dir = ? AND name = ?",
+                (device, name)).fetchone()
+            if row is None:
+                return None
+            if row[0] is None:
+                with open(os.path.join(self._root, device, name), "r") as done:
+                    payload = done.read().strip()
+                self._db.execute(
+                    "UPDATE files SET payload = ? WHERE dir = ? AND name = ?",
+                    (payload, device, name))
+                self._db.commit()
+                return int(payload)
+            return int(row[0])
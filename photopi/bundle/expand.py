@@ -0,0 +1,163 @@
+"""
+Parallel extraction of bundle archives.
+
+Each archive is read by a worker process which streams its JPEG members
+straight to their final path in the expand destination, so no temporary
+directory or second move pass is needed. Files are created exclusively, which
+makes the first archive to produce a filename the winner whenever several
+workers race for it. Archives which changed since they were last expanded
+are extracted with `overwrite`, replacing their earlier frames atomically.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import logging
+import os
+
+from photopi.bundle.archive import (DECOMPRESS_ERRORS, ArchiveFormatError,
+                                    open_reader)
+from photopi.bundle.spec import IMAGE_PATTERN
+from photopi.core.compress import default_jobs
+
+CHUNKSIZE = 1024 * 1024
+
+
+class ExtractResult:
+    """ Summary of the members extracted from one archive. """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.extracted = []
+        self.collisions = []
+        self.duplicates = 0
+        self.empty = 0
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.error = None
+
+    def __str__(self):
+        return str(self.__dict__)
+
+    def add_frame(self, filename):
+        """ Widens the frame range of this archive to include `filename`. """
+        self.count += 1
+        match = IMAGE_PATTERN.search(filename)
+        if match is None:
+            return
+        num = int(match.group(1))
+        if self.first is None or num < self.first:
+            self.first = num
+        if self.last is None or num > self.last:
+            self.last = num
+
+
+def _write_member(tar, member, dest_fname, overwrite=False):
+    """ Streams `member` into a new file at `dest_fname`. """
+    if overwrite:
+        outname = "{}.tmp{}".format(dest_fname, os.getpid())
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    else:
+        outname = dest_fname
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+
+    fdesc = os.open(outname, flags, 0o644)
+    try:
+        with os.fdopen(fdesc, "wb") as out:
+            src = tar.extractfile(member)
+            while True:
+                chunk = src.read(CHUNKSIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+        os.utime(outname, (member.mtime, member.mtime))
+        if overwrite:
+            os.replace(outname, dest_fname)
+    except BaseException:
+        os.remove(outname)
+        raise
+
+
+def extract_archive(fname, dest, overwrite=False):
+    """ Extracts the JPEG members of archive `fname` into `dest`. Runs in a
+        worker process, so it reports problems in the result rather than
+        raising. """
+    result = ExtractResult(fname)
+    seen = set()
+    try:
+        with open_reader(fname) as tar:
+            for member in tar:
+                basename = os.path.basename(member.name)
+                if not member.isfile() or not fnmatch.fnmatch(basename,
+                                                              "*.jpg"):
+                    continue
+                if member.size == 0:
+                    result.empty += 1
+                    continue
+                if basename in seen:
+                    result.duplicates += 1
+                    continue
+                seen.add(basename)
+                result.add_frame(basename)
+
+                try:
+                    _write_member(tar, member, os.path.join(dest, basename),
+                                  overwrite)
+                except FileExistsError:
+                    result.collisions.append(basename)
+                    continue
+                result.extracted.append(basename)
+    except IOError as err:
+        result.error = "I/O error({}): {}".format(err.errno, err.strerror)
+    except EOFError as err:
+        result.error = "EOF error: {}".format(err)
+    except (ArchiveFormatError,) + DECOMPRESS_ERRORS as err:
+        result.error = "error: {}".format(err)
+    return result
+
+
+def extract_archives(archives, dest, jobs=None, overwrite=frozenset()):
+    """ Extracts `archives` into `dest` on a pool of `jobs` processes and
+        yields an :class:`ExtractResult` for each as it completes. Members of
+        the archives in `overwrite` replace existing files. """
+    replace = [fname in overwrite for fname in archives]
+    jobs = min(default_jobs(jobs), len(archives))
+    if jobs <= 1:
+        for fname, over in zip(archives, replace):
+            yield extract_archive(fname, dest, over)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for result in pool.map(extract_archive, archives,
+                               [dest] * len(archives), replace):
+            yield result
+
+
+class ExpandSummary:
+    """ Accumulates :class:`ExtractResult` objects for a whole expand. """
+
+    def __init__(self, present):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._present = present
+        self.extracted = set()
+        self.duplicates = 0
+        self.existing = 0
+        self.empty = 0
+        self.errors = 0
+
+    def add(self, result):
+        """ Folds `result` into the summary and logs any problems. """
+        if result.error:
+            self.errors += 1
+            self._log.error("%s: %s", result.archive, result.error)
+
+        self.extracted.update(result.extracted)
+        self.duplicates += result.duplicates
+        self.empty += result.empty
+        for filename in result.collisions:
+            if filename in self._present:
+                self._log.debug("File %s exists, skipping", filename)
+                self.existing += 1
+            else:
+                self._log.debug("duplicate filename: %s", filename)
+                self.duplicates += 1
@@ -0,0 +1,282 @@
+"""
+Member index sidecars for bundle archives.
+
+When a part is zipped, an index is written next to its archive as
+`.<label>.<device>.p<N>.idx`. It lists every member with its image number,
+the offset of its data in the uncompressed tar stream, its size and mtime,
+together with the access points where decompression can start. A single
+frame is then read by seeking to the nearest access point before it instead
+of decompressing the whole archive.
+
+Archives written before indexes existed are indexed on demand by reading
+them once; their only access point is the start of the archive.
+"""
+import bisect
+import contextlib
+import json
+import logging
+import os
+
+from photopi.bundle.archive import open_decompressed, open_reader, sniff_format
+from photopi.bundle.spec import IMAGE_PATTERN, BundleSort, BundleSpecPart
+
+INDEX_VERSION = 1
+
+_READSIZE = 1024 * 1024
+
+
+def index_filename(archive):
+    """ Filename of the index sidecar for `archive`. """
+    return os.path.join(os.path.dirname(archive), ".{}.idx".format(
+        BundleSpecPart.filebase(archive)))
+
+
+def _image_number(name):
+    match = IMAGE_PATTERN.search(os.path.basename(name))
+    return int(match.group(1)) if match else None
+
+
+class IndexMember:
+    """ One file stored in an indexed archive. """
+
+    def __init__(self, number, name, offset, size, mtime):
+        self.number = number
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.mtime = mtime
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
+class ArchiveIndex:
+    """ The members of an archive and where to find their data. """
+
+    def __init__(self, archive, fmt, members, access_points):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self.archive = archive
+        self.format = fmt
+        self.members = sorted(
+            members, key=lambda m: (m.number is None, m.number or 0, m.name))
+        self.access_points = sorted(access_points)
+        self._bynumber = {m.number: m for m in self.members
+                          if m.number is not None}
+
+    @staticmethod
+    def FromWriter(archive, writer):
+        """ Index of `archive` from the :class:`ArchiveWriter` that wrote it. """
+        members = [IndexMember(_image_number(name), name, offset, size, mtime)
+                   for name, offset, size, mtime in writer.members]
+        return ArchiveIndex(archive, writer.format, members,
+                            writer.access_points)
+
+    @staticmethod
+    def Build(archive):
+        """ Index of `archive`, built by reading it from start to end. """
+        members = []
+        with open_reader(archive) as tar:
+            for member in tar:
+                if member.isfile():
+                    members.append(IndexMember(
+                        _image_number(member.name),
+                        os.path.basename(member.name), member.offset_data,
+                        member.size, int(member.mtime)))
+        return ArchiveIndex(archive, sniff_format(archive), members, [(0, 0)])
+
+    @staticmethod
+    def Load(archive):
+        """ Index of `archive` from its sidecar, or None if the sidecar is
+            missing or describes a different version of the archive. """
+        try:
+            with open(index_filename(archive), "r") as stream:
+                data = json.load(stream)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if (data.get("version") != INDEX_VERSION or
+                data.get("size") != os.stat(archive).st_size):
+            return None
+        members = [IndexMember(*member) for member in data["members"]]
+        return ArchiveIndex(archive, data["format"], members,
+                            [tuple(point) for point in data["points"]])
+
+    @staticmethod
+    def ForArchive(archive, save=True):
+        """ Index of `archive`, building (and saving) it when the sidecar is
+            missing or stale. """
+        index = ArchiveIndex.Load(archive)
+        if index is None:
+            index = ArchiveIndex.Build(archive)
+            if save:
+                try:
+                    index.save()
+                except OSError as err:
+                    index._log.warning("Unable to save index for %s: %s",
+                                       archive, err)
+        return index
+
+    def save(self, fname=None):
+        """ Atomically writes the index sidecar. """
+        fname = fname or index_filename(self.archive)
+        data = {
+            "version": INDEX_VERSION,
+            "archive": os.path.basename(self.archive),
+            "format": self.format,
+            "size": os.stat(self.archive).st_size,
+            "points": self.access_points,
+            "members": [[m.number, m.name, m.offset, m.size, m.mtime]
+                        for m in self.members],
+        }
+        tmpname = "{}.tmp{}".format(fname, os.getpid())
+        with open(tmpname, "w") as stream:
+            json.dump(data, stream, separators=(",", ":"))
+        os.replace(tmpname, fname)
+        return fname
+
+    def frames(self):
+        """ Sorted list of the image numbers in the archive. """
+        return sorted(self._bynumber)
+
+    def member(self, number):
+        """ The member holding image `number`, or None. """
+        return self._bynumber.get(number)
+
+    def _access_point(self, offset):
+        pos = bisect.bisect_right(self.access_points, (offset, float("inf")))
+        return self.access_points[pos - 1] if pos else (0, 0)
+
+    def iter_read(self, members):
+        """ Yields (member, contents) for `members` in archive order. The
+            archive is read forward in one pass, restarting at an access point
+            only when that skips data, so no block is decompressed twice. """
+        members = sorted(members, key=lambda m: m.offset)
+        with contextlib.ExitStack() as stack:
+            stream = None
+            position = None
+            for member in members:
+                uoffset, coffset = self._access_point(member.offset)
+                if stream is None or uoffset > position:
+                    stack.close()
+                    stream = stack.enter_context(open_decompressed(
+                        self.archive, self.format, coffset))
+                    position = uoffset
+                    if self.format == "tar":
+                        stream.seek(member.offset)
+                        position = member.offset
+
+                skip = member.offset - position
+                while skip > 0:
+                    skipped = len(stream.read(min(skip, _READSIZE)))
+                    if not skipped:
+                        raise EOFError("{} ends before {}".format(
+                            self.archive, member.name))
+                    skip -= skipped
+
+                data = stream.read(member.size)
+                if len(data) != member.size:
+                    raise EOFError("{} ends inside {}".format(
+                        self.archive, member.name))
+                position = member.offset + member.size
+                yield member, data
+
+    def read(self, member):
+        """ Contents of `member`, read from the nearest access point. """
+        for _, data in self.iter_read([member]):
+            return data
+
+    def extract(self, member, dest):
+        """ Writes `member` into directory `dest` and returns its path. """
+        fname = os.path.join(dest, member.name)
+        with open(fname, "wb") as stream:
+            stream.write(self.read(member))
+        os.utime(fname, (member.mtime, member.mtime))
+        return fname
+
+
+def frame_ranges(frames):
+    """ Parses a frame selection like `73512`, `100-200` or `1,5,10-20` into
+        a list of (first, last) ranges, where last is None for an open
+        range. None selects every frame and gives None. """
+    if not frames:
+        return None
+
+    ranges = []
+    for item in str(frames).split(","):
+        first, dash, last = item.partition("-")
+        first = int(first) if first else 0
+        if not dash:
+            last = first
+        else:
+            last = int(last) if last else None
+        ranges.append((first, last))
+    return ranges
+
+
+def parse_frames(frames):
+    """ Parses a frame selection like `73512`, `100-200` or `1,5,10-20` into
+        a predicate on image numbers. None selects every frame. """
+    ranges = frame_ranges(frames)
+    if ranges is None:
+        return lambda num: True
+
+    def selected(num):
+        return any(num >= first and (last is None or num <= last)
+                   for first, last in ranges)
+    return selected
+
+
+def archive_spans(spec, archives=None):
+    """ (archive, after, last) for the archives of `spec` in part order, as
+        far as the done markers tell: an archive holds frames numbered above
+        `after`, the last frame of an earlier part, up to `last`, its own
+        last frame. Either is None when unknown. Costs no archive reads. """
+    archives = spec.archives() if archives is None else archives
+    spans = []
+    after = None
+    for archive in sorted(archives, key=BundleSort.partfile_number):
+        try:
+            last = spec.part_spec(
+                BundleSort.partfile_number(archive)).done_number()
+        except (OSError, ValueError):
+            last = None
+        spans.append((archive, after, last))
+        if last is not None:
+            after = last
+    return spans
+
+
+def span_selected(ranges, after, last):
+    """ Whether frame `ranges` (see :func:`frame_ranges`) may hold frames
+        numbered above `after` up to `last`, either of which may be None. """
+    if ranges is None:
+        return True
+    for first, end in ranges:
+        if last is not None and first > last:
+            continue
+        if after is not None and end is not None and end <= after:
+            continue
+        return True
+    return False
+
+
+def bundle_frames(spec, frames=None, part=None):
+    """ Yields (index, member) for the selected frames of `spec` in frame
+        order, optionally limited to one part. Archives whose done markers
+        show they hold none of the frames are skipped unread. """
+    ranges = frame_ranges(frames)
+    selected = parse_frames(frames)
+    if ranges is None:
+        spans = [(archive, None, None) for archive in spec.archives()]
+    else:
+        spans = archive_spans(spec)
+    for archive, after, last in spans:
+        if part is not None and BundleSort.partfile_number(archive) != part:
+            continue
+        if not span_selected(ranges, after, last):
+            continue
+        index = ArchiveIndex.ForArchive(archive)
+        for number in index.frames():
+            if selected(number):
+                yield index, index.member(number)
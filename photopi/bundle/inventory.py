@@ -0,0 +1,193 @@
+"""
+Bundle inventories exchanged with a photopi server.
+
+Listing a storage node mounted over CIFS costs a round trip per directory
+and file, which is slow over Wi-Fi. When the node is served by a photopi
+server (see `node_servers` in the config) the server lists the node from its
+own disk with :func:`node_inventory` and sends it back whole, and a
+:class:`RemoteCatalog` answers every listing from it as a catalog would.
+
+.. code-block::yaml
+    storage_nodes:
+      pp1: /mnt/pp1          # the CIFS mount of pp1's local node
+    node_servers:
+      pp1:
+        host: pp1.local
+        port: 18861          # optional
+        node: local          # the node on the server; defaults to local
+"""
+import os
+import re
+
+from photopi.bundle.archive import is_archive
+from photopi.bundle.spec import LABEL_PATTERN
+
+_DONE_PATTERN = re.compile(r'^\.([^.]+)\.([^.]+)\.p(\d+)\.done$')
+
+
+def _label(name):
+    match = LABEL_PATTERN.search(name)
+    return match.group(1) if match else None
+
+
+def _partname(part):
+    return "" if part is None else str(part)
+
+
+def node_inventory(catalog, device_lim=None, label_lim=None):
+    """
+    Inventory of the bundles on the node of `catalog`, optionally limited to
+    one device and label, as plain data. For each device it holds
+
+    - `files`: name to size of the archives, sidecars and done markers,
+    - `done`: done marker name to the last image number it records, and
+    - `labels`: for each label directory, the names of its `partdirs` and of
+      its loose `images` by part number ("" for the label directory).
+    """
+    inventory = {}
+    for device in catalog.devices():
+        if device_lim and device != device_lim:
+            continue
+        files = {name: size for name, size in catalog.files(device).items()
+                 if _label(name) and (not label_lim or
+                                      _label(name) == label_lim)}
+
+        done = {}
+        for name in files:
+            match = _DONE_PATTERN.match(name)
+            if match and match.group(2) == device:
+                try:
+                    done[name] = catalog.done_number(
+                        device, match.group(1), int(match.group(3)))
+                except ValueError:
+                    done[name] = None
+
+        labels = {}
+        for label in catalog.labels(device):
+            if label_lim and label != label_lim:
+                continue
+            partdirs = [os.path.basename(os.path.dirname(path))
+                        for path in catalog.partdirs(device, label)]
+            images = {}
+            for part in [None] + [int(name[1:]) for name in partdirs]:
+                images[_partname(part)] = [
+                    os.path.basename(path)
+                    for path in catalog.images(device, label, part)]
+            labels[label] = {"partdirs": partdirs, "images": images}
+
+        inventory[device] = {"files": files, "done": done, "labels": labels}
+    return inventory
+
+
+def inventory_diff(inventory, have):
+    """ Paths, relative to the node, of the files in `inventory` missing from
+        `have`, a dict of relative path to size of the files held elsewhere,
+        or held there with another size. """
+    return sorted(os.path.join(device, name)
+                  for device, entry in inventory.items()
+                  for name, size in entry["files"].items()
+                  if have.get(os.path.join(device, name)) != size)
+
+
+class RemoteCatalog:
+    """ Index of the storage node mounted at `root`, answered from an
+        `inventory` its photopi server, `remote`, took instead of by listing
+        the mount. Changes made after the inventory was taken are not
+        seen. """
+
+    def __init__(self, root, inventory, remote=None):
+        self._root = root
+        self._inventory = inventory
+        self.remote = remote
+
+    def __str__(self):
+        return "RemoteCatalog({})".format(self._root)
+
+    @property
+    def root(self):
+        """ Path of the storage node this catalog describes. """
+        return self._root
+
+    def _device(self, device):
+        return self._inventory.get(device) or {
+            "files": {}, "done": {}, "labels": {}}
+
+    def _label(self, device, label):
+        return self._device(device)["labels"].get(label) or {
+            "partdirs": [], "images": {}}
+
+    def devices(self):
+        """ Sorted list of device directories on this node. """
+        return sorted(self._inventory)
+
+    def labels(self, device):
+        """ Sorted list of label directories for `device`. """
+        return sorted(self._device(device)["labels"])
+
+    def bundles(self, device_lim=None, label_lim=None):
+        """ Dict of device to the labels which have archives. """
+        bundles = {}
+        for device in self.devices():
+            if device_lim and device != device_lim:
+                continue
+            bundles[device] = sorted(set(
+                _label(name) for name in self._device(device)["files"]
+                if is_archive(name) and
+                (not label_lim or _label(name) == label_lim)))
+        return bundles
+
+    def archives(self, device, label):
+        """ Paths of the archives for the bundle `device`/`label`. """
+        prefix = "{}.".format(label)
+        return [os.path.join(self._root, device, name)
+                for name in self._device(device)["files"]
+                if name.startswith(prefix) and is_archive(name)]
+
+    def partdirs(self, device, label):
+        """ Paths of the part directories for the bundle `device`/`label`. """
+        return [os.path.join(self._root, device, label, name, "")
+                for name in self._label(device, label)["partdirs"]]
+
+    def images(self, device, label, part=None):
+        """ Paths of the loose images of a bundle or one of its parts. """
+        dirname = os.path.join(self._root, device, label)
+        if part is not None:
+            dirname = os.path.join(dirname, "p{}".format(part))
+        return [os.path.join(dirname, name) for name in
+                self._label(device, label)["images"].get(_partname(part), [])]
+
+    def is_done(self, device, label, partnum):
+        """ Indicates whether a part has a done marker. """
+        name = ".{}.{}.p{}.done".format(label, device, partnum)
+        return name in self._device(device)["files"]
+
+    def done_number(self, device, label, partnum):
+        """ Last image number recorded by the done marker of a part, or None
+            if the part is not done. """
+        name = ".{}.{}.p{}.done".format(label, device, partnum)
+        return self._device(device)["done"].get(name)
+
+    def size(self, fname):
+        """ Size of file `fname` below the node, or None if it is not in the
+            inventory. """
+        device, name = os.path.split(os.path.relpath(fname, self._root))
+        return self._device(device)["files"].get(name)
+
+    def present(self, destpath):
+        """ Paths below the node of the files already at `destpath` with the
+            same size, which need not be sent there again. """
+        have = {}
+        for device in self._inventory:
+            try:
+                with os.scandir(os.path.join(destpath, device)) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            have[os.path.join(device, entry.name)] = \
+                                entry.stat().st_size
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        missing = set(inventory_diff(self._inventory, have))
+        return set(os.path.join(self._root, device, name)
+                   for device, entry in self._inventory.items()
+                   for name in entry["files"]
+                   if os.path.join(device, name) not in missing)
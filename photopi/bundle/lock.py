@@ -0,0 +1,111 @@
+"""
+Locks coordinating the processes which write to a bundle.
+
+Zipping a part moves images into it, archives them and removes them again,
+so two processes zipping the same bundle at once would pick the same part
+number or zip a part twice. Every zip therefore holds inter-process locks
+(`flock`) on lock files in `lock_dir` (default `photopi-locks` in the
+temporary directory):
+
+- the `bundle` lock of a bundle while its loose images are moved into a new
+  part, so parts are numbered one process at a time,
+- the lock of a part (`p<partnum>`) while the part is zipped, and
+- the `capture` lock of a bundle, held by `camera continuous` while it shoots
+  into the bundle. `bundle zip orphans` leaves the loose images of a bundle
+  being captured alone rather than sweep up a photo as it is written.
+
+The kernel drops a lock when the process holding it exits, however it exits,
+so an interrupted zip never leaves a bundle locked. The lock files are on
+local disk; only the processes of one host are coordinated.
+
+.. code-block::yaml
+    lock_dir: /run/lock/photopi
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+
+BUNDLE = "bundle"
+CAPTURE = "capture"
+
+
+def part_name(partnum):
+    """ Name of the lock of part `partnum`. """
+    return "p{}".format(partnum)
+
+
+class BundleLock:
+    """ Lock `name` of the bundle `spec`, with lock files in `lock_dir`.
+        Shared locks may be held by several processes at once, but not
+        alongside an exclusive one. """
+
+    def __init__(self, lock_dir, spec, name, shared=False):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._lock_dir = lock_dir
+        self._spec = spec
+        self._shared = shared
+        # The same node may be reached by several paths.
+        digest = hashlib.sha1(
+            os.path.realpath(spec.base).encode()).hexdigest()[:12]
+        self.fname = os.path.join(lock_dir, "{}.{}.{}.{}.lock".format(
+            digest, spec.device, spec.label, name))
+        self.name = name
+        self._file = None
+
+    def __str__(self):
+        return "{}/{}/{}".format(self._spec.device, self._spec.label,
+                                 self.name)
+
+    @staticmethod
+    def FromConfig(config, spec, name, shared=False):
+        """ Lock `name` of `spec`, in the `lock_dir` of `config`. """
+        lock_dir = config['lock_dir'] or os.path.join(
+            tempfile.gettempdir(), "photopi-locks")
+        return BundleLock(lock_dir, spec, name, shared=shared)
+
+    @property
+    def held(self):
+        """ Whether this lock is held. """
+        return self._file is not None
+
+    def acquire(self, wait=True):
+        """ Takes the lock, waiting for other holders to release it, or
+            without `wait` returns False at once if it is held elsewhere.
+            Every :class:`BundleLock` is a holder of its own, so threads of
+            one process exclude each other too. """
+        if self._file is not None:
+            return True
+        os.makedirs(self._lock_dir, exist_ok=True)
+        stream = open(self.fname, "a")
+        mode = fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(stream, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                stream.close()
+                return False
+            self._log.info("Waiting for %s to be released", self)
+            try:
+                fcntl.flock(stream, mode)
+            except BaseException:
+                stream.close()
+                raise
+        self._file = stream
+        return True
+
+    def release(self):
+        """ Releases the lock, if held. """
+        stream, self._file = self._file, None
+        if stream is not None:
+            fcntl.flock(stream, fcntl.LOCK_UN)
+            stream.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
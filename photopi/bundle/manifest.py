@@ -0,0 +1,82 @@
+"""
+Expansion manifest for bundles in swap storage.
+
+The manifest lives in the expanded bundle directory and records, for every
+archive part that has been expanded there, the size and mtime of the archive
+and the range of frames it produced. `expand` only extracts parts which are
+missing from the manifest or whose archive has changed since. Deleting the
+manifest forces the next expand to extract every part again.
+"""
+import json
+import logging
+import os
+
+MANIFEST_NAME = ".photopi-expand.json"
+
+
+class ExpandManifest:
+    """ Record of the archive parts expanded into `path`. """
+
+    def __init__(self, path):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._fname = os.path.join(path, MANIFEST_NAME)
+        self._parts = self._load()
+
+    def _load(self):
+        try:
+            with open(self._fname, "r") as stream:
+                return json.load(stream).get("parts", {})
+        except FileNotFoundError:
+            return {}
+        except ValueError as err:
+            self._log.warning("Ignoring unreadable manifest %s: %s",
+                              self._fname, err)
+            return {}
+
+    @staticmethod
+    def _key(archive):
+        return os.path.basename(archive)
+
+    @staticmethod
+    def archive_stat(archive):
+        """ The (size, mtime) pair recorded for `archive`. """
+        stat = os.stat(archive)
+        return stat.st_size, stat.st_mtime_ns
+
+    def entry(self, archive):
+        """ The manifest entry for `archive`, or None. """
+        return self._parts.get(self._key(archive))
+
+    def is_current(self, archive, stat=None):
+        """ Indicates whether `archive` was expanded and has not changed. """
+        entry = self.entry(archive)
+        if entry is None:
+            return False
+        size, mtime = stat if stat else self.archive_stat(archive)
+        return entry["size"] == size and entry["mtime"] == mtime
+
+    def record(self, archive, stat, first, last, count):
+        """ Records that `archive` with `stat` produced frames `first` through
+            `last`. """
+        size, mtime = stat
+        self._parts[self._key(archive)] = {
+            "size": size,
+            "mtime": mtime,
+            "first": first,
+            "last": last,
+            "count": count,
+        }
+
+    def frame_ranges(self):
+        """ Dict of archive name to the (first, last) frames it produced. """
+        return {name: (entry["first"], entry["last"])
+                for name, entry in self._parts.items()}
+
+    def save(self):
+        """ Atomically writes the manifest. """
+        tmpname = "{}.tmp{}".format(self._fname, os.getpid())
+        with open(tmpname, "w") as stream:
+            json.dump({"parts": self._parts}, stream, indent=1,
+                      sort_keys=True)
+        os.replace(tmpname, self._fname)
@@ -1,16 +1,44 @@
 """ Defines the Module for working with bundles of images. """
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import fnmatch
 import logging
 import os
 import shutil
-import tarfile
-import zlib
+import signal
+import threading
+import time
 
+from photopi.core import metrics
 from photopi.core.borg import Borg
-from photopi.core.cmd import RsyncCmd
+from photopi.core.compress import default_jobs
+from photopi.core.schedule import shutdown_event
+from photopi.bundle.archive import (DECOMPRESS_ERRORS, DEFAULT_FORMAT,
+                                    ArchiveFormatError, check_format,
+                                    is_archive, open_writer)
+from photopi.bundle.catalog import open_catalog
+from photopi.bundle.expand import ExpandSummary, extract_archives
+from photopi.bundle.index import ArchiveIndex, bundle_frames, index_filename
+from photopi.bundle.inventory import RemoteCatalog
+from photopi.bundle.lock import BUNDLE, CAPTURE, BundleLock, part_name
+from photopi.bundle.manifest import ExpandManifest
 from photopi.bundle.spec import BundleSort, BundleSpec, BundleSpecPart
+from photopi.bundle.swapcache import SwapCache, parse_size
+from photopi.bundle.thumbs import build_thumbs, thumbs_filename
+from photopi.bundle.transfer import TransferPlan
+from photopi.bundle.watch import open_watcher
+
+IDLE_SECS = 900
+SETTLE_SECS = 2
+WAKE_SECS = 60
+ZIP_JOBS = 2
+
+
+def zip_slots(config, requested=None):
+    """ Number of bundles `zip orphans` zips at once: `requested`, else
+        `zip_jobs` from the config, else two. """
+    return max(1, int(requested or config['zip_jobs'] or ZIP_JOBS))
+
 
 class BundleModule(Borg):
     """ Module for working with bundles of images. """
@@ -38,6 +66,12 @@ class BundleModule(Borg):
         if args['expand']:
             return self._expand(config, args)
 
+        if args['frames']:
+            return self._frames(config, args)
+
+        if args['watch']:
+            return self._watch(config, args)
+
     def _fragmentimages(self, spec, fragment, maxfiles):
         self._log.info("Moving image files for zip")
 
@@ -52,27 +86,40 @@ class BundleModule(Borg):
             dest = fragment.dirname()
             os.mkdir(dest)
 
-            for stream in filestomove:
-                shutil.move(stream, dest)
+            with metrics.stage("fragment", device=spec.device,
+                               label=spec.label) as stage:
+                for stream in filestomove:
+                    stage.add(nbytes=os.path.getsize(stream), files=1)
+                    shutil.move(stream, dest)
             return True
 
         return False
 
-    def _zip_files(self, newtarname, frag):
+    def _zip_files(self, newtarname, frag, fmt=DEFAULT_FORMAT, jobs=None):
         files = frag.images()
         if not files:
             return False
 
-        newtar = tarfile.open(newtarname, "w|gz")
-
         self._log.info("Zipping %d images", len(files))
-        for fname in files:
-            basename = os.path.basename(fname)
-            self._log.info("adding %s", basename)
-            newtar.add(fname, basename)
+        labels = {"device": frag.device, "label": frag.label, "format": fmt}
+        with metrics.stage("tar", **labels) as stage:
+            with open_writer(newtarname, fmt, jobs=jobs) as newtar:
+                for fname in files:
+                    basename = os.path.basename(fname)
+                    self._log.info("adding %s", basename)
+                    newtar.add(fname, basename)
+            stage.add(nbytes=sum(member[2] for member in newtar.members),
+                      files=len(newtar.members))
+        if newtar.compression is not None:
+            # Compression overlaps the tar stage on the worker pool, so its
+            # time is what the workers spent, not wall time.
+            seconds, bytes_in, bytes_out = newtar.compression
+            metrics.record("compress", seconds, nbytes=bytes_in,
+                           files=len(newtar.members), bytes_out=bytes_out,
+                           **labels)
 
-        newtar.close()
         self._log.info("Zipped %d files", len(files))
+        ArchiveIndex.FromWriter(newtarname, newtar).save()
 
         lastnum = frag.last_image_number()
 
@@ -90,9 +137,12 @@ class BundleModule(Borg):
 
     def _expand(self, config, args):
         spec = BundleSpec.FromArgsAndConfig(args, config)
-        return self.expand(spec, config)
+        if not spec:
+            return False
+        return self.expand(self._indexed(spec, config), config,
+                           jobs=args['--jobs'])
 
-    def expand(self, spec, config):
+    def expand(self, spec, config, jobs=None):
         """ Expand the archives for the specified bundle to swap storage. """
         self._log.info("Expanding %s/%s", spec.device, spec.label)
 
@@ -100,56 +150,96 @@ class BundleModule(Borg):
         self._log.debug("Found %d archives", len(archives))
 
         extract_dest = os.path.join(config.swap_path, spec.device, spec.label)
-        extract_tmp = os.path.join(extract_dest, "tmp")
 
-        if not os.path.isdir(extract_tmp):
-            os.makedirs(extract_tmp)
+        if not os.path.isdir(extract_dest):
+            os.makedirs(extract_dest)
 
+        manifest = ExpandManifest(extract_dest)
+        stats = {}
+        changed = set()
+        pending = []
         for fname in archives:
-            try:
-                tarf = tarfile.open(fname, "r:gz")
-
-                # extract
-                self._log.debug("extracting %s", fname)
-
-                tarf.extractall(extract_tmp)
-            except IOError as err:
-                self._log.error("I/O error(%s): %s", err.errno, err.strerror)
-            except EOFError as err:
-                self._log.error("EOF error")
-                self._log.error(err)
-            except zlib.error as err:
-                self._log.error("error")
-                self._log.error(err)
-            except tarfile.ReadError as err:
-                self._log.error("error")
-                self._log.error(err)
-
-        matches = []
-        duplicates = []
-        for root, _, filenames in os.walk(extract_tmp):
-            for filename in fnmatch.filter(filenames, "*.jpg"):
-                dest_fname = os.path.join(extract_dest, filename)
-                src = os.path.join(root, filename)
-                filesize = os.stat(src).st_size
-                if filesize == 0:
-                    self._log.info("%s is empty; skipping", filename)
-                    continue
-                if dest_fname in matches:
-                    self._log.info("duplicate filename: %s", filename)
-                    duplicates.append(src)
-                elif os.path.isfile(dest_fname):
-                    self._log.info("File %s exists, skipping", filename)
-                else:
-                    match = src
-                    shutil.move(match, extract_dest)
-                    matches.append(dest_fname)
+            stats[fname] = manifest.archive_stat(fname)
+            if manifest.is_current(fname, stats[fname]):
+                continue
+            if manifest.entry(fname) is not None:
+                changed.add(fname)
+            pending.append(fname)
+        self._log.info("%d of %d archives need expanding", len(pending),
+                       len(archives))
+
+        # JPEGs barely compress, so the archive sizes bound what expands.
+        cache = SwapCache(config)
+        try:
+            if not cache.reserve(spec.device, spec.label,
+                                 sum(stats[fname][0] for fname in pending)):
+                return False
+        except ValueError as err:
+            self._log.error("swap_budget: %s", err)
+            return False
 
-        self._log.info("Extracted %d files", len(matches))
+        summary = ExpandSummary(set(os.listdir(extract_dest)))
+        try:
+            with metrics.stage("expand", device=spec.device,
+                               label=spec.label) as stage:
+                for result in extract_archives(pending, extract_dest,
+                                               jobs=jobs, overwrite=changed):
+                    self._log.debug("extracted %s", result.archive)
+                    summary.add(result)
+                    if not result.error:
+                        manifest.record(result.archive,
+                                        stats[result.archive], result.first,
+                                        result.last, result.count)
+                        stage.add(nbytes=stats[result.archive][0],
+                                  files=result.count)
+                manifest.save()
+        finally:
+            # Replaces the reservation with what was actually extracted.
+            cache.record(spec.device, spec.label)
+
+        self._log.info("Extracted %d files (%d existing, %d duplicates, "
+                       "%d empty)", len(summary.extracted), summary.existing,
+                       summary.duplicates, summary.empty)
 
         return True
 
+    def _frames(self, config, args):
+        """ Lists or extracts individual frames of a bundle. """
+        spec = BundleSpec.FromArgsAndConfig(args, config)
+        if not spec:
+            return False
+        spec = self._indexed(spec, config)
+
+        part = int(args['--part']) if args['--part'] else None
+        dest = args['--extract']
+        if dest:
+            os.makedirs(dest, exist_ok=True)
+
+        count = 0
+        try:
+            for index, member in bundle_frames(spec, args['--frames'], part):
+                if dest:
+                    self._log.debug("extracting %s", member.name)
+                    index.extract(member, dest)
+                else:
+                    print("{}\t{}\t{}\t{}".format(
+                        member.number, os.path.basename(index.archive),
+                        member.size,
+                        datetime.fromtimestamp(member.mtime).isoformat()))
+                count += 1
+        except (IOError, EOFError,
+                ArchiveFormatError) + DECOMPRESS_ERRORS as err:
+            self._log.error(err)
+            return False
+
+        self._log.info("%s %d frames", "Extracted" if dest else "Found", count)
+        return True
+
     def _ziporphans(self, config, args):
+        """ Zips the parts left unzipped and the loose images of every
+            bundle on the nodes, `--zips` bundles at once. Parts being zipped
+            by another process, and loose images being captured, are left
+            to it. """
         nodes = self._nodelist(args, config)
         if not nodes:
             return False
@@ -157,79 +247,268 @@ class BundleModule(Borg):
         device_lim = args['--device']
         label_lim = args['--label']
 
+        tasks = []
         for key, path in sorted(nodes):
-            for device in sorted(os.listdir(path)):
+            index = open_catalog(config, path)
+            devices = index.devices() if index else sorted(os.listdir(path))
+            for device in devices:
                 dev = os.path.join(path, device)
                 if not os.path.isdir(dev) or (device_lim and device != device_lim):
                     continue
 
-                for label in sorted(os.listdir(dev)):
+                labels = index.labels(device) if index else sorted(
+                    os.listdir(dev))
+                for label in labels:
                     ldir = os.path.join(dev, label)
                     if not os.path.isdir(ldir) or (label_lim and label != label_lim):
                         continue
-                    spec = BundleSpec(device, label, path)
+                    spec = BundleSpec(device, label, path, index=index)
 
-                    for p in spec.parts():
-                        part = spec.part_spec(p)
+                    tasks += [(spec, p) for p in spec.parts()
+                              if spec.part_spec(p).images()]
+                    if spec.images():
+                        tasks.append((spec, None))
+        if not tasks:
+            return True
 
-                        if len(part.images()) > 0:
-                            self._log.info("Zip %s/%s/%s", device, label, p)
-                            self._zipster(spec, args, config, part=p)
+        workers = min(len(tasks), zip_slots(config, args['--zips']))
+        if not args['--jobs']:
+            # Share the cores between the archives being compressed at once.
+            jobs = max(1, default_jobs() // workers)
+            args = dict(args, **{'--jobs': str(jobs)})
+        self._log.info("Zipping %d parts and bundles with %d workers",
+                       len(tasks), workers)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(metrics.in_scope(self._zip_orphan),
+                                   spec, part, args, config)
+                       for spec, part in tasks]
+            return all([future.result() for future in futures])
+
+    def _zip_orphan(self, spec, part, args, config):
+        """ Zips part `part` of `spec`, or all its loose images into new
+            parts when `part` is None. """
+        if part is not None:
+            self._log.info("Zip %s/%s/%s", spec.device, spec.label, part)
+            return self._zipster(spec, args, config, part=part, wait=False)
+
+        while spec.images():
+            self._log.info("Zip new bundle %s/%s", spec.device, spec.label)
+            zipped = self._zipster(spec, args, config, capture=True)
+            if zipped is None:
+                self._log.info("%s/%s is being captured, leaving its images",
+                               spec.device, spec.label)
+                return True
+            if not zipped or args['--dry']:
+                return zipped
+        return True
 
-                    while len(spec.images()) > 0:
-                        self._log.info("Zip new bundle %s/%s",
-                                       device, label)         
-                        self._zipster(spec, args, config)
-        return True  
-  
+    def _finished_images(self, spec, settle=SETTLE_SECS):
+        """ Loose images of `spec` which the camera is done writing: all but
+            the newest, and none modified in the last `settle` seconds. """
+        images = spec.images()[:-1]
+        cutoff = time.time() - settle
+        for pos, fname in enumerate(images):
+            try:
+                if os.path.getmtime(fname) > cutoff:
+                    return images[:pos]
+            except FileNotFoundError:
+                return images[:pos]
+        return images
+
+    def _roll(self, spec, args, config, maxfiles, idle, stopping=None):
+        """ Archives the finished images of `spec` in parts of `maxfiles`,
+            and the remainder once no image arrived for `idle` seconds.
+            Gives up on the bundle until the next pass once a zip fails or
+            event `stopping` is set. """
+        stopping = stopping or threading.Event()
+        for partnum in spec.parts():
+            if stopping.is_set():
+                return
+            if spec.part_spec(partnum).images():
+                # Left behind by an interrupted zip.
+                self._log.info("Zip %s/%s/%d", spec.device, spec.label,
+                               partnum)
+                if not self._zipster(spec, args, config, part=partnum):
+                    return
+
+        while not stopping.is_set() and \
+                len(self._finished_images(spec)) >= maxfiles:
+            self._log.info("Rolling %d images of %s/%s into a new part",
+                           maxfiles, spec.device, spec.label)
+            if not self._zipster(spec, args, config):
+                return
+
+        images = spec.images()
+        try:
+            newest = max(os.path.getmtime(fname) for fname in images)
+        except (ValueError, FileNotFoundError):
+            return
+        if time.time() - newest >= idle:
+            self._log.info("%s/%s idle, archiving %d remaining images",
+                           spec.device, spec.label, len(images))
+            while not stopping.is_set() and spec.images():
+                if not self._zipster(spec, args, config):
+                    return
+
+    def _watch(self, config, args):
+        """ Archives images into parts as they are captured, until stopped. """
+        node = args['--node'] or "local"
+        path = config.storage_node(node)
+        if path is None:
+            self._log.error("Invalid node")
+            return False
+        device = args['--device'] or config.device_id
+        devpath = os.path.join(path, device)
+        os.makedirs(devpath, exist_ok=True)
+
+        try:
+            check_format(args['--format'] or config['archive_format'])
+        except ArchiveFormatError as err:
+            self._log.error(err)
+            return False
+
+        maxfiles = int(args['--maxfilecount'] or 1000)
+        idle = int(args['--idle'] or IDLE_SECS)
+        args = dict(args, **{'--maxfilecount': str(maxfiles)})
+
+        watcher = open_watcher()
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            stopping = threading.Event()
+
+            def _stop(signum, _):
+                self._log.info("Stopping bundler")
+                stopping.set()
+                watcher.interrupt()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                handlers[signum] = signal.signal(signum, _stop)
+        else:
+            # A workflow of the `photopi run` daemon, which alone may handle
+            # signals; stop when it does.
+            stopping = shutdown_event()
+
+            def _wake():
+                stopping.wait()
+                watcher.interrupt()
+            threading.Thread(target=_wake, daemon=True).start()
+
+        self._log.info("Watching %s in parts of %d images", devpath, maxfiles)
+        try:
+            while not stopping.is_set():
+                watcher.watch(devpath)
+                for label in sorted(os.listdir(devpath)):
+                    if not os.path.isdir(os.path.join(devpath, label)):
+                        continue
+                    watcher.watch(os.path.join(devpath, label))
+                    self._roll(BundleSpec(device, label, path), args, config,
+                               maxfiles, idle, stopping=stopping)
+                    if stopping.is_set():
+                        break
+                watcher.wait(timeout=min(idle, WAKE_SECS))
+        finally:
+            watcher.close()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        return True
 
     def _zip(self, config, args):
         spec = BundleSpec.FromArgsAndConfig(args, config)
         if not spec:
             return False
+        spec = self._indexed(spec, config)
         self._log.debug("Zipping Bundle %s/%s", spec.device, spec.label)
 
 
         return self._zipster(spec, args, config, part=args['--part'])
 
-    def _zipster(self, spec, args, config, part=None):
+    def _zipster(self, spec, args, config, part=None, wait=True,
+                 capture=False):
+        """ Zips part `part` of `spec`, or the next `--maxfilecount` loose
+            images into a new part, holding their locks (see
+            :mod:`photopi.bundle.lock`). Without `wait` a part locked by
+            another process is left to it. With `capture` returns None,
+            zipping nothing, if the bundle is being captured. """
         if args['--dry']:
             self._log.info("Not zipping; dry run %s/%s", spec, part)
             return True
 
-        frag = None
+        try:
+            fmt = check_format(args['--format'] or config['archive_format'])
+        except ArchiveFormatError as err:
+            self._log.error(err)
+            return False
 
         if part:
             frag = spec.part_spec(int(part))
+            lock = BundleLock.FromConfig(config, spec,
+                                         part_name(frag.partnum))
+            if not lock.acquire(wait):
+                self._log.info("%s is being zipped by another zip", lock)
+                return True
         else:
-            frag = spec.next_part_spec()
-            maxfiles = int(args['--maxfilecount']) if args['--maxfilecount'] else 1000
-            if not self._fragmentimages(spec, frag, maxfiles):
-                self._log.info("no images to move")
-
+            guard = BundleLock.FromConfig(config, spec, CAPTURE, shared=True)
+            if capture and not guard.acquire(wait=False):
+                return None
+            try:
+                with BundleLock.FromConfig(config, spec, BUNDLE):
+                    frag = spec.next_part_spec()
+                    lock = BundleLock.FromConfig(config, spec,
+                                                 part_name(frag.partnum))
+                    # Taken before the part exists, so no other zip finds
+                    # it unlocked.
+                    lock.acquire()
+                    try:
+                        maxfiles = int(args['--maxfilecount']) if args['--maxfilecount'] else 1000
+                        if not self._fragmentimages(spec, frag, maxfiles):
+                            self._log.info("no images to move")
+                    except BaseException:
+                        lock.release()
+                        raise
+            finally:
+                guard.release()
+
+        try:
+            return self._zip_part(spec, frag, fmt, args, config)
+        finally:
+            lock.release()
+
+    def _zip_part(self, spec, frag, fmt, args, config):
         newtarname = None
 
         tardest = config.storage_node(args['--dest'])
 
         if tardest and not args['--rsync']:
-            newtarname = self._altdest(tardest, frag, args["--verifycifs"])
+            newtarname = self._altdest(tardest, frag, fmt,
+                                       args["--verifycifs"])
 
         if not newtarname:
-            newtarname = frag.tarfilename
-
-        if self._zip_files(newtarname, frag):
+            newtarname = frag.archive_filename(fmt)
+
+        if self._zip_files(newtarname, frag, fmt, jobs=args['--jobs']):
+            if config['thumbnails']:
+                try:
+                    build_thumbs(newtarname, jobs=args['--jobs'])
+                except (IOError, EOFError) as err:
+                    self._log.warning("Unable to make thumbnails for %s: %s",
+                                      newtarname, err)
             if args['--rsync'] and tardest:
                 self._log.info("Using rsync to move %s to %s",
                                newtarname, tardest)
-                destname = self._altdest(tardest, frag, args["--verifycifs"])
+                destname = self._altdest(tardest, frag, fmt,
+                                         args["--verifycifs"])
                 if destname is None:
                     self._log.warning("Alternate Destination is blank")
                 else:
-                    rsynccmd = RsyncCmd.Move(newtarname, destname)
-                    rsynccmd.run()
-                    rsynccmd = RsyncCmd.Move(frag.donefilename,
-                                             os.path.dirname(destname))
-                    rsynccmd.run()
+                    plan = TransferPlan(os.path.dirname(newtarname),
+                                        os.path.dirname(destname), move=True,
+                                        backend=config['transfer_backend'],
+                                        verify=config['transfer_verify'])
+                    plan.add(newtarname)
+                    for sidecar in self._sidecars(newtarname):
+                        plan.add(sidecar)
+                    plan.add_marker(frag.donefilename, newtarname)
+                    plan.run(streams=args['--streams'])
             elif args['--rsync']:
                 self._log.error(
                     "rsync flag must be used in conjunction with dest")
@@ -239,20 +518,37 @@ class BundleModule(Borg):
                           spec.label, frag.partnum)
         return True
 
-    def _altdest(self, tardest, spec, verifycifs):
+    @staticmethod
+    def _sidecars(archive, index=None):
+        """ Existing index and thumbnail sidecars of `archive`, looked up in
+            `index` when it is a server's inventory. """
+        if isinstance(index, RemoteCatalog):
+            exists = lambda fname: index.size(fname) is not None
+        else:
+            exists = os.path.isfile
+        return [fname for fname in (index_filename(archive),
+                                    thumbs_filename(archive))
+                if exists(fname)]
+
+    def _altdest(self, tardest, spec, fmt, verifycifs):
         basepath = os.path.join(tardest, spec.device)
         if not verifycifs or self._is_mounted(tardest):
             if not os.path.isdir(basepath):
                 os.makedirs(basepath)
-            newtarname = os.path.join(basepath,
-                                      os.path.basename(spec.tarfilename))
+            newtarname = os.path.join(basepath, os.path.basename(
+                spec.archive_filename(fmt)))
             return newtarname
         else:
             self._log.error("Warning. Expected mount path is not mounted.")
             return None
 
-    def fetch(self, bundles, destpath, done=False, move=False):
-        """ Moves archives in bundle(s) to `dest`. """
+    def fetch(self, bundles, destpath, done=False, move=False, streams=None,
+              backend=None, verify=False, chunk_size=None):
+        """ Moves archives in bundle(s) to `dest`, batching the transfers from
+            each source node into one plan run by `backend` (see
+            :mod:`photopi.bundle.transfer`) over up to `streams` workers.
+            Nodes served by a photopi server are pulled from it in chunks of
+            `chunk_size`. """
         if isinstance(bundles, BundleSpec):
             bundles = [bundles]
 
@@ -260,19 +556,48 @@ class BundleModule(Borg):
 
         self._log.info("Fetching bundles to %s", destpath)
 
+        plans = {}
+        present = {}
         for spec in bundles:
-            fetchdest = os.path.join(destpath, spec.device)
-            if not os.path.isdir(fetchdest):
-                os.makedirs(fetchdest)
+            known = spec.index if isinstance(spec.index, RemoteCatalog) \
+                else None
+            if spec.base not in plans:
+                plans[spec.base] = TransferPlan(
+                    spec.base, destpath, move=move, backend=backend,
+                    verify=verify, remote=known.remote if known else None,
+                    chunk_size=chunk_size)
+                present[spec.base] = self._present(spec.index, destpath, move)
+            plan = plans[spec.base]
+            sent = present[spec.base]
             for fname in spec.archives(done=done):
-                RsyncCmd(fname, fetchdest, move).run()
+                for name in [fname] + self._sidecars(fname, spec.index):
+                    if name not in sent:
+                        plan.add(name, size=known.size(name) if known
+                                 else None)
                 if done:
                     donefile = os.path.join(
-                        os.path.dirname(fname), 
+                        os.path.dirname(fname),
                         BundleSpecPart.donefile_from_tarname(fname))
-                    RsyncCmd(donefile, fetchdest, move).run()
-
-        return True
+                    if donefile not in sent:
+                        plan.add_marker(donefile, fname)
+
+        result = True
+        for plan in plans.values():
+            result = plan.run(streams=streams) and result
+        return result
+
+    def _present(self, index, destpath, move):
+        """ Files of the node of `index` already at `destpath`, which need
+            not be sent. Only a server's inventory knows them without
+            touching the source, and a move sends them anyway so the source
+            is only removed after a checked copy. """
+        if move or not isinstance(index, RemoteCatalog):
+            return set()
+        present = index.present(destpath)
+        if present:
+            self._log.info("Skipping %d files already at %s", len(present),
+                           destpath)
+        return present
 
     def _fetch(self, config, args):
         srcnode = args['--src']
@@ -289,29 +614,60 @@ class BundleModule(Borg):
             self._log.error("Invalid dest node")
             return False
 
-        bundles = self._get_bundles(srcpath, args['--device'], args['--label'])
+        index = self._node_index(config, srcnode, srcpath, args['--device'],
+                                 args['--label'])
+        bundles = self._get_bundles(srcpath, args['--device'], args['--label'],
+                                    index=index)
 
-        specs = self._get_specs(bundles, srcpath)
+        specs = self._get_specs(bundles, srcpath, index=index)
 
-        return self.fetch(specs, destpath,
-                          done=args['--done'], move=args['--move'])
+        return self.fetch(specs, destpath, done=args['--done'],
+                          move=args['--move'], streams=args['--streams'],
+                          backend=config['transfer_backend'],
+                          verify=config['transfer_verify'],
+                          chunk_size=parse_size(config['transfer_chunk_size']))
 
     def filter_bundles(self, args, config):
         """
         Dict of node-device-labels for bundles matching criteria in args.
         """
+        scanned = self._scan_nodes(args, config)
+        if scanned is None:
+            return False
+        return {key: bundles for key, (_, bundles) in scanned.items()}
+
+    def _scan_nodes(self, args, config):
+        """ Dict of node name to (index, bundles) for the nodes in args. """
         nodes = self._nodelist(args, config)
         if not nodes:
-            return False
+            return None
 
-        bundles = {}
+        scanned = {}
         for key, path in sorted(nodes):
-            if os.path.isdir(path):
-                bundles[key] = self._get_bundles(path, args['--device'],
-                                                 args['--label'])
-
-        self._log.debug("bundles found %s", bundles)
-        return bundles
+            index = self._node_index(config, key, path, args['--device'],
+                                     args['--label'])
+            if isinstance(index, RemoteCatalog) or os.path.isdir(path):
+                scanned[key] = (index, self._get_bundles(
+                    path, args['--device'], args['--label'], index=index))
+
+        self._log.debug("bundles found %s", scanned)
+        return scanned
+
+    def _node_index(self, config, node, path, device=None, label=None):
+        """ The index of storage node `node` at `path`: an inventory of the
+            bundles of `device` and `label` from the node's photopi server
+            when `node_servers` names one, otherwise its catalog. """
+        if node in (config['node_servers'] or {}):
+            # Imported here so rpyc is only loaded for served nodes.
+            from photopi.client.module import RemoteNode
+            remote = RemoteNode.FromConfig(config, node)
+            try:
+                return RemoteCatalog(path, remote.inventory(device, label),
+                                     remote=remote)
+            except (OSError, EOFError, ValueError) as err:
+                self._log.warning("Unable to list %s from %s, listing %s "
+                                  "instead: %s", node, remote, path, err)
+        return open_catalog(config, path)
 
     def _nodelist(self, args, config):
         """ List of (nodename, nodepath) tuples. """
@@ -328,10 +684,12 @@ class BundleModule(Borg):
     def _ls(self, config, args):
         """ List the bundles accessible by this node."""
 
-        bundles = self.filter_bundles(args, config)
+        scanned = self._scan_nodes(args, config)
+        if scanned is None:
+            return False
 
         tupled = []
-        for key, bundle in bundles.items():
+        for key, (_, bundle) in scanned.items():
             print(key)
             for device, labels in bundle.items():
                 print("\t{}".format(device))
@@ -341,21 +699,36 @@ class BundleModule(Borg):
 
         if len(tupled) == 1:
             (key, device, label) = tupled[0]
-            spec = BundleSpec(device, label, config['storage_nodes'][key])
+            path = config['storage_nodes'][key]
+            spec = BundleSpec(device, label, path, index=scanned[key][0])
             for archive in spec.archives():
                 print(archive)
 
         return True
 
     @staticmethod
-    def _get_specs(bundles, path):
+    def _get_specs(bundles, path, index=None):
         specs = []
         for device, labels in bundles.items():
             for label in labels:
-                specs.append(BundleSpec(device, label, path))
+                specs.append(BundleSpec(device, label, path, index=index))
         return specs
 
-    def _get_bundles(self, path, device_lim=None, label_lim=None):
+    @staticmethod
+    def _indexed(spec, config):
+        """ Clone of `spec` which answers listings from its node's catalog. """
+        return spec.clone(spec.base, index=open_catalog(config, spec.base))
+
+    def _get_bundles(self, path, device_lim=None, label_lim=None,
+                     index=None):
+        with metrics.stage("scan", catalog=index is not None) as stage:
+            bundles = self._scan_bundles(path, device_lim, label_lim, index)
+            stage.add(files=sum(len(labels) for labels in bundles.values()))
+        return bundles
+
+    def _scan_bundles(self, path, device_lim, label_lim, index):
+        if index is not None:
+            return index.bundles(device_lim, label_lim)
 
         archives = {}
         for device in sorted(os.listdir(path)):
@@ -368,7 +741,7 @@ class BundleModule(Borg):
             self._log.debug("Is Dir")
             for _, _, files in os.walk(os.path.join(path, device)):
                 self._log.debug(files)
-                for filename in fnmatch.filter(files, "*.tar.gz"):
+                for filename in filter(is_archive, files):
                     label = BundleSort.get_label(filename)
                     if label_lim and label != label_lim:
                         continue
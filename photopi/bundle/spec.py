@@ -5,6 +5,16 @@ import logging
 import os
 import re
 
+from photopi.bundle.archive import (DEFAULT_FORMAT, FORMATS, check_format,
+                                    is_archive, strip_extension)
+
+IMAGE_PATTERN = re.compile(r'image(\d+)')
+IMAGE_FILE_PATTERN = re.compile(r'^image(\d+)\.jpg$')
+PARTFILE_PATTERN = re.compile(r'p(\d+)\.tar(\.gz|\.zst)?$')
+PARTDIR_PATTERN = re.compile(r'^p(\d+)$')
+PARTDIR_PATH_PATTERN = re.compile(r'\/p(\d+)')
+LABEL_PATTERN = re.compile(r'(\d+-\d+-\d+)')
+
 class BundleSpec:
     def FromArgsAndConfig(args, config):
         log = logging.getLogger("BundleSpec.FromArgsAndConfig")
@@ -26,20 +36,23 @@ class BundleSpec:
         return BundleSpec(device, label, srcpath)
 
 
-    """ The group of images with the same label. """
-    def __init__(self, device, label, base):
+    """ The group of images with the same label. When `index` is given (e.g.
+        a :class:`photopi.bundle.catalog.BundleCatalog`), directory listings
+        are answered by it instead of globbing the node. """
+    def __init__(self, device, label, base, index=None):
         self._log = logging.getLogger(
             "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
         self._device = device
         self._label = label
         self._base = base
+        self._index = index
 
     def __str__(self):
         return '{}/{}/{}'.format(self._base, self._device, self._label)
 
-    def clone(self, base):
+    def clone(self, base, index=None):
         """ Clones this spec for a different node. """
-        return BundleSpec(self.device, self.label, base)
+        return BundleSpec(self.device, self.label, base, index=index)
 
     @property
     def label(self):
@@ -51,6 +64,16 @@ class BundleSpec:
         """ The device of this spec. """
         return self._device
 
+    @property
+    def base(self):
+        """ Path of the storage node holding this bundle. """
+        return self._base
+
+    @property
+    def index(self):
+        """ The index answering directory listings, or None. """
+        return self._index
+
     def part_spec(self, partnum):
         """ Gets the spec for the bundle fragment. """
         return BundleSpecPart(
@@ -75,10 +98,13 @@ class BundleSpec:
 
     def archives(self, done=False):
         """ List of archive filenames for this bundle. """
-        partarchs = sorted(glob.glob(
-            os.path.join(self._base, self._device,
-                         "{}.*.tar.gz".format(self._label))),
-                           key=BundleSort.partfile_number)
+        if self._index is not None:
+            partarchs = self._index.archives(self._device, self._label)
+        else:
+            partarchs = filter(is_archive, glob.glob(
+                os.path.join(self._base, self._device,
+                             "{}.*.tar*".format(self._label))))
+        partarchs = sorted(partarchs, key=BundleSort.partfile_number)
         self._log.debug(partarchs)
 
         if done:
@@ -97,6 +123,8 @@ class BundleSpec:
 
     def partdirs(self):
         """ List of fragment directories which exist for this bundle. """
+        if self._index is not None:
+            return self._index.partdirs(self._device, self._label)
         return glob.glob(
             os.path.join(self._base, self._device, self._label, "p*/"))
 
@@ -114,17 +142,28 @@ class BundleSpec:
         return parts[-1]
 
     def last_image_number(self):
-        """ Last image number in the bundle. """
-        if self.last_part_number() == 0:
-            images = self.images()
-            if images:
-                return BundleSort.image_number(images[-1])
+        """ Last image number in the bundle. Loose images are always newer
+            than the parts, so they are checked first. """
+        images = self.images()
+        if images:
+            return BundleSort.image_number(images[-1])
+        partspec = self.last_part_spec()
+        if partspec is None:
             return -1
-        return self.last_part_spec().last_image_number()
+        return partspec.last_image_number()
 
+    def snapshot(self):
+        """ Clone of this spec which answers every listing from a single scan
+            of the bundle's directories. Changes made after the snapshot is
+            taken are not seen by it. """
+        return self.clone(self._base, index=BundleSnapshot(
+            self._device, self._label, self._base))
 
     def images(self, part=None):
         """ List the images for this bundle. """
+        if self._index is not None:
+            images = self._index.images(self._device, self._label, part)
+            return sorted(images, key=BundleSort.image_number)
         if part is not None:
             pattern = os.path.join(self.device, self.label, "p{}".format(part),
                                    "image*.jpg")
@@ -145,8 +184,17 @@ class BundleSpecPart:
 
     @property
     def tarfilename(self):
-        """ Filename of zipped tarball of images for this fragment. """
-        return self._fname("{}.tar.gz")
+        """ Filename of the archive of images for this fragment. An existing
+            archive in any format wins over the default format. """
+        for fmt in sorted(FORMATS):
+            fname = self._fname("{}" + FORMATS[fmt])
+            if os.path.isfile(fname):
+                return fname
+        return self.archive_filename(DEFAULT_FORMAT)
+
+    def archive_filename(self, fmt):
+        """ Filename of the archive for this fragment in format `fmt`. """
+        return self._fname("{}" + FORMATS[check_format(fmt)])
 
     @property
     def donefilename(self):
@@ -160,11 +208,17 @@ class BundleSpecPart:
     @staticmethod
     def filebase(fname):
         fname = os.path.basename(fname)
-        match = re.search(r'\.?(.+)\..?(tar\.gz)|(done)', fname)
+        match = re.search(r'^\.?(.+?)(\.done)?$', strip_extension(fname))
         return match.group(1)
 
+    @property
+    def _index(self):
+        return self.parent.index if self.parent is not None else None
+
     def is_done(self):
         """ Indicates whether this fragment's archive has been written. """
+        if self._index is not None:
+            return self._index.is_done(self.device, self.label, self.partnum)
         return os.path.isfile(self.donefilename)
 
     def dirname(self):
@@ -182,22 +236,43 @@ class BundleSpecPart:
         """ List of images in this fragment. """
         return self.parent.images(part=self.partnum)
 
-    def last_image_number(self):
-        """ Last image number in the bundle. """
+    def done_number(self):
+        """ Last image number recorded by the done marker of this fragment,
+            or None if it has none. """
+        if self._index is not None:
+            return self._index.done_number(self.device, self.label,
+                                           self.partnum)
         donefile = self.donefilename
         if os.path.isfile(donefile):
-            stream = open(donefile, 'r')
-            num = stream.read()
-            return int(num)
+            with open(donefile, 'r') as stream:
+                return int(stream.read())
+        return None
+
+    def _own_last_image_number(self):
+        """ Last image number held by this fragment alone, or None. """
+        num = self.done_number()
+        if num is not None:
+            return num
         images = self.images()
         if images:
             return BundleSort.image_number(images[-1])
-        if self.partnum == 0:
+        return None
+
+    def last_image_number(self):
+        """ Last image number in the bundle up to and including this
+            fragment. Earlier fragments are searched newest first. """
+        num = self._own_last_image_number()
+        if num is not None:
+            return num
+        if self.partnum == 0 or self.parent is None:
             return -1
-        prevpart = self.parent.part_spec(self.partnum - 1)
-        if prevpart is not None:
-            return prevpart.last_image_number()
 
+        for partnum in reversed(self.parent.parts()):
+            if partnum >= self.partnum:
+                continue
+            num = self.parent.part_spec(partnum)._own_last_image_number()
+            if num is not None:
+                return num
         return -1
 
 
@@ -208,25 +283,108 @@ class BundleSort:
     def image_number(fname):
         """ Extract the image number from a filename. """
         fname = os.path.basename(fname)
-        match = re.search(r'image(\d+)', fname)
+        match = IMAGE_PATTERN.search(fname)
         return int(match.group(1))
 
     @staticmethod
     def get_label(filename):
         """ Extract the label from a filename. """
         fname = os.path.basename(filename)
-        match = re.search(r'(\d+-\d+-\d+)', fname)
+        match = LABEL_PATTERN.search(fname)
         return match.group(1)
 
     @staticmethod
     def partfile_number(fname):
         """ Extract the part number from a filename. """
         fname = os.path.basename(fname)
-        match = re.search(r'p(\d+)\.tar\.gz', fname)
+        match = PARTFILE_PATTERN.search(fname)
         return int(match.group(1))
 
     @staticmethod
     def partdir_number(fname):
         """ Extract the part number from a directory. """
-        match = re.search(r'\/p(\d+)', fname)
+        match = PARTDIR_PATH_PATTERN.search(fname)
         return int(match.group(1))
+
+
+class BundleSnapshot:
+    """
+    Point-in-time listing of one bundle, usable as the index of a
+    :class:`BundleSpec`. The device and label directories are scanned once
+    with `os.scandir` when the snapshot is taken; part directories and done
+    markers are read the first time they are asked for.
+    """
+
+    def __init__(self, device, label, base):
+        self._device = device
+        self._label = label
+        self._devpath = os.path.join(base, device)
+        self._labelpath = os.path.join(self._devpath, label)
+        self._archives = []
+        self._done = {}
+        self._partdirs = []
+        self._images = {}
+        self._scan_device()
+        self._scan_label()
+
+    @staticmethod
+    def _scandir(path):
+        try:
+            with os.scandir(path) as entries:
+                return list(entries)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+    def _scan_device(self):
+        prefix = "{}.".format(self._label)
+        doneprefix = ".{}.{}.p".format(self._label, self._device)
+        for entry in self._scandir(self._devpath):
+            name = entry.name
+            if name.startswith(prefix) and is_archive(name):
+                self._archives.append(entry.path)
+            elif name.startswith(doneprefix) and name.endswith(".done"):
+                partnum = name[len(doneprefix):-len(".done")]
+                if partnum.isdigit():
+                    self._done[int(partnum)] = None
+
+    def _scan_images(self, path):
+        return [entry.path for entry in self._scandir(path)
+                if IMAGE_FILE_PATTERN.match(entry.name)]
+
+    def _scan_label(self):
+        self._images[None] = []
+        for entry in self._scandir(self._labelpath):
+            if IMAGE_FILE_PATTERN.match(entry.name):
+                self._images[None].append(entry.path)
+            elif PARTDIR_PATTERN.match(entry.name) and entry.is_dir():
+                self._partdirs.append(os.path.join(entry.path, ""))
+
+    def archives(self, device, label):
+        """ Paths of the archives of the bundle. """
+        return list(self._archives)
+
+    def partdirs(self, device, label):
+        """ Paths of the part directories of the bundle. """
+        return list(self._partdirs)
+
+    def images(self, device, label, part=None):
+        """ Paths of the loose images of the bundle or one of its parts. """
+        if part not in self._images:
+            self._images[part] = self._scan_images(
+                os.path.join(self._labelpath, "p{}".format(part)))
+        return list(self._images[part])
+
+    def is_done(self, device, label, partnum):
+        """ Indicates whether a part has a done marker. """
+        return partnum in self._done
+
+    def done_number(self, device, label, partnum):
+        """ Last image number recorded by a part's done marker, or None. """
+        if partnum not in self._done:
+            return None
+        if self._done[partnum] is None:
+            donefile = os.path.join(self._devpath, ".{}.{}.p{}.done".format(
+                self._label, self._device, partnum))
+            with open(donefile, "r") as stream:
+                self._done[partnum] = int(stream.read())
+        return self._done[partnum]
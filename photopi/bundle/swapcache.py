@@ -0,0 +1,261 @@
+"""
+Swap storage as a size-budgeted cache of expanded bundles.
+
+Every bundle expanded into `<swap>/<device>/<label>` is tracked in
+`<swap>/.photopi-cache.json` with its size and the last time it was used.
+With `swap_budget` set in the config (bytes, or a size such as `200G`), an
+expand first evicts the least recently used bundles until the new one fits.
+Bundles which are pinned, because a timelapse is encoding from them, or
+still expanding are never evicted, by this process or any other. Bundles
+already in swap are reused as they are, so repeat renders of recent bundles
+skip extraction.
+
+Updates to the cache record are serialized between processes with a lock
+file. The record holds the pins of every process, and the bytes each
+expand in progress reserved until its size is measured, so concurrent
+expands cannot overrun the budget between them. Pins and reservations of
+processes which died are dropped. Directories found in swap without a
+record (expanded before the cache existed) are adopted on first use.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from photopi.bundle.manifest import MANIFEST_NAME
+
+CACHE_NAME = ".photopi-cache.json"
+LOCK_NAME = ".photopi-cache.lock"
+
+_SIZE_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?$', re.IGNORECASE)
+_SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+
+def parse_size(size):
+    """ Bytes in a size such as `1048576`, `500M` or `1.5T`, or None. """
+    if size is None or size == "":
+        return None
+    match = _SIZE_PATTERN.match(str(size).strip())
+    if match is None:
+        raise ValueError("Invalid size: {}".format(size))
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+
+def _alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def dir_size(path):
+    """ Total size of the files directly in `path`. """
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    except FileNotFoundError:
+        pass
+    return total
+
+
+class SwapCache:
+    """ The expanded bundles in swap storage of `config`. """
+
+    def __init__(self, config):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._root = config.swap_path
+        self._budget = config['swap_budget']
+        self._fname = os.path.join(self._root, CACHE_NAME)
+
+    @property
+    def budget(self):
+        """ Bytes of swap the expanded bundles may use, or None if
+            unlimited. Raises ValueError if `swap_budget` is malformed. """
+        return parse_size(self._budget)
+
+    @staticmethod
+    def _key(device, label):
+        return "{}/{}".format(device, label)
+
+    def path(self, device, label):
+        """ Directory of the expanded bundle `device`/`label`. """
+        return os.path.join(self._root, device, label)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(self._root, exist_ok=True)
+        with open(os.path.join(self._root, LOCK_NAME), "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _load(self):
+        """ (entries, pins) of the cache record, where pins maps bundle keys
+            to the pin count of each process id holding them. """
+        try:
+            with open(self._fname, "r") as stream:
+                state = json.load(stream)
+        except FileNotFoundError:
+            state = {}
+        except ValueError as err:
+            self._log.warning("Ignoring unreadable %s: %s", self._fname, err)
+            state = {}
+        entries = state.get("bundles", {})
+
+        # Drop bundles removed by hand and adopt ones expanded untracked.
+        entries = {key: entry for key, entry in entries.items()
+                   if os.path.isdir(os.path.join(self._root, key))}
+        for device in os.listdir(self._root):
+            devpath = os.path.join(self._root, device)
+            if not os.path.isdir(devpath):
+                continue
+            for label in os.listdir(devpath):
+                key = self._key(device, label)
+                path = os.path.join(devpath, label)
+                if key not in entries and os.path.isfile(
+                        os.path.join(path, MANIFEST_NAME)):
+                    entries[key] = {"size": dir_size(path),
+                                    "used": os.path.getmtime(path)}
+
+        # Forget what processes which died held.
+        for entry in entries.values():
+            if "reserved" in entry and not _alive(entry.get("pid", 0)):
+                entry.pop("reserved")
+                entry.pop("pid", None)
+        pins = {}
+        for key, holders in state.get("pinned", {}).items():
+            holders = {pid: count for pid, count in holders.items()
+                       if _alive(pid)}
+            if holders:
+                pins[key] = holders
+        return entries, pins
+
+    def _save(self, entries, pins):
+        tmpname = "{}.tmp{}".format(self._fname, os.getpid())
+        with open(tmpname, "w") as stream:
+            json.dump({"bundles": entries, "pinned": pins}, stream, indent=1,
+                      sort_keys=True)
+        os.replace(tmpname, self._fname)
+
+    def usage(self):
+        """ Dict of bundle key to (size, last used) for swap. """
+        with self._locked():
+            return {key: (entry["size"], entry["used"])
+                    for key, entry in self._load()[0].items()}
+
+    def reserve(self, device, label, needed):
+        """ Makes room for `needed` more bytes for bundle `device`/`label`,
+            evicting the least recently used bundles which are neither
+            pinned nor expanding, and holds them for it until
+            :meth:`record`. Returns False if the budget cannot hold it. """
+        key = self._key(device, label)
+        budget = self.budget
+        with self._locked():
+            entries, pins = self._load()
+            entry = entries.setdefault(key, {"size": 0})
+            entry["used"] = time.time()
+            entry.pop("reserved", None)
+            if budget is None:
+                self._save(entries, pins)
+                return True
+
+            used = sum(other["size"] + other.get("reserved", 0)
+                       for other in entries.values())
+            victims = sorted((other["used"], other_key)
+                             for other_key, other in entries.items()
+                             if other_key != key and other_key not in pins
+                             and "reserved" not in other)
+            freeable = sum(entries[other]["size"] for _, other in victims)
+            if used - freeable + needed > budget:
+                # Evicting would not make it fit, so keep what is there.
+                victims = []
+            while used + needed > budget and victims:
+                _, victim = victims.pop(0)
+                self._log.info("Evicting %s from swap (%d bytes)", victim,
+                               entries[victim]["size"])
+                shutil.rmtree(os.path.join(self._root, victim),
+                              ignore_errors=True)
+                used -= entries.pop(victim)["size"]
+            fits = used + needed <= budget
+            if fits:
+                entry["reserved"] = needed
+                entry["pid"] = os.getpid()
+            self._save(entries, pins)
+
+        if not fits:
+            self._log.error("%s needs %d bytes but only %d of the %d byte "
+                            "swap budget can be freed", key, needed,
+                            max(0, budget - used), budget)
+            return False
+        return True
+
+    def record(self, device, label):
+        """ Records the current size of bundle `device`/`label` as used now,
+            in place of what :meth:`reserve` held for it. """
+        key = self._key(device, label)
+        with self._locked():
+            entries, pins = self._load()
+            entries[key] = {"size": dir_size(self.path(device, label)),
+                            "used": time.time()}
+            self._save(entries, pins)
+
+    def forget(self, device, label):
+        """ Drops bundle `device`/`label` from the record, with this
+            process's pins of it, once its directory is removed. """
+        key = self._key(device, label)
+        with self._locked():
+            entries, pins = self._load()
+            entries.pop(key, None)
+            if key in pins:
+                pins[key].pop(str(os.getpid()), None)
+                if not pins[key]:
+                    del pins[key]
+            self._save(entries, pins)
+
+    def pin(self, device, label):
+        """ Keeps bundle `device`/`label` from being evicted by any process
+            until a matching :meth:`unpin`, or until this process exits. """
+        key = self._key(device, label)
+        pid = str(os.getpid())
+        with self._locked():
+            entries, pins = self._load()
+            holders = pins.setdefault(key, {})
+            holders[pid] = holders.get(pid, 0) + 1
+            self._save(entries, pins)
+
+    def unpin(self, device, label):
+        """ Releases one :meth:`pin` of bundle `device`/`label`. """
+        key = self._key(device, label)
+        pid = str(os.getpid())
+        with self._locked():
+            entries, pins = self._load()
+            holders = pins.get(key, {})
+            if holders.get(pid, 0) <= 1:
+                holders.pop(pid, None)
+            else:
+                holders[pid] -= 1
+            if not holders:
+                pins.pop(key, None)
+            self._save(entries, pins)
+
+    @contextlib.contextmanager
+    def pinned(self, device, label):
+        """ Pins bundle `device`/`label` for the duration of the block. """
+        self.pin(device, label)
+        try:
+            yield
+        finally:
+            self.unpin(device, label)
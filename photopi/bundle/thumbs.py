@@ -0,0 +1,163 @@
+"""
+Thumbnail sidecars for bundle archives.
+
+Each part can have a `.<label>.<device>.p<N>.thumbs.tar` next to its
+archive, holding a small JPEG for every frame under the frame's own name.
+The thumbnails are made on a process pool, with Pillow when it is installed
+(decoding the JPEG at reduced scale) and otherwise by lifting the thumbnail
+raspistill embeds in the EXIF data of every frame. Previews are rendered
+from these sidecars without touching the full size frames again.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import io
+import itertools
+import logging
+import os
+import struct
+import tarfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from photopi.bundle.index import ArchiveIndex
+from photopi.bundle.spec import BundleSpecPart
+from photopi.core.compress import default_jobs
+
+THUMB_SIZE = (320, 180)
+THUMB_QUALITY = 70
+
+_CHUNK_FRAMES = 64
+
+
+def thumbs_filename(archive):
+    """ Filename of the thumbnail sidecar for `archive`. """
+    return os.path.join(os.path.dirname(archive), ".{}.thumbs.tar".format(
+        BundleSpecPart.filebase(archive)))
+
+
+def _ifd_entries(tiff, offset, endian):
+    count = struct.unpack_from(endian + "H", tiff, offset)[0]
+    entries = {}
+    for pos in range(offset + 2, offset + 2 + count * 12, 12):
+        tag, kind, _, value = struct.unpack_from(endian + "HHII", tiff, pos)
+        if kind == 3:
+            value = struct.unpack_from(endian + "H", tiff, pos + 8)[0]
+        entries[tag] = value
+    next_ifd = struct.unpack_from(endian + "I", tiff,
+                                  offset + 2 + count * 12)[0]
+    return entries, next_ifd
+
+
+def exif_thumbnail(data):
+    """ The JPEG thumbnail embedded in the EXIF data of JPEG `data`, or
+        None if it has none. """
+    pos = 2
+    try:
+        while pos + 4 <= len(data) and data[pos] == 0xFF:
+            marker = data[pos + 1]
+            length = struct.unpack_from(">H", data, pos + 2)[0]
+            if marker == 0xE1 and data[pos + 4:pos + 10] == b"Exif\0\0":
+                tiff = data[pos + 10:pos + 2 + length]
+                endian = "<" if tiff[:2] == b"II" else ">"
+                ifd0 = struct.unpack_from(endian + "I", tiff, 4)[0]
+                _, ifd1 = _ifd_entries(tiff, ifd0, endian)
+                if not ifd1:
+                    return None
+                entries, _ = _ifd_entries(tiff, ifd1, endian)
+                start, size = entries.get(0x0201), entries.get(0x0202)
+                if not start or not size:
+                    return None
+                return bytes(tiff[start:start + size]) or None
+            if marker == 0xDA:
+                return None
+            pos += 2 + length
+    except struct.error:
+        return None
+    return None
+
+
+def make_thumbnail(data, size=THUMB_SIZE):
+    """ A small JPEG of the frame in JPEG `data`, or None if none can be
+        made. Runs in a worker process. """
+    if Image is None:
+        return exif_thumbnail(data)
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Let the decoder skip detail the thumbnail cannot show.
+        image.draft("RGB", size)
+        image = image.convert("RGB")
+        image.thumbnail(size)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=THUMB_QUALITY)
+        return out.getvalue()
+    except (OSError, ValueError):
+        return exif_thumbnail(data)
+
+
+def is_current(archive):
+    """ Indicates whether `archive` has a sidecar at least as new as it. """
+    try:
+        return (os.path.getmtime(thumbs_filename(archive)) >=
+                os.path.getmtime(archive))
+    except OSError:
+        return False
+
+
+def build_thumbs(archive, jobs=None, pool=None):
+    """ Writes the thumbnail sidecar of `archive` and returns its path. The
+        archive is read once; frames are scaled on `pool`, or on a pool of
+        `jobs` processes. """
+    log = logging.getLogger(__name__)
+    index = ArchiveIndex.ForArchive(archive)
+    members = [index.member(number) for number in index.frames()]
+    members = [member for member in members if member.size]
+
+    fname = thumbs_filename(archive)
+    tmpname = "{}.tmp{}".format(fname, os.getpid())
+    owned = pool is None
+    if owned:
+        pool = ProcessPoolExecutor(max_workers=default_jobs(jobs))
+    count = 0
+    try:
+        with tarfile.open(tmpname, "w") as tar:
+            frames = index.iter_read(members)
+            while True:
+                # Bound the frames held in memory to one chunk per pass.
+                chunk = list(itertools.islice(frames, _CHUNK_FRAMES))
+                if not chunk:
+                    break
+                thumbs = pool.map(make_thumbnail,
+                                  [data for _, data in chunk])
+                for (member, _), thumb in zip(chunk, thumbs):
+                    if not thumb:
+                        log.debug("No thumbnail for %s", member.name)
+                        continue
+                    info = tarfile.TarInfo(member.name)
+                    info.size = len(thumb)
+                    info.mtime = member.mtime
+                    tar.addfile(info, io.BytesIO(thumb))
+                    count += 1
+        os.replace(tmpname, fname)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    finally:
+        if owned:
+            pool.shutdown()
+
+    log.info("Wrote %d thumbnails for %s", count, os.path.basename(archive))
+    return fname
+
+
+def ensure_thumbs(archives, jobs=None):
+    """ Builds the missing or stale sidecars of `archives` on one shared pool
+        and returns the sidecar paths in order. """
+    pending = [archive for archive in archives if not is_current(archive)]
+    if pending:
+        with ProcessPoolExecutor(max_workers=default_jobs(jobs)) as pool:
+            for archive in pending:
+                build_thumbs(archive, pool=pool)
+    return [thumbs_filename(archive) for archive in archives]
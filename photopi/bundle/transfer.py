@@ -0,0 +1,340 @@
+"""
+Batched file transfers between storage nodes.
+
+A :class:`TransferPlan` collects every file to copy from one source
+directory to one destination directory. Marker files (the `.done` files of
+parts) are sent in a last batch, and only when the file they mark arrived,
+so a destination never holds a done marker without its archive.
+
+Two backends carry out a plan:
+
+- `native` copies in process on a thread pool. A move within one
+  filesystem is a rename; anything else is copied by the kernel with
+  `copy_file_range` (or `sendfile`) into a temporary file which is checked
+  and renamed into place.
+- `rsync` hands the files to rsync through `--files-from` lists, split over
+  several concurrent rsync streams.
+
+The default, `auto`, uses the native backend between local paths and falls
+back to rsync for remote `host:path` nodes and for any file the native
+backend failed to copy. From a node served by a photopi server it instead
+pulls the files over the photopi service in resumable, checked chunks (see
+:mod:`photopi.client.transfer`); files which fail are left to resume on
+the next attempt rather than copied again from zero.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from photopi.core import metrics
+from photopi.core.cmd import RsyncCmd, run_all
+
+BACKENDS = ("auto", "native", "rsync")
+NATIVE_JOBS = 4
+
+_CHUNKSIZE = 64 * 1024 * 1024
+_REMOTE_PATTERN = re.compile(r'^[^/]*:')
+# Errors meaning the kernel cannot offload this copy, so try the next method.
+_NO_OFFLOAD = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTSUP, errno.EBADF)
+
+
+def is_remote(path):
+    """ Indicates whether `path` names a remote rsync location. """
+    return bool(_REMOTE_PATTERN.match(path))
+
+
+def _copy_file_range(infd, outfd, size):
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(infd, outfd, min(_CHUNKSIZE, size - copied))
+        if not sent:
+            break
+        copied += sent
+    return copied
+
+
+def _sendfile(infd, outfd, size):
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(outfd, infd, copied, min(_CHUNKSIZE, size - copied))
+        if not sent:
+            break
+        copied += sent
+    return copied
+
+
+def _read_write(infd, outfd, size):
+    with open(infd, "rb", closefd=False) as src, \
+            open(outfd, "wb", closefd=False) as dest:
+        shutil.copyfileobj(src, dest, 1024 * 1024)
+        return dest.tell()
+
+
+def copy_fd(infd, outfd, size):
+    """ Copies `size` bytes between file descriptors, letting the kernel do
+        the copy when it can. Returns the number of bytes copied. """
+    for name, method in (("copy_file_range", _copy_file_range),
+                         ("sendfile", _sendfile)):
+        if not hasattr(os, name):
+            continue
+        try:
+            return method(infd, outfd, size)
+        except OSError as err:
+            if err.errno not in _NO_OFFLOAD:
+                raise
+            # Start the next method over from the beginning of both files.
+            os.lseek(infd, 0, os.SEEK_SET)
+            os.lseek(outfd, 0, os.SEEK_SET)
+            os.ftruncate(outfd, 0)
+    return _read_write(infd, outfd, size)
+
+
+def file_digest(fname):
+    """ sha256 hex digest of the contents of `fname`. """
+    digest = hashlib.sha256()
+    with open(fname, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TransferPlan:
+    """ Files to transfer from directory `src` to directory `dest`. """
+
+    def __init__(self, src, dest, move=False, backend=None, verify=False,
+                 remote=None, chunk_size=None):
+        """ `backend` is one of :data:`BACKENDS` (default auto). With
+            `verify`, native copies are compared by checksum, not only by
+            size. `remote` is the :class:`photopi.client.module.RemoteNode`
+            serving `src`, if any, to pull from in chunks of `chunk_size`. """
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        backend = backend or "auto"
+        if backend not in BACKENDS:
+            raise ValueError("Unknown transfer backend: {}".format(backend))
+        self.src = src
+        self.dest = dest
+        self.move = move
+        self.backend = backend
+        self.verify = verify
+        self.remote = remote
+        self.chunk_size = chunk_size
+        self._files = []
+        self._markers = []
+        self._sizes = {}
+
+    def __str__(self):
+        return "TransferPlan({} -> {}, {} files, {} markers)".format(
+            self.src, self.dest, len(self._files), len(self._markers))
+
+    def __len__(self):
+        return len(self._files) + len(self._markers)
+
+    def _relpath(self, fname):
+        return os.path.relpath(fname, self.src)
+
+    def _size(self, relpath):
+        if relpath in self._sizes:
+            return self._sizes[relpath]
+        try:
+            return os.path.getsize(os.path.join(self.src, relpath))
+        except OSError:
+            return 0
+
+    def add(self, fname, size=None):
+        """ Adds `fname`, a path below the source directory. A `size` known
+            up front saves a stat of the source. """
+        relpath = self._relpath(fname)
+        self._files.append(relpath)
+        if size is not None:
+            self._sizes[relpath] = size
+
+    def add_marker(self, fname, marks):
+        """ Adds marker `fname`, sent only after the file `marks` arrived. """
+        self._markers.append((self._relpath(fname), self._relpath(marks)))
+
+    def batches(self, streams=1, relpaths=None):
+        """ The files (or `relpaths`) split into at most `streams` lists of
+            similar size. """
+        relpaths = self._files if relpaths is None else relpaths
+        streams = max(1, min(int(streams), len(relpaths)))
+        batches = [[] for _ in range(streams)]
+        sizes = [0] * streams
+
+        for relpath in sorted(relpaths, key=self._size, reverse=True):
+            smallest = sizes.index(min(sizes))
+            batches[smallest].append(relpath)
+            sizes[smallest] += self._size(relpath)
+        return [batch for batch in batches if batch]
+
+    def _run_batches(self, batches):
+        """ Runs one rsync per batch concurrently and returns their exit
+            statuses. """
+        listfiles = []
+        cmds = []
+        try:
+            for batch in batches:
+                with tempfile.NamedTemporaryFile(
+                        "w", prefix="photopi-", suffix=".files",
+                        delete=False) as listfile:
+                    listfile.write("\n".join(batch) + "\n")
+                listfiles.append(listfile.name)
+                cmds.append(RsyncCmd(os.path.join(self.src, ""), self.dest,
+                                     move=self.move, files_from=listfile.name))
+            return asyncio.run(run_all(cmds))
+        finally:
+            for listfile in listfiles:
+                os.remove(listfile)
+
+    def _native_one(self, relpath):
+        """ Copies or moves one file in process. Returns True on success. """
+        src = os.path.join(self.src, relpath)
+        dest = os.path.join(self.dest, relpath)
+        destdir = os.path.dirname(dest)
+        try:
+            os.makedirs(destdir, exist_ok=True)
+            srcstat = os.stat(src)
+            if self.move and srcstat.st_dev == os.stat(destdir).st_dev:
+                os.replace(src, dest)
+                return True
+
+            tmpname = os.path.join(destdir, ".{}.tmp{}".format(
+                os.path.basename(dest), os.getpid()))
+            try:
+                infd = os.open(src, os.O_RDONLY)
+                try:
+                    outfd = os.open(tmpname,
+                                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                    0o644)
+                    try:
+                        copied = copy_fd(infd, outfd, srcstat.st_size)
+                        os.fsync(outfd)
+                    finally:
+                        os.close(outfd)
+                finally:
+                    os.close(infd)
+
+                if copied != srcstat.st_size or \
+                        os.path.getsize(tmpname) != srcstat.st_size:
+                    raise IOError(errno.EIO, "size mismatch after copy", src)
+                if self.verify and file_digest(src) != file_digest(tmpname):
+                    raise IOError(errno.EIO, "checksum mismatch after copy",
+                                  src)
+                shutil.copystat(src, tmpname)
+                os.replace(tmpname, dest)
+            except BaseException:
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+                raise
+
+            if self.move:
+                os.remove(src)
+            return True
+        except OSError as err:
+            self._log.error("Unable to transfer %s: %s", src, err)
+            return False
+
+    def _run_native(self, relpaths, jobs):
+        """ Transfers `relpaths` on `jobs` threads and returns the set of
+            those which failed. """
+        if not relpaths:
+            return set()
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            results = pool.map(self._native_one, relpaths)
+            return set(relpath for relpath, done in zip(relpaths, results)
+                       if not done)
+
+    def _run_rsync(self, relpaths, streams):
+        """ Transfers `relpaths` over up to `streams` rsyncs and returns the
+            set of those in batches which failed. """
+        if not relpaths:
+            return set()
+        batches = self.batches(streams, relpaths)
+        failed = set()
+        for batch, status in zip(batches, self._run_batches(batches)):
+            if status != 0:
+                self._log.error("rsync exited with %s for %d files", status,
+                                len(batch))
+                failed.update(batch)
+        return failed
+
+    def _run_remote(self, relpaths, streams):
+        """ Pulls `relpaths` from the server of the source over up to
+            `streams` connections, :data:`STREAMS` if not given, and returns
+            the set of those which failed. """
+        if not relpaths:
+            return set()
+        # Imported here, as the client builds on this module.
+        from photopi.client.transfer import STREAMS, ChunkedDownload
+        download = ChunkedDownload(self.remote, self.dest,
+                                   chunk_size=self.chunk_size,
+                                   streams=streams or STREAMS)
+        failed = download.run(relpaths)
+        if self.move:
+            for relpath in relpaths:
+                if relpath in failed:
+                    continue
+                try:
+                    os.remove(os.path.join(self.src, relpath))
+                except OSError as err:
+                    self._log.warning("Unable to remove %s after moving it: "
+                                      "%s", relpath, err)
+        return failed
+
+    def _transfer(self, relpaths, streams):
+        backend = self.backend
+        if backend == "auto" and self.remote is not None:
+            return self._run_remote(relpaths, streams)
+        if backend == "auto" and (is_remote(self.src) or is_remote(self.dest)):
+            backend = "rsync"
+        if backend == "rsync":
+            return self._run_rsync(relpaths, streams or 1)
+
+        failed = self._run_native(relpaths, max(streams or 1, NATIVE_JOBS))
+        if failed and backend == "auto":
+            self._log.warning("Retrying %d files with rsync", len(failed))
+            failed = self._run_rsync(sorted(failed), streams or 1)
+        return failed
+
+    def run(self, streams=None):
+        """ Transfers the files over up to `streams` workers, or the default
+            of the backend, then the markers whose files arrived. Returns True
+            if everything did. """
+        if not len(self):
+            return True
+        if streams:
+            streams = max(1, int(streams))
+        if not is_remote(self.dest):
+            os.makedirs(self.dest, exist_ok=True)
+        self._log.info("Transferring %d files from %s to %s", len(self),
+                       self.src, self.dest)
+
+        # Sizes are taken up front, since a move takes the sources away.
+        sizes = {} if is_remote(self.src) else {
+            relpath: self._size(relpath) for relpath in self._files}
+        with metrics.stage("transfer", backend=self.backend,
+                           move=self.move) as stage:
+            failed = self._transfer(self._files, streams)
+            sent = [relpath for relpath in self._files
+                    if relpath not in failed]
+            stage.add(nbytes=sum(sizes.get(relpath, 0) for relpath in sent),
+                      files=len(sent))
+            stage.ok = not failed
+
+        markers = [marker for marker, marks in self._markers
+                   if marks not in failed]
+        if len(markers) < len(self._markers):
+            self._log.warning("Holding back %d done markers",
+                              len(self._markers) - len(markers))
+        if self._transfer(markers, 1):
+            self._log.error("Unable to transfer %d done markers",
+                            len(markers))
+            return False
+        return not failed
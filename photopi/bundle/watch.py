@@ -0,0 +1,151 @@
+"""
+Change notification for the rolling bundler.
+
+:class:`InotifyWatcher` wakes the bundler as soon as a frame is written to
+one of the watched directories, using the Linux inotify API through
+:mod:`ctypes`. Where inotify is not available, :class:`ScanWatcher` simply
+wakes it at a fixed interval so it rescans. Either way the bundler treats a
+wake up as a hint and always checks the directories themselves.
+
+Both can be woken early with `interrupt()`, from a signal handler or another
+thread, so a bundler being stopped does not sleep out its wait first.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+
+_EVENT = struct.Struct("iIII")
+_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+
+class ScanWatcher:
+    """ Wakes up every `interval` seconds. """
+
+    def __init__(self, interval=30):
+        self._interval = interval
+        self._woken = threading.Event()
+
+    def watch(self, path):
+        """ Nothing to register; every directory is rescanned. """
+
+    def wait(self, timeout=None):
+        """ Sleeps for the scan interval (or `timeout` if shorter), or
+            until interrupted, and reports a change. """
+        delay = self._interval if timeout is None else min(timeout,
+                                                           self._interval)
+        self._woken.wait(delay)
+        self._woken.clear()
+        return True
+
+    def interrupt(self):
+        """ Ends the current or next :meth:`wait` at once. """
+        self._woken.set()
+
+    def close(self):
+        """ Nothing to release. """
+
+
+class InotifyWatcher:
+    """ Wakes up when files are written to, or created in, the watched
+        directories. Raises OSError if inotify is unavailable. """
+
+    def __init__(self):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Written to by interrupt() to end a wait early. The lock is
+        # reentrant as a signal handler may interrupt from within close().
+        self._wakeup = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._wakeup_lock = threading.RLock()
+        self._watches = {}
+
+    def watch(self, path):
+        """ Starts watching directory `path`, if not watched already. """
+        if path in self._watches.values():
+            return
+        wdesc = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), ctypes.c_uint32(_MASK))
+        if wdesc < 0:
+            err = ctypes.get_errno()
+            self._log.warning("Unable to watch %s: %s", path,
+                              os.strerror(err))
+            return
+        self._watches[wdesc] = path
+
+    def wait(self, timeout=None):
+        """ Blocks until a change or `timeout` seconds pass. Returns True if
+            anything changed. """
+        ready, _, _ = select.select([self._fd, self._wakeup[0]], [], [],
+                                    timeout)
+        if self._wakeup[0] in ready:
+            try:
+                while os.read(self._wakeup[0], 512):
+                    pass
+            except BlockingIOError:
+                pass
+        if self._fd not in ready:
+            return False
+
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wdesc, mask, _, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size + length
+            if mask & IN_IGNORED:
+                # The directory is gone; it can be watched again if recreated.
+                self._watches.pop(wdesc, None)
+        return True
+
+    def interrupt(self):
+        """ Ends the current or next :meth:`wait` at once. Safe to call
+            from a signal handler or another thread. """
+        with self._wakeup_lock:
+            if self._wakeup is None:
+                return
+            try:
+                os.write(self._wakeup[1], b"\0")
+            except BlockingIOError:
+                # A wake up is already pending.
+                pass
+
+    def close(self):
+        """ Releases the inotify descriptor. """
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        with self._wakeup_lock:
+            wakeup, self._wakeup = self._wakeup, None
+            for fd in wakeup or ():
+                os.close(fd)
+
+
+def open_watcher(interval=30):
+    """ An :class:`InotifyWatcher`, or a :class:`ScanWatcher` waking every
+        `interval` seconds when inotify cannot be used. """
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError) as err:
+        logging.getLogger(__name__).info(
+            "inotify unavailable (%s), scanning every %ss", err, interval)
+        return ScanWatcher(interval)
@@ -0,0 +1,231 @@
+"""
+A warm camera for taking single photos with low latency.
+
+Starting `raspistill` for every photo pays for opening the camera and
+letting its exposure settle each time, a second or more before the shot.
+A :class:`CaptureService` instead keeps one camera running in signal mode
+(`raspistill -s`) and takes each photo by signalling it, so a photo comes
+back in milliseconds. Photos are taken one at a time; concurrent callers
+wait their turn.
+
+The backend is chosen with `camera_backend` in the config:
+
+- `raspistill` (the default) drives the camera as above.
+- `fake` makes frames of random data in process, for running without a
+  camera.
+
+Photos are written to `capture_dir` (default a temporary directory) before
+being handed back; a directory in memory such as /dev/shm saves a write to
+the SD card.
+
+.. code-block::yaml
+    camera_backend: raspistill
+    camera_quality: 75
+    capture_dir: /dev/shm/photopi
+"""
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from photopi.camera.cmd import RaspistillCmd
+
+BACKENDS = ("raspistill", "fake")
+CAPTURE_NAME = "capture%06d.jpg"
+CAPTURE_TIMEOUT = 10
+START_TIMEOUT = 30
+FAKE_FRAME_SIZE = 64 * 1024
+
+# Printed by a verbose raspistill each time it waits for the next signal.
+_READY_TEXT = "Waiting for SIGUSR1"
+
+_SERVICE = None
+_SERVICE_LOCK = threading.Lock()
+
+
+class CaptureError(RuntimeError):
+    """ Raised when the camera fails to take a photo. """
+    pass
+
+
+class RaspistillBackend:
+    """ A `raspistill` process kept running in signal mode, writing the
+        photos it is signalled for into `workdir`. """
+
+    def __init__(self, workdir, quality=75):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._workdir = workdir
+        self._quality = quality
+        self._cmd = None
+        self._process = None
+        self._ready = threading.Event()
+        self._exited = True
+        self._frame = None
+
+    def _watch(self, process):
+        for line in iter(process.stdout.readline, b""):
+            line = line.decode(errors="replace").rstrip()
+            self._log.debug(line)
+            frame = self._cmd.parse_progress(line)
+            if frame is not None:
+                self._frame = frame
+            elif _READY_TEXT in line:
+                self._ready.set()
+        self._exited = True
+        self._ready.set()
+
+    def start(self):
+        """ Starts the camera and waits until it is ready for a photo. """
+        self._cmd = RaspistillCmd.Signal(path=self._workdir,
+                                         output=CAPTURE_NAME,
+                                         quality=self._quality)
+        self._ready.clear()
+        self._exited = False
+        self._process = self._cmd.spawn(stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        threading.Thread(target=self._watch, args=(self._process,),
+                         daemon=True).start()
+
+        started = time.perf_counter()
+        if not self._ready.wait(START_TIMEOUT) or self._exited:
+            self.close()
+            raise CaptureError("raspistill failed to start")
+        self._log.info("Camera ready in %.2fs", time.perf_counter() - started)
+
+    def shoot(self, timeout):
+        """ Takes a photo and returns the name of its file. The camera is
+            started first if it is not running. """
+        if self._process is None or self._exited:
+            self.start()
+
+        self._ready.clear()
+        self._frame = None
+        self._process.send_signal(signal.SIGUSR1)
+        # The camera reports it is waiting again once the photo is written.
+        if not self._ready.wait(timeout) or self._exited or \
+                self._frame is None:
+            # Restart it for the next photo rather than trust it again.
+            self.close()
+            raise CaptureError("raspistill took no photo within {}s".format(
+                timeout))
+        return os.path.join(self._workdir, CAPTURE_NAME % self._frame)
+
+    def close(self):
+        """ Stops the camera. """
+        process, self._process = self._process, None
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+class FakeBackend:
+    """ Makes photos of `size` bytes of random data in `workdir`, for
+        running without a camera. """
+
+    def __init__(self, workdir, size=FAKE_FRAME_SIZE):
+        self._workdir = workdir
+        self._size = size
+        self._frame = 0
+
+    def start(self):
+        """ Nothing to start. """
+        pass
+
+    def shoot(self, timeout):
+        """ Makes a photo and returns the name of its file. """
+        fname = os.path.join(self._workdir, CAPTURE_NAME % self._frame)
+        self._frame += 1
+        with open(fname, "wb") as stream:
+            stream.write(b"\xff\xd8" + os.urandom(max(0, self._size - 4)) +
+                         b"\xff\xd9")
+        return fname
+
+    def close(self):
+        """ Nothing to stop. """
+        pass
+
+
+class CaptureService:
+    """ Takes photos with one warm camera `backend`, one at a time. """
+
+    def __init__(self, backend):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._backend = backend
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def FromConfig(config):
+        """ A service for the camera backend selected by `config`. Raises
+            ValueError for an unknown `camera_backend`. """
+        name = config['camera_backend'] or "raspistill"
+        if name not in BACKENDS:
+            raise ValueError("Unknown camera backend: {}".format(name))
+
+        workdir = config['capture_dir']
+        if workdir:
+            os.makedirs(workdir, exist_ok=True)
+        else:
+            workdir = tempfile.mkdtemp(prefix="photopi-capture-")
+
+        if name == "fake":
+            return CaptureService(FakeBackend(workdir))
+        return CaptureService(RaspistillBackend(
+            workdir, quality=config['camera_quality'] or 75))
+
+    def start(self):
+        """ Starts the camera ahead of the first photo. """
+        with self._lock:
+            self._backend.start()
+
+    def capture(self, dest=None, timeout=CAPTURE_TIMEOUT):
+        """ Takes a photo and returns its JPEG data. With `dest` the photo is
+            also saved to that file. Raises :class:`CaptureError` if the
+            camera fails. """
+        with self._lock:
+            started = time.perf_counter()
+            fname = self._backend.shoot(timeout)
+            try:
+                with open(fname, "rb") as stream:
+                    data = stream.read()
+                if dest:
+                    shutil.move(fname, dest)
+            finally:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            self._log.debug("Captured %d bytes in %.1fms", len(data),
+                            (time.perf_counter() - started) * 1000)
+        return data
+
+    def close(self):
+        """ Stops the camera. """
+        with self._lock:
+            self._backend.close()
+
+
+def capture_service(config):
+    """ The capture service of this process, created from `config` on first
+        use and shared by every caller after. """
+    global _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _SERVICE = CaptureService.FromConfig(config)
+        return _SERVICE
+
+
+def close_capture_service():
+    """ Stops the camera of the capture service of this process, if there
+        is one. """
+    with _SERVICE_LOCK:
+        if _SERVICE is not None:
+            _SERVICE.close()
@@ -2,6 +2,7 @@
 
 import logging
 import os
+import re
 import time
 
 from subprocess import Popen, PIPE
@@ -9,6 +10,8 @@ from threading import Thread
 
 from photopi.core.cmd import Cmd
 
+_FRAME_PATTERN = re.compile(r'Opening output file .*?(\d+)\.jpg')
+
 
 class RaspistillCmd(Cmd):
     """ Class to manage running a `raspistill` command."""
@@ -40,8 +43,16 @@ class RaspistillCmd(Cmd):
             filestart=filestart)
         return cmd
 
+    @staticmethod
+    def Signal(path, output, quality=75):
+        """ Keep the camera running, taking a photo each time the process is
+            sent SIGUSR1. Verbose output tells when it is ready for the next
+            one. """
+        return RaspistillCmd(path=path, output=output, quality=quality,
+                             verbose=True, signal=True)
+
     def __init__(self, output=None, quality=75, path=None, verbose=False,
-                 timeout=None, interval=None, filestart=None):
+                 timeout=None, interval=None, filestart=None, signal=False):
         Cmd.__init__(self)
 
         self._args = []
@@ -57,6 +68,10 @@ class RaspistillCmd(Cmd):
             self._args += ["-t", str(timeout)]
         if filestart:
             self._args += ["-fs", str(filestart)]
+        if signal:
+            # Run until stopped, in burst mode so the camera stays set up
+            # for capture between photos.
+            self._args += ["-s", "-t", "0", "-bm"]
 
         self._log = logging.getLogger(
             "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
@@ -64,5 +79,10 @@ class RaspistillCmd(Cmd):
     def _arguments(self):
         return self._args
 
+    def parse_progress(self, line):
+        """ Number of the image being written, from verbose output. """
+        match = _FRAME_PATTERN.search(line)
+        return int(match.group(1)) if match else None
+
     def _cmd(self):
         return "raspistill"
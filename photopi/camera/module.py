@@ -3,6 +3,7 @@
 import logging
 import os
 
+from photopi.bundle.lock import CAPTURE, BundleLock
 from photopi.bundle.spec import BundleSpec
 from photopi.camera.cmd import RaspistillCmd
 from photopi.core.borg import Borg
@@ -36,17 +37,40 @@ class CameraModule(Borg):
         else:
             path = config.local_path
 
+        if args['--host']:
+            return self._remote_test(args, config, path)
+
         cmd = RaspistillCmd.Test(path=path)
 
         self._log.info("test image captured")
 
         return cmd.run()
 
+    def _remote_test(self, args, config, path):
+        # Imported here so rpyc is only needed for remote photos.
+        import rpyc
+        from photopi.server.module import DEFAULT_PORT
+
+        port = int(args['--port'] or config['server_port'] or DEFAULT_PORT)
+        conn = rpyc.connect(args['--host'], port)
+        try:
+            data = conn.root.capture()
+        finally:
+            conn.close()
+
+        fname = os.path.join(path, "test.jpg")
+        with open(fname, "wb") as stream:
+            stream.write(data)
+        self._log.info("test image captured by %s", args['--host'])
+        return True
+
     def _continuous(self, args, config):
         # build a bundle for the continuouse shooting.
         bundle = BundleSpec.FromArgsAndConfig(args, config)
+        if not bundle:
+            return False
 
-        lastimage = bundle.last_image_number()
+        lastimage = bundle.snapshot().last_image_number()
         if lastimage == -1:
             leadoff = 0
         else:
@@ -63,6 +87,8 @@ class CameraModule(Borg):
 
         os.makedirs(bundle.path, exist_ok=True)
 
-        return cmd.run()
+        # Keeps `bundle zip orphans` from zipping images as they are shot.
+        with BundleLock.FromConfig(config, bundle, CAPTURE):
+            return cmd.run()
 
 MODULE = ("camera", CameraModule)
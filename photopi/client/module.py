@@ -1,8 +1,58 @@
+import json
+
 import rpyc
 
 from photopi.core.borg import Borg
-from rpyc.utils.server import ThreadedServer
-from threading import Thread
+from photopi.server.module import DEFAULT_PORT
+
+# Seconds to wait for a reply, long enough for a chunk over a slow link.
+REQUEST_TIMEOUT = 120
+
+
+class RemoteNode:
+    """ Storage node `node` of the photopi server at `host`:`port`. """
+
+    def __init__(self, host, port=None, node="local"):
+        self.host = host
+        self.port = int(port or DEFAULT_PORT)
+        self.node = node
+
+    def __str__(self):
+        return "{}:{}/{}".format(self.host, self.port, self.node)
+
+    @staticmethod
+    def FromConfig(config, name):
+        """ The server of storage node `name` given by `node_servers` in
+            `config`, or None when the node is not served. """
+        served = (config['node_servers'] or {}).get(name)
+        if not served:
+            return None
+        return RemoteNode(served['host'], port=served.get('port'),
+                          node=served.get('node') or "local")
+
+    def connect(self):
+        """ A new connection to the server. """
+        return rpyc.connect(self.host, self.port, keepalive=True,
+                            config={"sync_request_timeout": REQUEST_TIMEOUT})
+
+    def _call(self, method, *args):
+        conn = self.connect()
+        try:
+            return getattr(conn.root, method)(*args)
+        finally:
+            conn.close()
+
+    def inventory(self, device=None, label=None):
+        """ Inventory of the bundles on the node, in one round trip (see
+            :func:`photopi.bundle.inventory.node_inventory`). """
+        return json.loads(self._call("inventory", self.node, device, label))
+
+    def diff(self, have, device=None, label=None):
+        """ Paths below the node of the files missing from `have`, a dict of
+            relative path to size, or held there with another size. """
+        return list(self._call("diff", self.node, tuple(sorted(have.items())),
+                               device, label))
+
 
 class ClientModule(Borg):
     def __init__(self):
@@ -18,5 +68,11 @@ class ClientModule(Borg):
             args[args['--action']] = True
             print(c.raspistill(args))
 
+        if args['--module'] == "bundle":
+            node = RemoteNode(args['--host'], args['--port'],
+                              args['--node'] or "local")
+            print(json.dumps(node.inventory(args['--device'], args['--label']),
+                             indent=1, sort_keys=True))
+
 def get_module():
     return ClientModule()
@@ -0,0 +1,296 @@
+"""
+Chunked, resumable downloads from a photopi server.
+
+Files are pulled in chunks of `transfer_chunk_size` (default 1 MiB) over
+several connections at once, each chunk checked against the sha256 digest
+the server read it with. A file is assembled in `.<name>.part` beside its
+destination, with the digests of the chunks received so far checkpointed
+in `.<name>.part.json`. An interrupted download therefore resumes from the
+chunks already on disk, after checking them against the checkpoint, rather
+than from zero. Once every chunk arrived the digest of the whole file is
+compared with the server's before the file is renamed into place.
+
+.. code-block::yaml
+    transfer_chunk_size: 1M
+"""
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from photopi.bundle.transfer import file_digest
+
+CHUNK_SIZE = 1024 * 1024
+STREAMS = 4
+RETRIES = 5
+_BACKOFF_SECS = 0.5
+_UNREACHABLE = (errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EHOSTDOWN)
+
+
+def _link_failed(err):
+    """ Whether `err` is a failure of the link, worth reconnecting for, as
+        opposed to an error the server raised, which comes back as its own
+        type. """
+    return isinstance(err, (ConnectionError, TimeoutError, EOFError)) or \
+        getattr(err, "errno", None) in _UNREACHABLE
+
+
+class ChunkError(IOError):
+    """ Raised when a chunk arrives damaged. """
+    pass
+
+
+class PartialFile:
+    """ Download in progress of a file of `size` bytes, last modified at
+        `mtime` (ns) on the server, to `dest` in chunks of `chunk_size`. """
+
+    def __init__(self, relpath, dest, size, mtime, chunk_size):
+        self.relpath = relpath
+        self.dest = dest
+        self.size = size
+        self.mtime = mtime
+        self.chunk_size = chunk_size
+        dirname, name = os.path.split(dest)
+        self.partname = os.path.join(dirname, ".{}.part".format(name))
+        self.checkpoint = self.partname + ".json"
+        self.digests = {}
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return self.relpath
+
+    @property
+    def chunks(self):
+        """ Number of chunks in the file. """
+        return max(1, -(-self.size // self.chunk_size))
+
+    def extent(self, index):
+        """ (offset, length) of chunk `index`. """
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def _matches(self, state):
+        return (state.get("size"), state.get("mtime"), state.get("chunk")) == \
+            (self.size, self.mtime, self.chunk_size)
+
+    def resume(self):
+        """ Opens the partial file, keeping the chunks of an earlier attempt
+            which still match their checkpointed digests, and returns the
+            indices of the chunks still to fetch. """
+        try:
+            with open(self.checkpoint, "r") as stream:
+                state = json.load(stream)
+        except (FileNotFoundError, ValueError):
+            state = {}
+
+        os.makedirs(os.path.dirname(self.dest), exist_ok=True)
+        if not self._matches(state) or not os.path.isfile(self.partname):
+            # The source changed, or nothing usable was kept; start over.
+            state = {}
+            with open(self.partname, "wb"):
+                pass
+        os.truncate(self.partname, self.size)
+
+        with open(self.partname, "rb") as stream:
+            for index, digest in (state.get("chunks") or {}).items():
+                offset, length = self.extent(int(index))
+                stream.seek(offset)
+                if hashlib.sha256(stream.read(length)).hexdigest() == digest:
+                    self.digests[int(index)] = digest
+        self._save()
+        return [index for index in range(self.chunks)
+                if index not in self.digests]
+
+    def _save(self):
+        tmpname = "{}.tmp{}".format(self.checkpoint, os.getpid())
+        with open(tmpname, "w") as stream:
+            json.dump({"size": self.size, "mtime": self.mtime,
+                       "chunk": self.chunk_size,
+                       "chunks": {str(index): digest for index, digest
+                                  in sorted(self.digests.items())}}, stream)
+        os.replace(tmpname, self.checkpoint)
+
+    def write(self, index, data, digest):
+        """ Writes chunk `index` once `data` matches `digest`. Returns True
+            when that completes the file. """
+        offset, length = self.extent(index)
+        if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+            raise ChunkError("chunk {} of {} arrived damaged".format(
+                index, self.relpath))
+        fd = os.open(self.partname, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+        with self.lock:
+            self.digests[index] = digest
+            self._save()
+            return len(self.digests) == self.chunks
+
+    def finish(self, digest):
+        """ Moves the completed file into place if it matches the server's
+            whole-file `digest`, otherwise discards it. Returns True if it
+            matched. """
+        if file_digest(self.partname) != digest:
+            self.discard()
+            return False
+        os.utime(self.partname, ns=(self.mtime, self.mtime))
+        os.replace(self.partname, self.dest)
+        os.remove(self.checkpoint)
+        return True
+
+    def discard(self):
+        """ Removes the partial file and its checkpoint. """
+        for fname in (self.partname, self.checkpoint):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+class ChunkedDownload:
+    """ Pulls files below storage node `remote` (a
+        :class:`photopi.client.module.RemoteNode`) into directory `dest` over
+        up to `streams` connections. """
+
+    def __init__(self, remote, dest, chunk_size=None, streams=STREAMS,
+                 retries=RETRIES):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._remote = remote
+        self._dest = dest
+        self._chunk_size = int(chunk_size or CHUNK_SIZE)
+        self._streams = max(1, int(streams))
+        self._retries = retries
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+
+    def _root(self):
+        """ The service on this thread's own connection to the server. """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            conn = self._remote.connect()
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn.root
+
+    def _reset(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except (OSError, EOFError):
+                pass
+
+    def _call(self, method, *args):
+        """ Calls `method` of the service, reconnecting and retrying with
+            backoff when the link fails. """
+        for attempt in range(self._retries + 1):
+            try:
+                return getattr(self._root(), method)(*args)
+            except (OSError, EOFError) as err:
+                if not _link_failed(err):
+                    raise
+                self._reset()
+                if attempt == self._retries:
+                    raise
+                self._log.warning("%s failed, retrying: %s", method, err)
+                time.sleep(_BACKOFF_SECS * 2 ** attempt)
+
+    def _fetch_chunk(self, partial, index):
+        if partial.failed:
+            return
+        offset, length = partial.extent(index)
+        for attempt in range(self._retries + 1):
+            try:
+                data, digest = self._call("read", self._remote.node,
+                                          partial.relpath, offset, length)
+                if not partial.write(index, data, digest):
+                    return
+                break
+            except ChunkError as err:
+                if attempt == self._retries:
+                    self._log.error("Giving up on %s: %s", partial, err)
+                    partial.failed = True
+                    return
+                self._log.warning("%s, fetching it again", err)
+            except (OSError, EOFError, ValueError) as err:
+                self._log.error("Unable to fetch %s: %s", partial, err)
+                partial.failed = True
+                return
+
+        digest = self._call("digest", self._remote.node, partial.relpath)
+        if not partial.finish(digest):
+            self._log.error("%s failed its whole-file digest check",
+                            partial)
+            partial.failed = True
+
+    def run(self, relpaths):
+        """ Downloads `relpaths`, relative to the node, to the same paths
+            below the destination. Returns the set of those which failed;
+            their verified chunks are kept for the next attempt. """
+        if not relpaths:
+            return set()
+        failed = set()
+        try:
+            stats = self._call("stat", self._remote.node, tuple(relpaths))
+        except (OSError, EOFError, ValueError) as err:
+            self._log.error("Unable to reach %s: %s", self._remote, err)
+            return set(relpaths)
+
+        tasks = []
+        partials = []
+        for relpath, stat in zip(relpaths, stats):
+            if stat is None:
+                self._log.error("%s is missing from %s", relpath,
+                                self._remote)
+                failed.add(relpath)
+                continue
+            partial = PartialFile(relpath, os.path.join(self._dest, relpath),
+                                  stat[0], stat[1], self._chunk_size)
+            missing = partial.resume()
+            if len(missing) < partial.chunks:
+                self._log.info("Resuming %s with %d of %d chunks", relpath,
+                               partial.chunks - len(missing), partial.chunks)
+            partials.append(partial)
+            tasks += [(partial, index) for index in missing]
+            if not missing:
+                # Complete but unconfirmed: check it like any other.
+                tasks.append((partial, None))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self._streams) as pool:
+                for future in [pool.submit(self._task, partial, index)
+                               for partial, index in tasks]:
+                    future.result()
+        finally:
+            with self._conns_lock:
+                for conn in self._conns:
+                    try:
+                        conn.close()
+                    except (OSError, EOFError):
+                        pass
+                del self._conns[:]
+
+        failed.update(partial.relpath for partial in partials
+                      if partial.failed or os.path.exists(partial.partname))
+        return failed
+
+    def _task(self, partial, index):
+        try:
+            if index is None:
+                digest = self._call("digest", self._remote.node,
+                                    partial.relpath)
+                if not partial.finish(digest):
+                    partial.failed = True
+                return
+            self._fetch_chunk(partial, index)
+        except (OSError, EOFError, ValueError) as err:
+            self._log.error("Unable to fetch %s: %s", partial, err)
+            partial.failed = True
@@ -1,9 +1,59 @@
+import asyncio
 import logging
 import os
+import re
 from subprocess import Popen, PIPE
 from threading import Thread
 
+from photopi.core import metrics
+
+_LINE_SPLIT = re.compile(rb'[\r\n]')
+_PERCENT_PATTERN = re.compile(r'(\d+)%')
+
+
+async def _read_lines(stream, callback):
+    """ Feeds each line of `stream` to `callback`. Progress meters redraw
+        with carriage returns, so those end a line as well. """
+    pending = b""
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            break
+        lines = _LINE_SPLIT.split(pending + chunk)
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                callback(line.decode(errors="replace"))
+    if pending:
+        callback(pending.decode(errors="replace"))
+
+
+async def run_all(cmds, limit=None, timeout=None):
+    """ Runs `cmds` concurrently, at most `limit` at a time, and returns
+        their exit statuses in order. """
+    semaphore = asyncio.Semaphore(limit or len(cmds) or 1)
+
+    async def _run(cmd):
+        async with semaphore:
+            return await cmd.run_async(timeout=timeout)
+    return await asyncio.gather(*[_run(cmd) for cmd in cmds])
+
+
+def log_progress(log, name, step=10):
+    """ Progress callback logging `name` each time it passes another `step`
+        percent. """
+    state = {"last": None}
+
+    def _progress(value):
+        if state["last"] is None or value >= state["last"] + step:
+            state["last"] = value - value % step
+            log.info("%s: %d%%", name, value)
+    return _progress
+
 class Cmd(Thread):
+    # Metrics stage (see photopi.core.metrics) runs are recorded under.
+    stage = None
+
     def __init__(self):
         Thread.__init__(self)
         self._process = None
@@ -24,25 +74,104 @@ class Cmd(Thread):
     def _arguments(self):
         raise NotImplementedError("Please implement this method")
 
-    def run(self):
+    def spawn(self, stdin=None, stdout=None, stderr=None):
+        """ Starts the command without waiting for it and returns the process.
+            Pass `stdin=PIPE` to feed it input, or `stdout=PIPE` to read its
+            output. """
+        cmd = self._arguments()
+        cmd.insert(0, self._cmd())
+        self._process = Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+        return self._process
+
+    def parse_progress(self, line):
+        """ Progress reported by a line of output, or None. Commands which
+            report progress override this. """
+        return None
+
+    def produced(self):
+        """ (bytes, files) the finished command produced, for metrics. """
+        return 0, 0
+
+    def _stage(self):
+        return metrics.stage(self.stage, cmd=self._cmd())
+
+    def _count(self, stage):
+        nbytes, files = self.produced()
+        stage.add(nbytes=nbytes, files=files)
+        stage.ok = self.returncode == 0
+
+    async def run_async(self, timeout=None, progress=None, capture=False):
+        """ Runs the command on the event loop and returns its exit status.
+            With `progress`, output is parsed line by line and `progress` is
+            called with every value :meth:`parse_progress` finds; with
+            `capture`, output is kept in `output` and `err`. The command is
+            killed when `timeout` seconds pass (raising TimeoutError) or the
+            awaiting task is cancelled. """
         cmd = self._arguments()
         cmd.insert(0, self._cmd())
-        self._process = Popen(cmd)
-        self.stdout = self._process.stdout
-        self.output, self.err = self._process.communicate()
-        self.returncode = self._process.returncode
+        piped = PIPE if progress or capture else None
+        self._process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=piped, stderr=piped)
+
+        captured = {"stdout": [], "stderr": []}
+
+        def _reader(name):
+            def _line(line):
+                if capture:
+                    captured[name].append(line)
+                if progress:
+                    value = self.parse_progress(line)
+                    if value is not None:
+                        progress(value)
+            return _read_lines(getattr(self._process, name), _line)
+
+        waits = [self._process.wait()]
+        if piped:
+            waits += [_reader("stdout"), _reader("stderr")]
+        with self._stage() as stage:
+            try:
+                await asyncio.wait_for(asyncio.gather(*waits), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                if self._process.returncode is None:
+                    self._process.kill()
+                    await self._process.wait()
+                raise
+            finally:
+                if capture:
+                    self.output = "\n".join(captured["stdout"])
+                    self.err = "\n".join(captured["stderr"])
+                self.returncode = self._process.returncode
+            self._count(stage)
+        return self.returncode
+
+    def call(self, timeout=None, progress=None, capture=False):
+        """ Runs the command to completion from synchronous code and returns
+            its exit status. See :meth:`run_async`. """
+        return asyncio.run(self.run_async(timeout=timeout, progress=progress,
+                                          capture=capture))
+
+    def run(self):
+        with self._stage() as stage:
+            self.spawn()
+            self.stdout = self._process.stdout
+            self.output, self.err = self._process.communicate()
+            self.returncode = self._process.returncode
+            self._count(stage)
 
 class RsyncCmd(Cmd):
     def Move(src, dest):
         return RsyncCmd(src, dest, move=True)
 
-    def __init__(self, src, dest, move=False):
+    def __init__(self, src, dest, move=False, files_from=None):
         Cmd.__init__(self)
         self._src = src
         self._dest = dest
         self._args = ["-rvh", "--progress"]
         if move:
             self._args.append("--remove-source-files")
+        if files_from:
+            # Paths in the list are relative to `src`.
+            self._args.append("--files-from={}".format(files_from))
 
         self._args.append(src)
         self._args.append(dest)
@@ -56,3 +185,8 @@ class RsyncCmd(Cmd):
         return self._args
     def _cmd(self):
         return "rsync"
+
+    def parse_progress(self, line):
+        """ Percentage of the current file from an rsync `--progress` line. """
+        match = _PERCENT_PATTERN.search(line)
+        return int(match.group(1)) if match else None
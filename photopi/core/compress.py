@@ -0,0 +1,151 @@
+"""
+Parallel block compression.
+
+The writers in this module split the incoming stream into fixed-size blocks
+and compress each block as an independent member (a gzip member or a zstd
+frame) on a worker pool. The members are written in order, so the output is
+a standard multi-member file that `gzip`/`zstd`, `tar` and :mod:`tarfile`
+read without modification.
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCKSIZE = 1024 * 1024
+
+def default_jobs(jobs=None):
+    """ Number of compression workers to use for `jobs` (None for all cores). """
+    if jobs:
+        return max(1, int(jobs))
+    return os.cpu_count() or 1
+
+def gzip_member(block, level=6):
+    """ Compress `block` as a single, self-contained gzip member. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+class ParallelBlockWriter:
+    """
+    File-like object which compresses everything written to it on a pool of
+    `jobs` workers and writes the compressed blocks to `fileobj`.
+
+    zlib and zstd release the GIL while compressing, so a thread pool is
+    enough to keep every core busy without copying blocks between processes.
+    """
+
+    def __init__(self, fileobj, jobs=None, blocksize=BLOCKSIZE, level=None):
+        self._fileobj = fileobj
+        self._blocksize = blocksize
+        self._level = level
+        self._jobs = default_jobs(jobs)
+        self._pool = ThreadPoolExecutor(max_workers=self._jobs)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._uoffset = 0
+        self._coffset = 0
+        self.access_points = []
+        self.closed = False
+        self.compress_seconds = 0.0
+        self._timing_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, trace):
+        self.close()
+
+    def _compress(self, block):
+        raise NotImplementedError("Please implement this method")
+
+    def _timed_compress(self, block):
+        started = time.perf_counter()
+        data = self._compress(block)
+        with self._timing_lock:
+            self.compress_seconds += time.perf_counter() - started
+        return data
+
+    @property
+    def bytes_in(self):
+        """ Bytes handed to the compressor so far. """
+        return self._uoffset + len(self._buffer)
+
+    @property
+    def bytes_out(self):
+        """ Compressed bytes written so far. """
+        return self._coffset
+
+    def write(self, data):
+        """ Buffer `data` and hand full blocks to the workers. """
+        self._buffer += data
+        while len(self._buffer) >= self._blocksize:
+            self._submit(bytes(self._buffer[:self._blocksize]))
+            del self._buffer[:self._blocksize]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(
+            (self._uoffset, self._pool.submit(self._timed_compress, block)))
+        self._uoffset += len(block)
+
+        # Bound the memory held by in-flight blocks.
+        while len(self._pending) > self._jobs * 2:
+            self._drain_one()
+
+    def _drain_one(self):
+        uoffset, future = self._pending.popleft()
+        data = future.result()
+        # Every block starts a new member, so decompression can begin there.
+        self.access_points.append((uoffset, self._coffset))
+        self._fileobj.write(data)
+        self._coffset += len(data)
+
+    def flush(self):
+        """ Compress any buffered data and write all pending blocks. """
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._drain_one()
+        self._fileobj.flush()
+
+    def close(self):
+        """ Flush remaining data and shut the worker pool down. """
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
+            self.closed = True
+
+class ParallelGzipWriter(ParallelBlockWriter):
+    """ Writes a multi-member gzip stream, one member per block. """
+
+    def __init__(self, fileobj, jobs=None, blocksize=BLOCKSIZE, level=6):
+        ParallelBlockWriter.__init__(self, fileobj, jobs=jobs,
+                                     blocksize=blocksize, level=level)
+
+    def _compress(self, block):
+        return gzip_member(block, self._level)
+
+class ParallelZstdWriter(ParallelBlockWriter):
+    """ Writes a zstd stream of independent frames, one frame per block. """
+
+    def __init__(self, fileobj, jobs=None, blocksize=BLOCKSIZE, level=1):
+        if zstandard is None:
+            raise RuntimeError(
+                "zstd archives require the 'zstandard' package")
+        ParallelBlockWriter.__init__(self, fileobj, jobs=jobs,
+                                     blocksize=blocksize, level=level)
+
+    def _compress(self, block):
+        # Compressor objects are not thread safe, so each block gets its own.
+        return zstandard.ZstdCompressor(level=self._level).compress(block)
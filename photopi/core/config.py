@@ -2,9 +2,11 @@
 Classes and routines for loading configuration for the application.
 See :class:`Configuration` for more information.
 """
+import hashlib
+import json
 import logging
 import os
-import yaml
+import time
 
 class ConfigNotFoundError(RuntimeError):
     """ Raised Error when a configuration file cannot be found. """
@@ -19,6 +21,22 @@ class InvalidConfigError(RuntimeError):
 _CONFIG_LOCATIONS = ['photopi.yaml', os.path.expanduser('~/.photopi.yaml'),
                      os.path.join('/etc', 'photopi.yaml')]
 
+# Parsed configs by absolute path: ((mtime_ns, size), config).
+_PARSED = {}
+# A file changed this recently may change again within its mtime tick.
+_RACY_NS = 2 * 1000 * 1000 * 1000
+
+
+def _cache_dir():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                        os.path.join(os.path.expanduser("~"), ".cache"),
+                        "photopi")
+
+
+def _cache_filename(path):
+    return os.path.join(_cache_dir(), "config-{}.json".format(
+        hashlib.sha1(path.encode()).hexdigest()[:16]))
+
 class Configuration():
     """
     This class represents configuration loaded from a local file or other
@@ -32,6 +50,10 @@ class Configuration():
     The first file found wins. This library simply loads the configuration
     from the file and presents it to the client as a dictionary.
 
+    Parsed configs are cached, in the process and as JSON in
+    ~/.cache/photopi, keyed by the path, mtime and size of their file, so a
+    file is only parsed again once it changes.
+
     .. code-block::yaml
         device_name: pp1
 
@@ -44,22 +66,80 @@ class Configuration():
         """
         self.log = logging.getLogger(
             "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        # Absolute path of the file the config was loaded from.
+        self.path = None
         self._config = self._get_config(config_path)
         self._validate_config()
 
     def _get_config(self, config_path=None):
         if config_path:
-            return self._read_config_file(config_path)
+            return self._cached_config_file(config_path)
         else:
             for conffile in _CONFIG_LOCATIONS:
                 try:
-                    return self._read_config_file(conffile)
+                    return self._cached_config_file(conffile)
                 except ConfigNotFoundError:
                     pass
         raise ConfigNotFoundError(
             "No configuration files could be found in any of: {}".format(
                 ', '.join(_CONFIG_LOCATIONS)))
 
+    def _cached_config_file(self, filename):
+        """ Config in `filename`, parsed once per version of the file. """
+        path = os.path.abspath(filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise ConfigNotFoundError(
+                "Configuration file {} was not found".format(filename))
+        key = (stat.st_mtime_ns, stat.st_size)
+        self.path = path
+
+        cached = _PARSED.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        config = self._load_cached(path, key)
+        if config is None:
+            config = self._read_config_file(path)
+            if time.time_ns() - stat.st_mtime_ns < _RACY_NS:
+                # Too fresh to trust the mtime; parse it again next time.
+                return config
+            self._store_cached(path, key, config)
+        _PARSED[path] = (key, config)
+        return config
+
+    def _load_cached(self, path, key):
+        try:
+            with open(_cache_filename(path), "r") as stream:
+                cached = json.load(stream)
+        except (IOError, ValueError):
+            return None
+        if cached.get("path") != path or cached.get("key") != list(key):
+            return None
+        return cached.get("config")
+
+    def _store_cached(self, path, key, config):
+        fname = _cache_filename(path)
+        tmpname = "{}.tmp{}".format(fname, os.getpid())
+        try:
+            # Configs holding values JSON cannot represent, such as dates,
+            # or keys it would turn into strings, are parsed every time.
+            data = json.dumps({"path": path, "key": list(key),
+                               "config": config})
+            if json.loads(data)["config"] != config:
+                raise ValueError("config does not survive JSON")
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with open(tmpname, "w") as stream:
+                stream.write(data)
+            os.replace(tmpname, fname)
+        except (TypeError, ValueError) as err:
+            self.log.debug("Not caching %s: %s", path, err)
+        except OSError as err:
+            self.log.debug("Unable to cache %s: %s", path, err)
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
     def _validate_config(self):
         verifypaths = [
             "device_id",
@@ -82,9 +162,13 @@ class Configuration():
     @staticmethod
     def _read_config_file(filename):
         "Read a config file and raise a ConfigNotFoundError if not found"
+        # Imported here, as a cached config needs no parser at all.
+        import yaml
+        # The libyaml parser is many times faster than the pure Python one.
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
         try:
             with open(filename, 'r') as config:
-                return yaml.load(config)
+                return yaml.load(config, Loader=loader)
         except IOError:
             raise ConfigNotFoundError(
                 "Configuration file {} was not found".format(
@@ -0,0 +1,259 @@
+"""
+Per-stage performance metrics.
+
+Commands time each of their stages (scan, fragment, tar, compress, transfer,
+expand, encode) with :func:`stage`, counting the bytes and files the stage
+processed. Stages are kept for the life of the process and written out by
+:func:`flush` once the command finishes:
+
+- appended as JSON lines to `metrics_log`, one line per stage, and
+- written as a Prometheus textfile, `photopi_<command>.prom` in
+  `metrics_textfile_dir`, for node_exporter's textfile collector. The
+  textfile holds the totals per stage of the last run of the command.
+
+Both are optional; without them stages are only logged as they finish.
+
+Where several commands run in one process, as under `photopi run`, each
+collects its stages in its own :func:`scope`. Work a command hands to
+another thread is wrapped with :func:`in_scope` to be counted with it.
+
+.. code-block::yaml
+    metrics_log: /var/log/photopi/metrics.jsonl
+    metrics_textfile_dir: /var/lib/node_exporter/textfile_collector
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+_RECORDS = []
+_RECORDS_LOCK = threading.Lock()
+_SCOPE = contextvars.ContextVar("photopi_metrics_scope", default=None)
+_UNSAFE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def human_bytes(nbytes):
+    """ `nbytes` as a short human readable size. """
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(nbytes) < 1024:
+            return "{:.1f} {}".format(nbytes, unit)
+        nbytes /= 1024.0
+    return "{:.1f} TiB".format(nbytes)
+
+
+class StageTimer:
+    """ Counts the work done by a running stage. Set `ok` to False for a
+        stage which failed without raising. """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.nbytes = 0
+        self.files = 0
+        self.ok = True
+
+    def add(self, nbytes=0, files=0):
+        """ Counts `nbytes` and `files` more processed by the stage. """
+        self.nbytes += nbytes
+        self.files += files
+
+
+def record(name, seconds, nbytes=0, files=0, ok=True, **labels):
+    """ Records a finished stage `name` which took `seconds` and returns the
+        record. Extra `labels` describe what the stage worked on. """
+    entry = {
+        "stage": name,
+        "started": round(time.time() - seconds, 3),
+        "seconds": round(seconds, 6),
+        "bytes": nbytes,
+        "files": files,
+        "throughput": round(nbytes / seconds, 1) if seconds > 0 else 0.0,
+        "ok": ok,
+    }
+    entry.update(labels)
+    scope = _SCOPE.get()
+    with _RECORDS_LOCK:
+        (_RECORDS if scope is None else scope).append(entry)
+
+    logging.getLogger(__name__).info(
+        "%s%s: %.2fs, %d files, %s (%s/s)%s", name,
+        "".join(" {}={}".format(key, value)
+                for key, value in sorted(labels.items())),
+        seconds, files, human_bytes(nbytes), human_bytes(entry["throughput"]),
+        "" if ok else ", failed")
+    return entry
+
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    """ Times stage `name` of the running command and yields a
+        :class:`StageTimer` to count its bytes and files on. The stage is
+        recorded as failed if it raises. With a `name` of None nothing is
+        recorded. """
+    timer = StageTimer(name, labels)
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield timer
+        ok = True
+    finally:
+        if name is not None:
+            record(name, time.perf_counter() - started, timer.nbytes,
+                   timer.files, ok=ok and timer.ok, **labels)
+
+
+@contextlib.contextmanager
+def scope():
+    """ Collects the stages recorded by this thread, and by work it wraps
+        with :func:`in_scope`, into the list yielded instead of the
+        process wide records. """
+    entries = []
+    token = _SCOPE.set(entries)
+    try:
+        yield entries
+    finally:
+        _SCOPE.reset(token)
+
+
+def in_scope(func):
+    """ `func` wrapped to record its stages into the caller's :func:`scope`
+        when run on another thread, e.g. by a pool. """
+    entries = _SCOPE.get()
+
+    def _run(*args, **kwargs):
+        token = _SCOPE.set(entries)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _SCOPE.reset(token)
+    return _run
+
+
+def records():
+    """ Copy of the stages recorded so far. """
+    with _RECORDS_LOCK:
+        return list(_RECORDS)
+
+
+def reset():
+    """ Forgets the stages recorded so far and returns them. """
+    with _RECORDS_LOCK:
+        taken = list(_RECORDS)
+        del _RECORDS[:]
+    return taken
+
+
+def _prom_labels(labels):
+    return ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\")
+                                     .replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+
+def prometheus_text(command, entries, seconds=None, ok=True, now=None):
+    """ Prometheus exposition text of the stage totals in `entries` for a
+        run of `command` which took `seconds`. """
+    totals = {}
+    for entry in entries:
+        total = totals.setdefault(entry["stage"], {
+            "seconds": 0.0, "bytes": 0, "files": 0, "runs": 0, "failures": 0})
+        total["seconds"] = round(total["seconds"] + entry["seconds"], 6)
+        total["bytes"] += entry["bytes"]
+        total["files"] += entry["files"]
+        total["runs"] += 1
+        total["failures"] += 0 if entry["ok"] else 1
+
+    gauges = [
+        ("stage_seconds", "Seconds spent in the stage", "seconds"),
+        ("stage_bytes", "Bytes processed by the stage", "bytes"),
+        ("stage_files", "Files processed by the stage", "files"),
+        ("stage_runs", "Times the stage ran", "runs"),
+        ("stage_failures", "Times the stage failed", "failures"),
+    ]
+    lines = []
+    for metric, helptext, field in gauges:
+        lines.append("# HELP photopi_{} {} in the last run.".format(
+            metric, helptext))
+        lines.append("# TYPE photopi_{} gauge".format(metric))
+        for name in sorted(totals):
+            lines.append("photopi_{}{{{}}} {}".format(
+                metric, _prom_labels({"command": command, "stage": name}),
+                totals[name][field]))
+
+    lines.append("# HELP photopi_stage_throughput_bytes_per_second Bytes "
+                 "per second through the stage in the last run.")
+    lines.append("# TYPE photopi_stage_throughput_bytes_per_second gauge")
+    for name in sorted(totals):
+        total = totals[name]
+        rate = total["bytes"] / total["seconds"] if total["seconds"] else 0
+        lines.append("photopi_stage_throughput_bytes_per_second{{{}}} "
+                     "{:.1f}".format(_prom_labels({"command": command,
+                                                   "stage": name}), rate))
+
+    labels = _prom_labels({"command": command})
+    if seconds is not None:
+        lines.append("# HELP photopi_command_seconds Duration of the last "
+                     "run of the command.")
+        lines.append("# TYPE photopi_command_seconds gauge")
+        lines.append("photopi_command_seconds{{{}}} {:.6f}".format(labels,
+                                                                   seconds))
+    lines.append("# HELP photopi_command_success Whether the last run of "
+                 "the command succeeded.")
+    lines.append("# TYPE photopi_command_success gauge")
+    lines.append("photopi_command_success{{{}}} {}".format(labels,
+                                                           1 if ok else 0))
+    lines.append("# HELP photopi_command_last_run_timestamp_seconds When the "
+                 "command last finished.")
+    lines.append("# TYPE photopi_command_last_run_timestamp_seconds gauge")
+    lines.append("photopi_command_last_run_timestamp_seconds{{{}}} "
+                 "{:.3f}".format(labels, now if now is not None
+                                 else time.time()))
+    return "\n".join(lines) + "\n"
+
+
+def textfile_name(directory, command):
+    """ Path of the Prometheus textfile for `command` in `directory`. """
+    return os.path.join(directory, "photopi_{}.prom".format(
+        _UNSAFE.sub("_", command)))
+
+
+def flush(config, command, seconds=None, ok=True, entries=None):
+    """ Writes the stages recorded by `command`, those collected in
+        `entries` along with any recorded outside a scope, to the metrics
+        log and textfile configured in `config`, then forgets them. Returns
+        the records written. """
+    log = logging.getLogger(__name__)
+    entries = list(entries or []) + reset()
+    if config is None:
+        return entries
+
+    logname = config['metrics_log']
+    if logname and entries:
+        host = socket.gethostname()
+        try:
+            with open(logname, "a") as stream:
+                for entry in entries:
+                    stream.write(json.dumps(dict(
+                        entry, command=command, host=host,
+                        device=config.device_id), sort_keys=True) + "\n")
+        except IOError as err:
+            log.warning("Unable to write metrics to %s: %s", logname, err)
+
+    textdir = config['metrics_textfile_dir']
+    if textdir:
+        fname = textfile_name(textdir, command)
+        # node_exporter may read at any time, so replace the file whole.
+        tmpname = "{}.tmp{}".format(fname, os.getpid())
+        try:
+            with open(tmpname, "w") as stream:
+                stream.write(prometheus_text(command, entries, seconds, ok))
+            os.replace(tmpname, fname)
+        except IOError as err:
+            log.warning("Unable to write metrics to %s: %s", fname, err)
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+    return entries
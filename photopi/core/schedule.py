@@ -0,0 +1,302 @@
+"""
+Scheduled workflows for the `photopi run` daemon.
+
+A workflow in the config runs on a schedule when it has a `schedule` entry,
+either a fixed interval or a cron expression (minute, hour, day of month,
+month, day of week):
+
+.. code-block::yaml
+    workflows:
+      zip:
+        module: bundle
+        action: zip
+        args: {orphans: true, --node: local}
+        schedule: {every: 10m}
+      fetch:
+        module: bundle
+        action: fetch
+        args: {--src: pp1, --done: true, --move: true}
+        schedule: {cron: "*/30 6-20 * * *"}
+
+Workflows run on a pool of threads in the daemon's process, so the bundle
+catalogs and other per-process state stay warm between runs. A workflow
+still running when it is next due is skipped for that turn rather than run
+twice at once.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import os
+import re
+import threading
+
+POLL_SECS = 30
+
+_INTERVAL_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)([smhd]?)$')
+_INTERVAL_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# (lowest, highest) of each cron field.
+_CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+_CRON_SEARCH_DAYS = 5 * 366
+
+_SHUTDOWN = threading.Event()
+
+
+def shutdown_event():
+    """ Event set once the scheduler of this process is stopping, for
+        workflows which run until stopped, such as `bundle watch`, to
+        finish with it. """
+    return _SHUTDOWN
+
+
+def parse_interval(interval):
+    """ Seconds in an interval such as `90`, `10m`, `2h` or `30d`. """
+    match = _INTERVAL_PATTERN.match(str(interval).strip())
+    if match is None:
+        raise ValueError("Invalid interval: {}".format(interval))
+    return float(match.group(1)) * _INTERVAL_UNITS[match.group(2)]
+
+
+class IntervalTrigger:
+    """ Fires every `interval`, given in seconds or as e.g. `10m`. """
+
+    def __init__(self, interval):
+        self.seconds = parse_interval(interval)
+        if self.seconds <= 0:
+            raise ValueError("Invalid interval: {}".format(interval))
+
+    def __eq__(self, other):
+        return isinstance(other, IntervalTrigger) and \
+            other.seconds == self.seconds
+
+    def __str__(self):
+        return "every {}s".format(self.seconds)
+
+    def next_after(self, when):
+        """ The first time after `when` the trigger fires. """
+        return when + timedelta(seconds=self.seconds)
+
+
+def _cron_values(field, lowest, highest):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step <= 0:
+                raise ValueError("Invalid step in {}".format(field))
+        if part == "*":
+            first, last = lowest, highest
+        elif "-" in part:
+            first, last = (int(value) for value in part.split("-", 1))
+        else:
+            first = int(part)
+            last = highest if step > 1 else first
+        if highest == 6 and last == 7:
+            # Sunday may be written as 7 as well as 0.
+            values.add(0)
+            if first == 7:
+                continue
+            last = 6
+        if first < lowest or last > highest or first > last:
+            raise ValueError("{} is out of range in {}".format(part, field))
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class CronTrigger:
+    """ Fires at the times matching a five field cron expression. """
+
+    def __init__(self, expression):
+        fields = str(expression).split()
+        if len(fields) != 5:
+            raise ValueError("Invalid cron expression: {}".format(expression))
+        self.expression = " ".join(fields)
+        try:
+            (self._minutes, self._hours, self._days, self._months,
+             self._weekdays) = [_cron_values(field, lowest, highest)
+                                for field, (lowest, highest)
+                                in zip(fields, _CRON_FIELDS)]
+        except ValueError as err:
+            raise ValueError("Invalid cron expression {}: {}".format(
+                expression, err))
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def __eq__(self, other):
+        return isinstance(other, CronTrigger) and \
+            other.expression == self.expression
+
+    def __str__(self):
+        return "cron {}".format(self.expression)
+
+    def _day_matches(self, when):
+        day = when.day in self._days
+        weekday = (when.weekday() + 1) % 7 in self._weekdays
+        # As in cron, a restricted day of month or of week may match alone.
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, when):
+        """ The first time after `when` the trigger fires. """
+        when = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = when + timedelta(days=_CRON_SEARCH_DAYS)
+        while when < limit:
+            if when.month not in self._months:
+                when = (when.replace(day=1, hour=0, minute=0) +
+                        timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(when):
+                when = when.replace(hour=0, minute=0) + timedelta(days=1)
+            elif when.hour not in self._hours:
+                when = when.replace(minute=0) + timedelta(hours=1)
+            elif when.minute not in self._minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError("{} never fires".format(self))
+
+
+def trigger_for(schedule):
+    """ The trigger for a workflow's `schedule` entry. Raises ValueError if
+        it is neither `every` nor `cron`. """
+    if not isinstance(schedule, dict):
+        raise ValueError("Invalid schedule: {}".format(schedule))
+    if schedule.get("every") is not None:
+        return IntervalTrigger(schedule["every"])
+    if schedule.get("cron") is not None:
+        return CronTrigger(schedule["cron"])
+    raise ValueError("Schedule needs `every` or `cron`: {}".format(schedule))
+
+
+class WorkflowScheduler:
+    """ Runs the scheduled workflows of a config on a pool of `jobs`
+        threads. `load_config` returns the current config, and
+        `run_workflow` is called with a workflow name to run it. """
+
+    def __init__(self, load_config, run_workflow, jobs=2, poll=POLL_SECS):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._load_config = load_config
+        self._run_workflow = run_workflow
+        self._jobs = max(1, int(jobs))
+        self._poll = poll
+        self._triggers = {}
+        self._due = {}
+        self._running = {}
+        self._stamp = None
+        self.config = None
+
+    @staticmethod
+    def _file_stamp(path):
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def reload(self, now=None):
+        """ Reloads the config if its file changed and reschedules its
+            workflows. A config which fails to load keeps the previous one
+            in force. Returns True if the schedule was rebuilt. """
+        path = getattr(self.config, "path", None)
+        stamp = self._file_stamp(path)
+        if self.config is not None and stamp == self._stamp:
+            return False
+
+        try:
+            config = self._load_config()
+        except Exception as err:
+            if self.config is None:
+                raise
+            self._log.error("Keeping the previous config: %s", err)
+            self._stamp = stamp
+            return False
+
+        if self.config is not None:
+            self._log.info("Config changed, rescheduling workflows")
+        self.config = config
+        self._stamp = self._file_stamp(getattr(config, "path", None))
+        self._schedule(config['workflows'] or {}, now or datetime.now())
+        return True
+
+    def _schedule(self, workflows, now):
+        triggers = {}
+        due = {}
+        for name, workflow in sorted(workflows.items()):
+            if not isinstance(workflow, dict) or not workflow.get("schedule"):
+                continue
+            try:
+                trigger = trigger_for(workflow["schedule"])
+                if self._triggers.get(name) == trigger and name in self._due:
+                    due[name] = self._due[name]
+                else:
+                    # Also catches cron expressions which never fire.
+                    due[name] = trigger.next_after(now)
+                    self._log.info("Scheduled workflow %s %s, next at %s",
+                                   name, trigger, due[name].isoformat(
+                                       timespec="minutes"))
+                triggers[name] = trigger
+            except ValueError as err:
+                self._log.error("Not scheduling workflow %s: %s", name, err)
+        self._triggers = triggers
+        self._due = due
+
+    def _launch(self, pool, name):
+        running = self._running.get(name)
+        if running is not None and not running.done():
+            self._log.warning("Workflow %s is still running; skipping this "
+                              "run", name)
+            return
+        self._log.info("Starting workflow %s", name)
+        self._running[name] = pool.submit(self._run, name)
+
+    def _run(self, name):
+        try:
+            if self._run_workflow(name):
+                self._log.info("Workflow %s finished", name)
+            else:
+                self._log.error("Workflow %s failed", name)
+        except Exception:
+            self._log.exception("Workflow %s raised", name)
+
+    def tick(self, pool, now=None):
+        """ Starts the workflows due by `now` and returns the seconds until
+            the next one is due, at most the poll interval. """
+        now = now or datetime.now()
+        for name in sorted(self._due):
+            if self._due[name] <= now:
+                self._launch(pool, name)
+                try:
+                    self._due[name] = self._triggers[name].next_after(now)
+                except ValueError as err:
+                    self._log.error("Not scheduling workflow %s again: %s",
+                                    name, err)
+                    del self._due[name]
+        wait = self._poll
+        if self._due:
+            wait = min(wait, (min(self._due.values()) - now).total_seconds())
+        return max(0.0, wait)
+
+    def run(self, stop):
+        """ Runs workflows as they fall due until event `stop` is set, then
+            waits for the running ones to finish. """
+        self.reload()
+        self._log.info("Running %d scheduled workflows on %d workers",
+                       len(self._triggers), self._jobs)
+        pool = ThreadPoolExecutor(max_workers=self._jobs,
+                                  thread_name_prefix="workflow")
+        try:
+            while not stop.is_set():
+                self.reload()
+                stop.wait(self.tick(pool))
+        finally:
+            _SHUTDOWN.set()
+            running = [name for name, future in self._running.items()
+                       if not future.done()]
+            if running:
+                self._log.info("Waiting for %s to finish",
+                               ", ".join(sorted(running)))
+            pool.shutdown(wait=True, cancel_futures=True)
+        return True
@@ -1,4 +1,4 @@
-import os, time
+import os
 
 from photopi.camera.cmd import RaspistillCmd
 from photopi.core.photopi import get_label_or_default, get_base_dir, get_remote_dir, get_device
@@ -44,12 +44,7 @@ class RaspistillModule():
         return self._run_spec(spec)
 
     def _run_spec(self, spec):
-        spec.start()
-
-        while True:
-            time.sleep(1)
-            if not spec.is_alive():
-                break
+        spec.call(capture=True)
 
         print(str(spec.output))
         print(str(spec.err))
@@ -1,17 +1,36 @@
-import rpyc, time
+""" Defines the Module serving photopi over rpyc. """
 
-from rpyc.utils.server import ThreadedServer
-from threading import Thread
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
 
+import rpyc
+from rpyc.utils.server import ThreadedServer
 
+from photopi.bundle.catalog import BundleCatalog, open_catalog
+from photopi.bundle.inventory import inventory_diff, node_inventory
+from photopi.bundle.transfer import file_digest
+from photopi.camera.capture import capture_service, close_capture_service
 from photopi.core.borg import Borg
 import photopi.raspistill.module
 
+DEFAULT_PORT = 18861
+
 
 class MyService(rpyc.Service):
-    def on_connect(self):
+    """ The photopi service, shared by every connection to the server. """
+
+    def __init__(self, config=None):
+        rpyc.Service.__init__(self)
+        self._config = config
+
+    def on_connect(self, conn):
         pass
-    def on_disconnect(self):
+
+    def on_disconnect(self, conn):
         # code that runs when the connection has already closed
         # (to finalize the service, if needed)
         pass
@@ -19,27 +38,95 @@ class MyService(rpyc.Service):
     def exposed_raspistill(self, args):
         return photopi.raspistill.module.get_module().main(args)
 
+    def _inventory(self, node, device, label):
+        path = self._config.storage_node(node)
+        if path is None:
+            raise ValueError("Invalid node {}".format(node))
+        # Without a catalog the node is listed once, in memory.
+        catalog = open_catalog(self._config, path) or \
+            BundleCatalog(path, ":memory:")
+        return node_inventory(catalog, device, label)
+
+    def exposed_inventory(self, node, device=None, label=None):
+        """ Inventory of the bundles on the server's storage node `node`, as
+            JSON so it is sent whole rather than as a remote reference. """
+        return json.dumps(self._inventory(node, device, label))
+
+    def exposed_diff(self, node, have, device=None, label=None):
+        """ Paths below the server's storage node `node` of the files the
+            client lacks; `have` holds (relative path, size) pairs of the
+            files it has. """
+        return tuple(inventory_diff(self._inventory(node, device, label),
+                                    dict(have)))
+
+    def _path(self, node, relpath):
+        root = self._config.storage_node(node)
+        if root is None:
+            raise ValueError("Invalid node {}".format(node))
+        root = os.path.realpath(root)
+        path = os.path.realpath(os.path.join(root, relpath))
+        if not path.startswith(root + os.sep):
+            raise ValueError("{} is outside node {}".format(relpath, node))
+        return path
+
+    def exposed_stat(self, node, relpaths):
+        """ (size, mtime in ns) of each of `relpaths` below storage node
+            `node`, or None for those missing. """
+        stats = []
+        for relpath in relpaths:
+            try:
+                stat = os.stat(self._path(node, relpath))
+                stats.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append(None)
+        return tuple(stats)
+
+    def exposed_read(self, node, relpath, offset, length):
+        """ Up to `length` bytes from `offset` of a file below storage node
+            `node`, with the sha256 hex digest they were read with. """
+        with open(self._path(node, relpath), "rb") as stream:
+            stream.seek(offset)
+            data = stream.read(length)
+        return data, hashlib.sha256(data).hexdigest()
+
+    def exposed_digest(self, node, relpath):
+        """ sha256 hex digest of a file below storage node `node`. """
+        return file_digest(self._path(node, relpath))
+
+    def exposed_capture(self, dest=None):
+        """ Takes a photo with the server's warm camera and returns its JPEG
+            data, also saving it to `dest` on the server if given. """
+        return capture_service(self._config).capture(dest=dest)
+
 
 class ServerModule(Borg):
+    """ Module for serving photopi to remote clients. """
     def __init__(self):
         Borg.__init__(self)
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
 
+    def main(self, args, config, prefs=None):
+        """ Serves until interrupted. The camera is started up front when
+            `camera_backend` is configured, otherwise on the first capture. """
+        port = int(args['--port'] or config['server_port'] or DEFAULT_PORT)
+        if config['camera_backend']:
+            capture_service(config).start()
 
-    def main(self, args):
-        print(args)
-
-        # start the rpyc server
-        server = ThreadedServer(MyService, port = int(args['--port']))
-        t = Thread(target = server.start)
-        t.daemon = True
-        t.start()
-
-        # the main logic
-        while True:
-            time.sleep(1)
-            print("run")
+        server = ThreadedServer(MyService(config), port=port)
+        # Replies such as photos otherwise wait on the client's delayed ACK,
+        # some 40ms a call. Accepted connections inherit the option.
+        server.listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._log.info("Serving photopi on port %d", port)
+        # Stop on SIGTERM as on SIGINT, so the camera is closed either way.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.start()
+        finally:
+            close_capture_service()
+        return True
 
 def get_module():
     return ServerModule()
 
-
+MODULE = ("server", ServerModule)
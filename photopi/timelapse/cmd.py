@@ -1,6 +1,18 @@
+import os
+import re
+
 from photopi.core.cmd import Cmd
 
+_POSITION_PATTERN = re.compile(r'^Pos:.*\(\s*(\d+)%\)')
+
+def _produced(avi_fname):
+    try:
+        return os.path.getsize(avi_fname), 1
+    except OSError:
+        return 0, 0
+
 class MencoderCmd(Cmd):
+    stage = "encode"
 
     def AllFiles(src, avi_fname):
         return MencoderCmd(avi_fname, "mf://{}/*.jpg".format(src))
@@ -8,18 +20,66 @@ class MencoderCmd(Cmd):
     def CustomFilelist(manifest, avi_fname):
         return MencoderCmd(avi_fname, manifest)
 
-    def __init__(self, avi_fname, manifest):
+    def ImagePipe(avi_fname):
+        """ Encoder reading concatenated JPEG frames from its stdin. """
+        return MencoderCmd(avi_fname, "-", pipe=True)
+
+    def Preview(avi_fname):
+        """ Small, low bitrate encoder reading thumbnails from its stdin. """
+        return MencoderCmd(avi_fname, "-", pipe=True, scale="320:180",
+                           bitrate=400000)
+
+    def __init__(self, avi_fname, manifest, pipe=False, scale="1920:1080",
+                 bitrate=8000000):
         Cmd.__init__(self)
         self._fname = avi_fname
         self._manifest = manifest
+        self._pipe = pipe
+        self._scale = scale
+        self._bitrate = bitrate
 
     def _cmd(self):
         return "mencoder"
 
     def _arguments(self):
         args = "-nosound -ovc lavc -lavcopts".split(" ")
-        args += ["vcodec=mpeg4:aspect=16/9:vbitrate=8000000"]
-        args += ["-vf", "scale=1920:1080"]
+        args += ["vcodec=mpeg4:aspect=16/9:vbitrate={}".format(self._bitrate)]
+        args += ["-vf", "scale={}".format(self._scale)]
         args += ["-o", self._fname]
-        args += ["-mf", "type=jpeg:fps=24", self._manifest]
+        if self._pipe:
+            args += ["-demuxer", "lavf", "-lavfdopts", "format=mjpeg"]
+            args += ["-fps", "24", self._manifest]
+        else:
+            args += ["-mf", "type=jpeg:fps=24", self._manifest]
         return args
+
+    def parse_progress(self, line):
+        """ Percentage encoded from a mencoder status line. """
+        match = _POSITION_PATTERN.search(line)
+        return int(match.group(1)) if match else None
+
+    def produced(self):
+        """ Size of the video written. """
+        return _produced(self._fname)
+
+class MencoderJoinCmd(Cmd):
+    """ Joins encoded videos into one file without re-encoding them. """
+    stage = "encode"
+
+    def __init__(self, segments, avi_fname):
+        Cmd.__init__(self)
+        self._segments = list(segments)
+        self._fname = avi_fname
+
+    def _cmd(self):
+        return "mencoder"
+
+    def _arguments(self):
+        args = "-nosound -ovc copy".split(" ")
+        args += ["-o", self._fname]
+        args += self._segments
+        return args
+
+    def produced(self):
+        """ Size of the joined video. """
+        return _produced(self._fname)
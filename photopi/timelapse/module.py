@@ -1,14 +1,23 @@
 from datetime import datetime
+import glob
 import logging
 import os
 import shutil
-import time
 
 from photopi.core.borg import Borg
-from photopi.core.cmd import RsyncCmd
+from photopi.core.cmd import RsyncCmd, log_progress
 from photopi.timelapse.spec import TimelapseSpec
 from photopi.timelapse.cmd import MencoderCmd
-from photopi.bundle.spec import BundleSpec
+from photopi.timelapse.scheduler import AutoScheduler, encode_slots
+from photopi.timelapse.segment import SegmentedEncode
+from photopi.timelapse.selection import FrameSelection, write_frames
+from photopi.timelapse.stream import FrameStreamer, bundle_manifest
+from photopi.bundle.archive import DECOMPRESS_ERRORS, ArchiveFormatError
+from photopi.bundle.catalog import open_catalog
+from photopi.bundle.index import ArchiveIndex
+from photopi.bundle.spec import BundleSort, BundleSpec
+from photopi.bundle.swapcache import SwapCache
+from photopi.bundle.thumbs import ensure_thumbs
 from photopi.bundle.module import BundleModule
 
 _YESOPTS = ["y", "Y", ""]
@@ -47,6 +56,12 @@ class TimelapseModule(Borg):
         if args['auto']:
             return self._autosuite(args, config, prefs)
 
+        if args['select']:
+            return self._select(args, config)
+
+        if args['preview']:
+            return self._preview(args, config)
+
         return self._suite(args, config)
 
     def _autosuite(self, args, config, prefs):
@@ -67,54 +82,201 @@ class TimelapseModule(Borg):
         path = config.storage_node(args['--node'])
         for device, labels in bundles[args['--node']].items():
             for label in sorted(labels):
-                specs.append(BundleSpec(device, label, path))
+                specs.append(BundleSpec(device, label, path,
+                                        index=open_catalog(config, path)))
 
         self._log.info(specs)
 
-        for spec in specs:
-            self._log.info("Loading %s", spec)
-            self._bundlemod.expand(spec, config)
-
-            dest_avi = os.path.join(destpath,
-                                    "{}-{}-timelapse.avi".format(
-                                        spec.label, spec.device))
+        names = {}
+        movepath = None
+        if not prefs:
+            for spec in specs:
+                names[(spec.device, spec.label)] = input(
+                    "Enter timelapse name for {}/{} > ".format(
+                        spec.device, spec.label))
+            move = input("Move archives once encoded? Y/n")
+            if move in _YESOPTS:
+                movepath = config.storage_node(_prompt(
+                    "Select destination node> ",
+                    list(config.storage_nodes.keys())))
+        elif prefs['move']:
+            movepath = config.storage_node(prefs['movedest'])
+
+        scheduler = AutoScheduler(
+            self._bundlemod, config, destpath,
+            slots=encode_slots(config, args['--encodes']),
+            stream=args['--stream'], segment=args['--segment'], names=names,
+            movepath=movepath)
+        results = scheduler.run(specs)
+
+        failed = [result for result in results if not result.ok]
+        self._log.info("Rendered %d of %d bundles", len(results) - len(failed),
+                       len(results))
+        return not failed
+
+    def _select(self, args, config):
+        """ Encodes a timelapse from a selection of frames which may span
+            several bundles, reading only the parts holding those frames. """
+        try:
+            selection = FrameSelection.FromArgs(args)
+        except ValueError as err:
+            self._log.error(err)
+            return False
 
-            if not prefs:
-                input("hit <enter> when ready to encode: {}/{}> ".format(
-                              spec.device, spec.label))
+        node = args['--node'] if args['--node'] else "local"
+        path = config.storage_node(node)
+        if path is None:
+            self._log.error("Invalid source node")
+            return False
+        device = args['--device'] if args['--device'] else config.device_id
 
+        bundles = self._bundlemod.filter_bundles(
+            dict(args, **{'--node': node, '--device': device}), config)
+        index = open_catalog(config, path)
+        specs = [BundleSpec(device, label, path, index=index)
+                 for label in sorted(bundles[node].get(device, []))]
 
-            self._log.info("Writing %s", dest_avi)
+        manifest = selection.manifest(specs)
+        if not manifest:
+            self._log.error("No frames selected")
+            return False
+        self._log.info("Selected %d frames", len(manifest))
 
-            loadedpath = os.path.join(config.swap_path, spec.device,
-                                      spec.label)
+        destnode = args['--dest'] or _prompt(
+            "Select destination node> ", list(config.storage_nodes.keys()))
+        destpath = config.storage_node(destnode)
+        if not destpath:
+            self._log.warning("node [%s] is not configured", destnode)
+            return False
 
-            cmd = MencoderCmd.AllFiles(loadedpath, dest_avi)
-            cmd.start()
+        fname = args['--name'] or input("Enter timelapse name> ")
 
-            while cmd.is_alive():
-                time.sleep(1)
+        labels = sorted(set(BundleSort.get_label(index.archive)
+                            for index, _ in manifest))
+        span = labels[0] if len(labels) == 1 else "{}_{}".format(
+            labels[0], labels[-1])
+        dest_avi = os.path.join(destpath, "{}-{}-timelapse-{}.avi".format(
+            span, device, fname))
 
-            if not prefs:
-                fname = input("Enter timelapse name for {}/{} > ".format(
-                              spec.device, spec.label))
-            else:
-                fname = ""
+        if args['--segment']:
+            # Segments are named after the archive members they hold, so
+            # they stream from the archives to stay resumable.
+            self._log.info("Writing %s", dest_avi)
+            return self._segmented(args, config, manifest, dest_avi, True)
 
-            finalfname = os.path.join(destpath,
-                                      "{}-{}-timelapse-{}.avi".format(
-                                          spec.label, spec.device, fname))
-            shutil.move(dest_avi, finalfname)
+        if args['--stream']:
+            self._log.info("Writing %s", dest_avi)
+            return self._stream(manifest, dest_avi)
+
+        workname = "select-{}-{}".format(span, fname)
+        workdir = os.path.join(config.swap_path, device, workname)
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(workdir)
+        # The frames take swap like an expanded bundle, so they are held to
+        # the budget and kept from eviction the same way.
+        swap = SwapCache(config)
+        try:
+            with swap.pinned(device, workname):
+                try:
+                    if not swap.reserve(device, workname, sum(
+                            member.size for _, member in manifest)):
+                        return False
+                except ValueError as err:
+                    self._log.error("swap_budget: %s", err)
+                    return False
+                paths = write_frames(manifest, workdir)
+                listfile = os.path.join(workdir, "frames.txt")
+                with open(listfile, "w") as stream:
+                    stream.write("\n".join(paths) + "\n")
+
+                self._log.info("Writing %s", dest_avi)
+                cmd = MencoderCmd.CustomFilelist(
+                    "mf://@{}".format(listfile), dest_avi)
+                cmd.run()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            swap.forget(device, workname)
+        return cmd.returncode == 0
+
+    def _preview(self, args, config):
+        """ Renders a small preview video of each selected bundle from the
+            thumbnail sidecars of its parts, making any which are missing. """
+        node = args['--node'] if args['--node'] else "local"
+        path = config.storage_node(node)
+        if path is None:
+            self._log.error("Invalid source node")
+            return False
+        destnode = args['--dest'] if args['--dest'] else "swap"
+        destpath = config.storage_node(destnode)
+        if destpath is None:
+            self._log.error("Invalid dest node")
+            return False
 
-            if not prefs:
-                move = input("timelapse complete. Move archives? Y/n")
-                if move in ["y", "Y"]:
-                    return self._movearchives(spec, config)
-            else:
-                if prefs['move']:
-                    destpath = config.storage_node(prefs['movedest'])
-                    return self._bundlemod.fetch(spec, destpath, move=True)
-            return True
+        bundles = self._bundlemod.filter_bundles(
+            dict(args, **{'--node': node}), config)
+        index = open_catalog(config, path)
+        failed = 0
+        count = 0
+        for device, labels in sorted(bundles[node].items()):
+            for label in sorted(labels):
+                spec = BundleSpec(device, label, path, index=index)
+                dest_avi = os.path.join(destpath, "{}-{}-preview.avi".format(
+                    label, device))
+                manifest = []
+                seen = set()
+                count += 1
+                try:
+                    for sidecar in ensure_thumbs(spec.archives()):
+                        thumbs = ArchiveIndex.Build(sidecar)
+                        for number in thumbs.frames():
+                            member = thumbs.member(number)
+                            if member.name not in seen:
+                                seen.add(member.name)
+                                manifest.append((thumbs, member))
+                except (ArchiveFormatError, EOFError) + DECOMPRESS_ERRORS \
+                        as err:
+                    # A damaged archive costs its bundle, not the whole run.
+                    self._log.error("%s/%s: unable to read thumbnails: %s",
+                                    device, label, err)
+                    failed += 1
+                    continue
+
+                if self._stream(manifest, dest_avi, preview=True):
+                    self._log.info("%s/%s: %d frames -> %s", device, label,
+                                   len(manifest), dest_avi)
+                else:
+                    self._log.error("%s/%s: preview failed", device, label)
+                    failed += 1
+
+        self._log.info("Rendered %d of %d previews", count - failed, count)
+        return not failed
+
+    def _stream(self, manifest, dest_avi, preview=False):
+        """ Encodes the frames in `manifest` by piping them out of their
+            archives into the encoder, without expanding them to swap. """
+        if not manifest:
+            self._log.error("No frames to encode")
+            return False
+        cmd = (MencoderCmd.Preview(dest_avi) if preview else
+               MencoderCmd.ImagePipe(dest_avi))
+        return FrameStreamer(manifest).run(cmd)
+
+    def _segmented(self, args, config, frames, dest_avi, stream):
+        """ Encodes `frames` in segments of `--segment` frames, as many at
+            once as there are encode slots. """
+        return SegmentedEncode(dest_avi, frames,
+                               segment_frames=args['--segment'],
+                               jobs=encode_slots(config, args['--encodes']),
+                               stream=stream).run()
+
+    def _bundle_segmented(self, args, config, bundle, dest_avi):
+        if args['--stream']:
+            frames = bundle_manifest([bundle])
+        else:
+            frames = sorted(glob.glob(os.path.join(
+                config.swap_path, bundle.device, bundle.label, "*.jpg")))
+        return self._segmented(args, config, frames, dest_avi,
+                               args['--stream'])
 
     def _suite(self, args, config):
         done = False
@@ -153,11 +315,14 @@ class TimelapseModule(Borg):
             else:
                 label = labels[0]
 
-            bundle = BundleSpec(device, label, config.storage_node(node))
+            path = config.storage_node(node)
+            bundle = BundleSpec(device, label, path,
+                                index=open_catalog(config, path))
 
             print("Processing {}/{}/{}".format(node, device, label))
 
-            loaded = self._bundlemod.expand(bundle, config)
+            loaded = (args['--stream'] or
+                      self._bundlemod.expand(bundle, config))
 
             if not loaded:
                 self._log.error("Unable to load")
@@ -178,14 +343,17 @@ class TimelapseModule(Borg):
                                     "{}-{}-timelapse-{}.avi".format(
                                         bundle.device, bundle.label, fname))
 
-            loadedpath = os.path.join(config.swap_path, bundle.device,
-                                      bundle.label)
-
-            cmd = MencoderCmd.AllFiles(loadedpath, dest_avi)
-            cmd.start()
+            if args['--segment']:
+                self._bundle_segmented(args, config, bundle, dest_avi)
+            elif args['--stream']:
+                self._stream(bundle_manifest([bundle]), dest_avi)
+            else:
+                loadedpath = os.path.join(config.swap_path, bundle.device,
+                                          bundle.label)
 
-            while not cmd.is_alive():
-                time.sleep(1)
+                cmd = MencoderCmd.AllFiles(loadedpath, dest_avi)
+                cmd.call(progress=log_progress(self._log,
+                                               os.path.basename(dest_avi)))
 
             move = input("timelapse complete. Move archives? Y/n")
             if move in _SELFOPTS:
@@ -200,7 +368,9 @@ class TimelapseModule(Borg):
         destnode = _prompt("Select destination node> ",
                            list(config.storage_nodes.keys()))
         destpath = config.storage_node(destnode)
-        return self._bundlemod.fetch(bundle, destpath, move=True)
+        return self._bundlemod.fetch(bundle, destpath, move=True,
+                                     backend=config['transfer_backend'],
+                                     verify=config['transfer_verify'])
 
     def _suite(self, args, config):
         self._log.debug(args)
@@ -238,11 +408,20 @@ class TimelapseModule(Borg):
         else:
             label = labels[0]
 
-        bundle = BundleSpec(device, label, config.storage_node(node))
+        path = config.storage_node(node)
+        bundle = BundleSpec(device, label, path,
+                            index=open_catalog(config, path))
 
         print("Processing {}/{}/{}".format(node, device, label))
 
-        loaded = bundle_mod.expand(bundle, config)
+        if args['--stream']:
+            return self._suite_bundle(args, config, bundle_mod, bundle)
+        # Kept from eviction by other expands until it is encoded.
+        with SwapCache(config).pinned(bundle.device, bundle.label):
+            return self._suite_bundle(args, config, bundle_mod, bundle)
+
+    def _suite_bundle(self, args, config, bundle_mod, bundle):
+        loaded = args['--stream'] or bundle_mod.expand(bundle, config)
 
         if not loaded:
             self._log.error("Unable to load")
@@ -263,15 +442,18 @@ class TimelapseModule(Borg):
                                 "{}-{}-timelapse-{}.avi".format(
                                     bundle.device, bundle.label, fname))
 
+        if args['--segment']:
+            return self._bundle_segmented(args, config, bundle, dest_avi)
+
+        if args['--stream']:
+            return self._stream(bundle_manifest([bundle]), dest_avi)
+
         loadedpath = os.path.join(config.swap_path, bundle.device, bundle.label)
 
         cmd = MencoderCmd.AllFiles(loadedpath, dest_avi)
-        cmd.start()
-
-        while not cmd.is_alive():
-            time.sleep(1)
+        cmd.call(progress=log_progress(self._log, os.path.basename(dest_avi)))
 
-        return cmd.returncode == 0 or cmd.returncode == None
+        return cmd.returncode == 0
 
 
 MODULE = ("timelapse", TimelapseModule)
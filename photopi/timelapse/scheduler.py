@@ -0,0 +1,216 @@
+"""
+Pipelined scheduling of `timelapse auto`.
+
+Bundles are expanded one after another on the calling thread while the
+encodes of earlier bundles run on a pool, so the expand of bundle N+1
+overlaps the encode of bundle N. The number of concurrent encodes is sized
+from the cores and the available memory unless configured, and the number of
+bundles expanded ahead of the encoders is bounded so swap only holds the
+bundles being worked on.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+
+from photopi.bundle.swapcache import SwapCache
+from photopi.core import metrics
+from photopi.core.cmd import log_progress
+from photopi.timelapse.cmd import MencoderCmd
+from photopi.timelapse.segment import SegmentedEncode
+from photopi.timelapse.stream import FrameStreamer, bundle_manifest
+
+ENCODE_MEMORY = 512
+
+
+def available_memory():
+    """ Bytes of memory available to new processes, or None if unknown. """
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def encode_slots(config, requested=None):
+    """ Number of encodes to run at once. `requested` (or `encode_jobs` in the
+        config) wins; otherwise one per core, limited by the memory available
+        at `encode_memory` MiB (default 512) per encode. """
+    requested = requested or config['encode_jobs']
+    if requested:
+        return max(1, int(requested))
+
+    slots = os.cpu_count() or 1
+    memory = available_memory()
+    if memory is not None:
+        per_encode = (config['encode_memory'] or ENCODE_MEMORY) * 1024 * 1024
+        slots = min(slots, memory // per_encode)
+    return max(1, slots)
+
+
+class BundleResult:
+    """ Outcome of rendering the timelapse of one bundle. """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.avi = None
+        self.expanded = False
+        self.encoded = False
+        self.moved = None
+        self.error = None
+        self.expand_secs = 0.0
+        self.encode_secs = 0.0
+
+    def __str__(self):
+        return str(self.__dict__)
+
+    @property
+    def ok(self):
+        """ Indicates whether the bundle was rendered (and moved, if asked). """
+        return self.encoded and self.moved is not False and not self.error
+
+    def summary(self):
+        """ One line report for this bundle. """
+        status = "ok" if self.ok else "FAILED"
+        line = "{}/{}: {} (expand {:.1f}s, encode {:.1f}s)".format(
+            self.spec.device, self.spec.label, status, self.expand_secs,
+            self.encode_secs)
+        if self.avi and self.encoded:
+            line += " -> {}".format(self.avi)
+        if self.error:
+            line += ": {}".format(self.error)
+        return line
+
+
+class AutoScheduler:
+    """ Expands and encodes a list of bundles with overlapping stages. """
+
+    def __init__(self, bundlemod, config, destpath, slots=1, stream=False,
+                 segment=None, names=None, movepath=None):
+        """ `names` maps (device, label) to the name of its timelapse, and
+            archives are moved to `movepath` once encoded when it is set.
+            With `segment`, bundles are encoded one at a time in segments of
+            that many frames, the slots encoding segments instead. """
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._bundlemod = bundlemod
+        self._config = config
+        self._destpath = destpath
+        self._slots = slots
+        self._stream = stream
+        self._segment = segment
+        self._workers = 1 if segment else slots
+        self._names = names or {}
+        self._movepath = movepath
+        self._swap = SwapCache(config)
+        # Bundles expanded but not yet encoded, beyond those encoding.
+        self._ahead = threading.BoundedSemaphore(self._workers + 1)
+
+    def _expand(self, spec, result):
+        start = time.monotonic()
+        try:
+            if self._stream:
+                result.expanded = True
+            else:
+                # Leave the cores not taken by encodes to the extraction.
+                jobs = max(1, (os.cpu_count() or 1) - self._workers)
+                # Pinned before it expands, so no expand, here or in another
+                # process, evicts it before it encodes.
+                self._swap.pin(spec.device, spec.label)
+                result.expanded = self._bundlemod.expand(
+                    spec, self._config, jobs=jobs)
+        except (OSError, RuntimeError) as err:
+            result.error = "expand failed: {}".format(err)
+        if not self._stream and not (result.expanded and not result.error):
+            self._swap.unpin(spec.device, spec.label)
+        if not result.expanded and not result.error:
+            result.error = "unable to load"
+        result.expand_secs = time.monotonic() - start
+        return result.expanded and not result.error
+
+    def _encode(self, spec, result):
+        start = time.monotonic()
+        dest_avi = os.path.join(self._destpath, "{}-{}-timelapse.avi".format(
+            spec.label, spec.device))
+        try:
+            self._log.info("Writing %s", dest_avi)
+            if self._segment:
+                if self._stream:
+                    frames = bundle_manifest([spec])
+                else:
+                    frames = sorted(glob.glob(os.path.join(
+                        self._config.swap_path, spec.device, spec.label,
+                        "*.jpg")))
+                result.encoded = SegmentedEncode(
+                    dest_avi, frames, segment_frames=self._segment,
+                    jobs=self._slots, stream=self._stream).run()
+            elif self._stream:
+                result.encoded = FrameStreamer(bundle_manifest([spec])).run(
+                    MencoderCmd.ImagePipe(dest_avi))
+            else:
+                loadedpath = os.path.join(self._config.swap_path, spec.device,
+                                          spec.label)
+                cmd = MencoderCmd.AllFiles(loadedpath, dest_avi)
+                cmd.call(progress=log_progress(self._log,
+                                               os.path.basename(dest_avi)))
+                result.encoded = cmd.returncode == 0
+
+            if result.encoded:
+                name = self._names.get((spec.device, spec.label), "")
+                result.avi = os.path.join(
+                    self._destpath, "{}-{}-timelapse-{}.avi".format(
+                        spec.label, spec.device, name))
+                shutil.move(dest_avi, result.avi)
+                if self._movepath:
+                    result.moved = self._bundlemod.fetch(
+                        spec, self._movepath, move=True,
+                        backend=self._config['transfer_backend'],
+                        verify=self._config['transfer_verify'])
+            else:
+                result.error = "encoder failed"
+        except (OSError, RuntimeError) as err:
+            result.error = "encode failed: {}".format(err)
+        finally:
+            result.encode_secs = time.monotonic() - start
+            if not self._stream:
+                self._swap.unpin(spec.device, spec.label)
+            self._ahead.release()
+        self._report(result)
+        return result
+
+    def _report(self, result):
+        if result.ok:
+            self._log.info(result.summary())
+        else:
+            self._log.error(result.summary())
+
+    def run(self, specs):
+        """ Renders `specs` and returns a :class:`BundleResult` for each, in
+            the order given. """
+        self._log.info("Rendering %d bundles with %d encoders", len(specs),
+                       self._slots)
+        results = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            for spec in specs:
+                result = BundleResult(spec)
+                results.append(result)
+
+                self._ahead.acquire()
+                self._log.info("Loading %s", spec)
+                if not self._expand(spec, result):
+                    self._ahead.release()
+                    self._report(result)
+                    continue
+                futures.append(pool.submit(metrics.in_scope(self._encode),
+                                           spec, result))
+
+            for future in futures:
+                future.result()
+        return results
@@ -0,0 +1,124 @@
+"""
+Segmented encoding of long frame sequences.
+
+The frames are split into fixed-size segments which are encoded as separate
+videos at the same time, then joined into the final file with a stream copy.
+Every segment starts a new encode, so it begins on a keyframe and the join
+needs no re-encoding. Finished segments are kept, named after the frames
+they hold, until the join succeeds; an interrupted encode resumes by only
+encoding the segments which are missing.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import shutil
+
+from photopi.core import metrics
+from photopi.timelapse.cmd import MencoderCmd, MencoderJoinCmd
+from photopi.timelapse.stream import FrameStreamer
+
+SEGMENT_FRAMES = 7200
+
+
+def segment_dir(dest_avi):
+    """ Directory holding the segments of `dest_avi` while it is encoded. """
+    return "{}.segments".format(dest_avi)
+
+
+def _frame_key(frame):
+    if isinstance(frame, tuple):
+        index, member = frame
+        return "{}:{}:{}".format(os.path.basename(index.archive), member.name,
+                                 member.size)
+    stat = os.stat(frame)
+    return "{}:{}:{}".format(os.path.basename(frame), stat.st_size,
+                             stat.st_mtime_ns)
+
+
+class SegmentedEncode:
+    """ Encodes `frames` into `dest_avi` as segments of `segment_frames`
+        frames, `jobs` at a time. `frames` are either JPEG paths or, with
+        `stream`, (index, member) pairs which are piped out of their
+        archives. """
+
+    def __init__(self, dest_avi, frames, segment_frames=SEGMENT_FRAMES,
+                 jobs=1, stream=False):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._dest_avi = dest_avi
+        self._frames = frames
+        self._segment_frames = max(1, int(segment_frames))
+        self._jobs = max(1, int(jobs))
+        self._stream = stream
+        self._workdir = segment_dir(dest_avi)
+
+    def segments(self):
+        """ List of (path, frames) for each segment. A segment is named after
+            a digest of its frames, so a changed bundle never reuses a stale
+            segment. """
+        segments = []
+        for seq, start in enumerate(range(0, len(self._frames),
+                                          self._segment_frames)):
+            frames = self._frames[start:start + self._segment_frames]
+            digest = hashlib.sha1("\n".join(
+                _frame_key(frame) for frame in frames).encode()).hexdigest()
+            segments.append((os.path.join(
+                self._workdir, "seg{:05d}-{}.avi".format(seq, digest[:12])),
+                             frames))
+        return segments
+
+    def _encode_segment(self, fname, frames):
+        tmpname = "{}.part.avi".format(fname[:-len(".avi")])
+        if self._stream:
+            done = FrameStreamer(frames).run(MencoderCmd.ImagePipe(tmpname))
+        else:
+            listfile = "{}.txt".format(fname[:-len(".avi")])
+            with open(listfile, "w") as stream:
+                stream.write("\n".join(frames) + "\n")
+            cmd = MencoderCmd.CustomFilelist("mf://@{}".format(listfile),
+                                             tmpname)
+            cmd.run()
+            done = cmd.returncode == 0
+            os.remove(listfile)
+
+        if not done:
+            self._log.error("Unable to encode %s", os.path.basename(fname))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            return False
+        os.replace(tmpname, fname)
+        self._log.info("Encoded %s", os.path.basename(fname))
+        return True
+
+    def run(self):
+        """ Encodes the missing segments, joins them and removes them once the
+            final video is written. Returns True on success. """
+        if not self._frames:
+            self._log.error("No frames to encode")
+            return False
+        os.makedirs(self._workdir, exist_ok=True)
+
+        segments = self.segments()
+        pending = [(fname, frames) for fname, frames in segments
+                   if not os.path.isfile(fname)]
+        self._log.info("Encoding %d of %d segments, %d at a time",
+                       len(pending), len(segments), self._jobs)
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            encode = metrics.in_scope(self._encode_segment)
+            results = list(pool.map(lambda seg: encode(*seg), pending))
+        if not all(results):
+            self._log.error("%d segments failed, rerun to resume",
+                            results.count(False))
+            return False
+
+        cmd = MencoderJoinCmd([fname for fname, _ in segments],
+                              self._dest_avi)
+        cmd.run()
+        if cmd.returncode != 0:
+            self._log.error("Unable to join segments into %s", self._dest_avi)
+            return False
+
+        shutil.rmtree(self._workdir, ignore_errors=True)
+        return True
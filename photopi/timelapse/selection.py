@@ -0,0 +1,157 @@
+"""
+Frame selection for timelapses spanning part of one bundle or many.
+
+A :class:`FrameSelection` picks frames by number, by capture time window and
+by subsampling (every Nth frame, or at most one frame per interval). The
+selection is resolved against the index sidecars of the archives, so only
+the parts holding selected frames are ever read, and only the selected
+members are decompressed out of them.
+"""
+from datetime import datetime, timedelta
+import logging
+import os
+
+from photopi.bundle.index import (ArchiveIndex, archive_spans, frame_ranges,
+                                  parse_frames, span_selected)
+from photopi.core.schedule import parse_interval
+
+
+def parse_when(when, now=None):
+    """ Datetime for `when`, either an ISO date/time such as `2026-09-01` or
+        `2026-09-01T06:00`, or an interval before `now` such as `30d`. """
+    if not when:
+        return None
+    try:
+        return datetime.fromisoformat(when)
+    except ValueError:
+        pass
+    now = now or datetime.now()
+    return now - timedelta(seconds=parse_interval(when))
+
+
+def parse_label_span(span):
+    """ (first, last) labels for a span such as `2026-09-01:2026-09-30`. Either
+        end may be left empty. """
+    if not span:
+        return (None, None)
+    first, sep, last = span.partition(":")
+    if not sep:
+        return (first, first)
+    return (first or None, last or None)
+
+
+class FrameSelection:
+    """ Criteria for the frames making up a timelapse. """
+
+    def __init__(self, frames=None, since=None, until=None, every=None,
+                 step=None, labels=None):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._frames = parse_frames(frames)
+        self._ranges = frame_ranges(frames)
+        self.since = parse_when(since)
+        self.until = parse_when(until)
+        self.every = int(every) if every not in (None, "") else 1
+        if self.every < 1:
+            raise ValueError("--every must be a positive integer")
+        self.step = parse_interval(step) if step else None
+        self.first_label, self.last_label = parse_label_span(labels)
+
+    @staticmethod
+    def FromArgs(args):
+        """ Selection described by the `timelapse select` options. """
+        return FrameSelection(frames=args['--frames'], since=args['--since'],
+                              until=args['--until'], every=args['--every'],
+                              step=args['--step'], labels=args['--labels'])
+
+    def wants_label(self, label):
+        """ Indicates whether bundle `label` can hold selected frames. """
+        if self.first_label and label < self.first_label:
+            return False
+        if self.last_label and label > self.last_label:
+            return False
+        try:
+            day = datetime.strptime(label, "%Y-%m-%d").date()
+        except ValueError:
+            return True
+        if self.since and day < self.since.date():
+            return False
+        if self.until and day > self.until.date():
+            return False
+        return True
+
+    def _in_window(self, mtime):
+        if self.since and mtime < self.since.timestamp():
+            return False
+        if self.until and mtime > self.until.timestamp():
+            return False
+        return True
+
+    def _wants_archive(self, index):
+        times = [member.mtime for member in index.members]
+        if not times:
+            return False
+        if self.since and max(times) < self.since.timestamp():
+            return False
+        if self.until and min(times) > self.until.timestamp():
+            return False
+        return True
+
+    def manifest(self, specs):
+        """ List of (index, member) for the selected frames of the bundles
+            `specs`, in capture order. """
+        candidates = []
+        for spec in specs:
+            if not self.wants_label(spec.label):
+                continue
+            if self._ranges is None:
+                spans = [(archive, None, None)
+                         for archive in spec.archives()]
+            else:
+                spans = archive_spans(spec)
+            for archive, after, last in spans:
+                if not span_selected(self._ranges, after, last):
+                    # None of its frames selected, by its done markers.
+                    self._log.debug("Skipping %s", archive)
+                    continue
+                index = ArchiveIndex.ForArchive(archive)
+                if not self._wants_archive(index):
+                    self._log.debug("Skipping %s", archive)
+                    continue
+                for number in index.frames():
+                    member = index.member(number)
+                    if (member.size and self._frames(number) and
+                            self._in_window(member.mtime)):
+                        candidates.append((index, member))
+
+        candidates.sort(key=lambda item: (item[1].mtime, item[1].number))
+
+        selected = []
+        lasttime = None
+        for index, member in candidates:
+            if (self.step and lasttime is not None and
+                    member.mtime - lasttime < self.step):
+                continue
+            lasttime = member.mtime
+            selected.append((index, member))
+        return selected[::self.every]
+
+
+def write_frames(manifest, dest):
+    """ Extracts the frames in `manifest` into `dest` as sequentially numbered
+        files, reading each archive once, and returns their paths in order. """
+    os.makedirs(dest, exist_ok=True)
+    byarchive = {}
+    for seq, (index, member) in enumerate(manifest):
+        entries = byarchive.setdefault(index.archive, (index, {}))[1]
+        entries[id(member)] = (member, seq)
+
+    paths = [None] * len(manifest)
+    for index, entries in byarchive.values():
+        members = [member for member, _ in entries.values()]
+        for member, data in index.iter_read(members):
+            seq = entries[id(member)][1]
+            paths[seq] = os.path.join(dest, "frame{:08d}.jpg".format(seq))
+            with open(paths[seq], "wb") as stream:
+                stream.write(data)
+    return paths
@@ -0,0 +1,139 @@
+"""
+Streaming encode of frames read straight out of bundle archives.
+
+Instead of expanding a bundle into swap and letting the encoder read the
+JPEGs back from disk, the frames are decompressed in frame order and written
+to the encoder's stdin as an image pipe. A reader thread fills a bounded
+queue of batches while the encoder drains it, so memory use stays at a few
+batches whatever the size of the bundle, and the only file written is the
+output video.
+"""
+import itertools
+import logging
+import queue
+import threading
+from subprocess import PIPE
+
+from photopi.bundle.archive import DECOMPRESS_ERRORS, ArchiveFormatError
+from photopi.bundle.index import bundle_frames
+from photopi.core import metrics
+
+BATCH_BYTES = 16 * 1024 * 1024
+QUEUE_DEPTH = 4
+
+READ_ERRORS = (OSError, EOFError, ArchiveFormatError) + DECOMPRESS_ERRORS
+
+
+def bundle_manifest(specs):
+    """ List of (index, member) for every frame of the bundles `specs` in
+        frame order. Like expand, empty members are skipped and a filename
+        repeated in a later archive is ignored. """
+    manifest = []
+    seen = set()
+    for spec in specs:
+        for index, member in bundle_frames(spec):
+            if not member.size or member.name in seen:
+                continue
+            seen.add(member.name)
+            manifest.append((index, member))
+    return manifest
+
+
+def iter_frames(manifest):
+    """ Yields the contents of the frames in `manifest` in manifest order.
+        Each run of consecutive frames from one archive is read in a single
+        forward pass. """
+    for index, run in itertools.groupby(manifest, key=lambda item: item[0]):
+        members = [member for _, member in run]
+        order = {id(member): seq for seq, member in enumerate(members)}
+        pending = {}
+        nextseq = 0
+        for member, data in index.iter_read(members):
+            pending[order[id(member)]] = data
+            while nextseq in pending:
+                yield pending.pop(nextseq)
+                nextseq += 1
+
+
+def iter_batches(frames, batch_bytes=BATCH_BYTES):
+    """ Groups the byte strings `frames` into lists of about `batch_bytes`. """
+    batch = []
+    size = 0
+    for data in frames:
+        batch.append(data)
+        size += len(data)
+        if size >= batch_bytes:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+class FrameStreamer:
+    """ Feeds the frames of a manifest to the stdin of an encoder command. """
+
+    def __init__(self, manifest, batch_bytes=BATCH_BYTES, depth=QUEUE_DEPTH):
+        self._log = logging.getLogger(
+            "{}.{}".format(self.__class__.__module__, self.__class__.__name__))
+        self._manifest = manifest
+        self._batch_bytes = batch_bytes
+        self._queue = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self.error = None
+        self.frames = 0
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self):
+        try:
+            for batch in iter_batches(iter_frames(self._manifest),
+                                      self._batch_bytes):
+                if not self._put(batch):
+                    return
+        except READ_ERRORS as err:
+            self.error = err
+        finally:
+            self._put(None)
+
+    def run(self, cmd):
+        """ Runs `cmd` with the frames piped to its stdin. Returns True when
+            every frame was read and the encoder succeeded. Reading stops
+            early if the encoder exits. """
+        with metrics.stage(cmd.stage, streamed=True) as stage:
+            process = cmd.spawn(stdin=PIPE)
+            reader = threading.Thread(target=self._read, daemon=True)
+            reader.start()
+            try:
+                while True:
+                    batch = self._queue.get()
+                    if batch is None:
+                        break
+                    for data in batch:
+                        process.stdin.write(data)
+                        stage.add(nbytes=len(data), files=1)
+                    self.frames += len(batch)
+            except BrokenPipeError:
+                self._log.error("Encoder exited after %d frames", self.frames)
+            finally:
+                self._stopped.set()
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                cmd.returncode = process.wait()
+                reader.join()
+            stage.ok = cmd.returncode == 0 and self.error is None
+
+        if self.error is not None:
+            self._log.error("Unable to read frames: %s", self.error)
+            return False
+        self._log.info("Streamed %d frames", self.frames)
+        return cmd.returncode == 0
@@ -21,6 +21,10 @@ setup(
         'docopt',
         'PyYAML'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'thumbs': ['Pillow'],
+    },
     scripts=[
         'bin/photopi'
     ],